@@ -8,19 +8,1346 @@ B站用户视频批量下载器
 作者: 根据BilibiliDown项目分析创建
 """
 
+import argparse
 import requests
 import json
 import os
 import time
 import hashlib
 import urllib.parse
-from typing import List, Dict, Optional
+import threading
+import queue
+import sqlite3
+import struct
+import asyncio
+import functools
+import contextvars
+import tracemalloc
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List, Dict, Iterable, Iterator, Optional
 import sys
 
+try:
+    import aiohttp
+except ImportError:  # 异步下载后端为可选功能，未安装aiohttp时使用默认的线程后端
+    aiohttp = None
+
+
+class DownloadStats:
+    """线程安全的下载计数器（替代 success_count/fail_count）"""
+
+    def __init__(self, total: int = 0):
+        self.total = total
+        self.success = 0
+        self.fail = 0
+        self.skipped = 0  # 超出流量预算而未下载的视频
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, success: bool):
+        with self._lock:
+            if success:
+                self.success += 1
+            else:
+                self.fail += 1
+
+    def record_skipped(self):
+        with self._lock:
+            self.skipped += 1
+
+    @property
+    def elapsed(self) -> float:
+        return time.time() - self.start_time
+
+
+class RunMetrics:
+    """一次运行的计时和计数：各阶段耗时、HTTP状态码、重试次数、各CDN节点的传输量和吞吐
+
+    线程安全，运行结束后可导出为JSON报告或 Prometheus textfile（node_exporter textfile collector 格式）。
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._phases: Dict[str, Dict] = {}
+        self._counters: Dict[str, int] = {}
+        self._http: Dict[str, Dict[str, int]] = {}
+        self._transfers: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        """对 with 块计时并计入 name 阶段，块内抛出异常时同时计为一次错误"""
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                phase = self._phases.setdefault(name, {'count': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+                phase['count'] += 1
+                phase['errors'] += failed
+                phase['seconds'] += elapsed
+                phase['max_seconds'] = max(phase['max_seconds'], elapsed)
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def record_status(self, endpoint: str, status: int, code=None):
+        """记录API响应的HTTP状态码，以及JSON中非0的业务错误码"""
+        with self._lock:
+            statuses = self._http.setdefault(endpoint, {})
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if code not in (None, 0):
+                key = f"code {code}"
+                statuses[key] = statuses.get(key, 0) + 1
+
+    def record_transfer(self, url: str, size: int, seconds: float):
+        """按CDN节点（域名）累计传输的字节数和耗时"""
+        host = urllib.parse.urlparse(str(url)).netloc or 'unknown'
+        with self._lock:
+            transfer = self._transfers.setdefault(host, {'requests': 0, 'bytes': 0, 'seconds': 0.0})
+            transfer['requests'] += 1
+            transfer['bytes'] += size
+            transfer['seconds'] += seconds
+
+    def report(self, stats: Optional['DownloadStats'] = None, cache: Optional['MetadataCache'] = None) -> Dict:
+        with self._lock:
+            phases = {name: dict(phase, avg_seconds=phase['seconds'] / phase['count'])
+                      for name, phase in self._phases.items()}
+            transfers = {host: dict(transfer, throughput=transfer['bytes'] / transfer['seconds']
+                                    if transfer['seconds'] else 0.0)
+                         for host, transfer in self._transfers.items()}
+            report = {
+                'started_at': self.started_at,
+                'finished_at': time.time(),
+                'phases': phases,
+                'counters': dict(self._counters),
+                'http_status': {endpoint: dict(statuses) for endpoint, statuses in self._http.items()},
+                'transfers': transfers,
+            }
+        report['elapsed'] = report['finished_at'] - self.started_at
+        if stats is not None:
+            report['videos'] = {'total': stats.total, 'success': stats.success,
+                                'fail': stats.fail, 'skipped': stats.skipped}
+        if cache is not None:
+            report['cache'] = {'hits': cache.hits, 'misses': cache.misses}
+        return report
+
+    def write_json(self, path: str, report: Dict):
+        self._write_atomic(path, json.dumps(report, ensure_ascii=False, indent=2))
+
+    def write_prometheus(self, path: str, report: Dict):
+        """按 Prometheus 文本格式写出，先写临时文件再改名，采集时不会读到写了一半的文件"""
+        prefix = 'bilibili_download'
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{self._escape_label(val)}"' for key, val in labels.items())
+                lines.append(f"{prefix}_{name}{{{label_text}}} {value}" if label_text
+                             else f"{prefix}_{name} {value}")
+
+        phases = report['phases'].items()
+        metric('phase_seconds_total', 'counter', 'Time spent in each phase.',
+               [({'phase': name}, phase['seconds']) for name, phase in phases])
+        metric('phase_calls_total', 'counter', 'Number of times each phase ran.',
+               [({'phase': name}, phase['count']) for name, phase in phases])
+        metric('phase_errors_total', 'counter', 'Number of phase runs that raised.',
+               [({'phase': name}, phase['errors']) for name, phase in phases])
+        metric('http_responses_total', 'counter', 'API responses by endpoint and status.',
+               [({'endpoint': endpoint, 'status': status}, count)
+                for endpoint, statuses in report['http_status'].items() for status, count in statuses.items()])
+        metric('events_total', 'counter', 'Retries, throttling and other events.',
+               [({'event': name}, value) for name, value in report['counters'].items()])
+        metric('transfer_bytes_total', 'counter', 'Bytes downloaded per CDN host.',
+               [({'host': host}, transfer['bytes']) for host, transfer in report['transfers'].items()])
+        metric('transfer_seconds_total', 'counter', 'Transfer time per CDN host.',
+               [({'host': host}, transfer['seconds']) for host, transfer in report['transfers'].items()])
+        if 'videos' in report:
+            metric('videos', 'gauge', 'Videos in the last run by result.',
+                   [({'result': result}, count) for result, count in report['videos'].items()])
+        metric('run_seconds', 'gauge', 'Duration of the last run.', [({}, report['elapsed'])])
+        metric('last_run_timestamp_seconds', 'gauge', 'When the last run finished.', [({}, report['finished_at'])])
+        self._write_atomic(path, '\n'.join(lines) + '\n')
+
+    @staticmethod
+    def _escape_label(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @staticmethod
+    def _write_atomic(path: str, content: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+
+
+def timed(phase: str):
+    """方法装饰器：每次调用的耗时计入 self.metrics 的 phase 阶段，普通方法和协程都适用"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(self, *args, **kwargs):
+                with self.metrics.phase(phase):
+                    return await func(self, *args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.phase(phase):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class RunProfiler:
+    """--profile 模式的性能分析：采样各线程的调用栈，用 tracemalloc 统计内存，按 bvid 和阶段标记区间
+
+    cProfile 只能分析启用它的线程，而下载分布在线程池和事件循环中，所以这里用一个采样线程
+    定时读取所有线程的调用栈。调用栈前面加上所在区间的标签（bvid;阶段），输出 collapsed stack
+    格式（每行 "帧;帧;... 次数"），可直接交给 flamegraph.pl、inferno 或 speedscope 生成火焰图：
+      cpu.folded    采样到的调用栈（等待网络、等待ffmpeg和Python自身开销都会出现在栈顶）
+      spans.txt     各区间（bvid;阶段）的调用次数和墙钟时间
+      memory.txt    各阶段的内存增量和分配最多的代码行
+    """
+
+    def __init__(self, output_dir: str, interval: float = 0.005, top: int = 30):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.top = top
+        self._labels = contextvars.ContextVar('profile_labels', default=())
+        self._active: Dict[object, tuple] = {}  # 线程ident或asyncio任务 -> 当前区间标签
+        self._loops: Dict[int, asyncio.AbstractEventLoop] = {}  # 运行事件循环的线程 -> 事件循环
+        self._samples: Dict[str, int] = {}
+        self._spans: Dict[str, Dict] = {}
+        self._memory: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._started = 0.0
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._started = time.perf_counter()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample_loop, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> str:
+        """停止采样并写出分析结果，返回输出目录"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        elapsed = time.perf_counter() - self._started
+        snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        _, peak = tracemalloc.get_traced_memory() if snapshot else (0, 0)
+        tracemalloc.stop()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        with self._lock:
+            samples = sorted(self._samples.items())
+            spans = sorted(self._spans.items())
+            memory = sorted(self._memory.items(), key=lambda item: -item[1]['bytes'])
+        with open(os.path.join(self.output_dir, 'cpu.folded'), 'w', encoding='utf-8') as f:
+            for stack, count in samples:
+                f.write(f"{stack} {count}\n")
+        with open(os.path.join(self.output_dir, 'spans.txt'), 'w', encoding='utf-8') as f:
+            for name, span in spans:
+                f.write(f"{name}\t{span['count']}\t{span['seconds']:.3f}\t{span['max_seconds']:.3f}\n")
+
+        lines = [f"运行时间: {elapsed:.1f} 秒，内存峰值: {peak / 1024 / 1024:.1f} MB", "",
+                 "各阶段内存增量（多个线程同时运行时会互相计入）:"]
+        for phase, usage in memory:
+            lines.append(f"  {phase}: {usage['count']} 次，合计 {usage['bytes'] / 1024:.1f} KB，"
+                         f"单次最大 {usage['max_bytes'] / 1024:.1f} KB")
+        if snapshot:
+            lines += ["", f"结束时分配最多的 {self.top} 处代码:"]
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                lines.append(f"  {stat}")
+        with open(os.path.join(self.output_dir, 'memory.txt'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        # 按采样次数列出自身耗时最多的函数（栈顶帧）
+        leaves: Dict[str, int] = {}
+        for stack, count in samples:
+            leaf = stack.rsplit(';', 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + count
+        total = sum(leaves.values())
+        if total:
+            print(f"性能分析: 共 {total} 个样本，栈顶最多的函数:")
+            for leaf, count in sorted(leaves.items(), key=lambda item: -item[1])[:10]:
+                print(f"  {count * 100 / total:5.1f}%  {leaf}")
+        return self.output_dir
+
+    def _key(self):
+        """当前区间的归属：事件循环中是当前任务，否则是当前线程"""
+        ident = threading.get_ident()
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is None:
+            return ident
+        self._loops[ident] = task.get_loop()
+        return task
+
+    @contextmanager
+    def span(self, phase: Optional[str], bvid: Optional[str] = None):
+        """with 块内采样到的调用栈标记为 bvid;phase，同时记录墙钟时间和内存增量
+
+        未给出 bvid 时沿用外层区间的标签（子线程通过 inherit、asyncio 子任务通过上下文变量继承）。
+        """
+        labels = self._labels.get()
+        new_labels = labels
+        if bvid and bvid not in labels:
+            new_labels += (bvid,)
+        if phase:
+            new_labels += (phase,)
+        key = self._key()
+        token = self._labels.set(new_labels)
+        self._active[key] = new_labels
+        start = time.perf_counter()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            allocated = tracemalloc.get_traced_memory()[0] - memory_before
+            self._labels.reset(token)
+            if labels:
+                self._active[key] = labels
+            else:
+                self._active.pop(key, None)
+            with self._lock:
+                name = ';'.join(new_labels)
+                span = self._spans.setdefault(name, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+                span['count'] += 1
+                span['seconds'] += elapsed
+                span['max_seconds'] = max(span['max_seconds'], elapsed)
+                if phase:
+                    usage = self._memory.setdefault(phase, {'count': 0, 'bytes': 0, 'max_bytes': 0})
+                    usage['count'] += 1
+                    usage['bytes'] += allocated
+                    usage['max_bytes'] = max(usage['max_bytes'], allocated)
+
+    def inherit(self, func):
+        """包装要交给线程池执行的函数，使其继承调用方当前的区间标签"""
+        labels = self._labels.get()
+
+        def run(*args, **kwargs):
+            ident = threading.get_ident()
+            token = self._labels.set(labels)
+            self._active[ident] = labels
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._labels.reset(token)
+                self._active.pop(ident, None)
+        return run
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            rows = []
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                key = ident
+                loop = self._loops.get(ident)
+                if loop is not None:
+                    task = asyncio.current_task(loop)
+                    if task is not None:
+                        key = task
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.reverse()
+                rows.append(';'.join(list(self._active.get(key, ())) + stack))
+            del frames
+            with self._lock:
+                for row in rows:
+                    self._samples[row] = self._samples.get(row, 0) + 1
+
+
+def profiled(phase: Optional[str], bvid_arg: bool = False, job_arg: bool = False):
+    """方法装饰器：设置了 self.profiler 时把每次调用记为一个性能分析区间，普通方法和协程都适用
+
+    bvid_arg 表示第一个参数是 bvid，job_arg 表示第一个参数是下载任务；都不是时沿用外层区间的 bvid。
+    """
+    def label(args):
+        if job_arg:
+            return args[0]['video']['bvid']
+        return args[0] if bvid_arg else None
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(self, *args, **kwargs):
+                if self.profiler is None:
+                    return await func(self, *args, **kwargs)
+                with self.profiler.span(phase, label(args)):
+                    return await func(self, *args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if self.profiler is None:
+                return func(self, *args, **kwargs)
+            with self.profiler.span(phase, label(args)):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class ProgressReporter:
+    """下载进度事件源：传输代码报告每个任务已完成的字节数，监听者收到进度事件
+
+    事件是字典：task（任务名，即文件路径）、done/total（字节，total 未知时为0）、
+    rate（字节/秒）、eta（剩余秒数，未知时为None）、status（'running'/'done'/'failed'）。
+    本身只做计数、不输出任何内容，显示交给监听者（如 ConsoleProgressRenderer）。
+    """
+
+    RATE_WINDOW = 0.5  # 计算速度的最小采样间隔（秒）
+
+    def __init__(self):
+        self._tasks: Dict[str, Dict] = {}
+        self._listeners: List = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener):
+        """listener(event) 可能在多个下载线程中被调用，需要自行保证线程安全"""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def update(self, task: str, done: int, total: int = 0):
+        """报告任务当前已完成的字节数（累计值）"""
+        now = time.monotonic()
+        with self._lock:
+            info = self._tasks.get(task)
+            if info is None:
+                info = self._tasks[task] = {'sample_time': now, 'sample_done': done, 'rate': 0.0}
+            info['done'], info['total'] = done, total
+            elapsed = now - info['sample_time']
+            if elapsed >= self.RATE_WINDOW:
+                current = max(0, done - info['sample_done']) / elapsed
+                # 指数平滑，避免速度和剩余时间来回跳动
+                info['rate'] = current if not info['rate'] else 0.7 * info['rate'] + 0.3 * current
+                info['sample_time'], info['sample_done'] = now, done
+            elif not info['rate'] and elapsed > 0:
+                # 第一个采样间隔内先用平均速度
+                info['rate'] = max(0, done - info['sample_done']) / elapsed
+                info['sample_time'], info['sample_done'] = now, done
+            event = self._event(task, info, 'running')
+        self._emit(event)
+
+    def finish(self, task: str, success: bool = True):
+        with self._lock:
+            info = self._tasks.pop(task, None)
+        if info is not None:
+            self._emit(self._event(task, info, 'done' if success else 'failed'))
+
+    @staticmethod
+    def _event(task: str, info: Dict, status: str) -> Dict:
+        total, done, rate = info['total'], info['done'], info['rate']
+        eta = (total - done) / rate if total and rate > 0 else None
+        return {'task': task, 'done': done, 'total': total, 'rate': rate, 'eta': eta, 'status': status}
+
+    def _emit(self, event: Dict):
+        for listener in list(self._listeners):
+            listener(event)
+
+
+class ConsoleProgressRenderer:
+    """把所有进行中任务的进度汇总成一行输出，最多每 interval 秒重绘一次
+
+    同时下载多个文件时不再各自输出互相覆盖的进度行，也不会因每个数据块都输出一次而占用CPU。
+    """
+
+    def __init__(self, interval: float = 0.25):
+        self.interval = interval
+        self._tasks: Dict[str, Dict] = {}
+        self._last_draw = 0.0
+        self._width = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, event: Dict):
+        with self._lock:
+            if event['status'] == 'running':
+                self._tasks[event['task']] = event
+            else:
+                self._tasks.pop(event['task'], None)
+            now = time.monotonic()
+            if not self._tasks or now - self._last_draw < self.interval:
+                return
+            self._last_draw = now
+            self._draw()
+
+    def _draw(self):
+        tasks = list(self._tasks.values())
+        done = sum(e['done'] for e in tasks)
+        total = sum(e['total'] for e in tasks)
+        rate = sum(e['rate'] for e in tasks)
+        known = all(e['total'] for e in tasks)
+        format_size = BilibiliUserDownloader._format_size
+        parts = [f"下载中 {len(tasks)} 个文件"]
+        if known:
+            parts.append(f"{done / total * 100:.1f}% ({format_size(done)}/{format_size(total)})")
+        else:
+            parts.append(format_size(done))
+        parts.append(f"{format_size(rate)}/s")
+        if known and rate > 0:
+            parts.append(f"剩余 {BilibiliUserDownloader._format_duration((total - done) / rate)}")
+        line = " | ".join(parts)
+        print("\r" + line.ljust(self._width), end='', flush=True)
+        self._width = len(line)
+
+
+class RestartDownloadError(Exception):
+    """已下载的部分无法续传（服务器忽略Range或文件已变化），需要从头下载"""
+
+
+class BudgetExceededError(Exception):
+    """视频的预计大小超出本次运行剩余的流量预算"""
+
+
+class StreamPolicy:
+    """DASH流选择策略：限制最高分辨率和码率，并按编码偏好在同一画质的多种编码中选择
+
+    codec_order 为编码偏好顺序（'avc'/'hevc'/'av1'），为空时同一画质选带宽最高的流；
+    max_video_bitrate/max_audio_bitrate 与 playurl 中的 bandwidth 一样以 bit/s 计，0 表示不限制。
+    所有流都超出限制时退而选择最低的一档，而不是放弃下载。
+    """
+
+    CODEC_IDS = {7: 'avc', 12: 'hevc', 13: 'av1'}
+    CODEC_PREFIXES = (('avc', 'avc'), ('hev', 'hevc'), ('hvc', 'hevc'), ('av01', 'av1'))
+
+    def __init__(self, max_height: int = 0, codec_order: Optional[List[str]] = None,
+                 max_video_bitrate: int = 0, max_audio_bitrate: int = 0):
+        self.max_height = max_height
+        self.codec_order = list(codec_order or [])
+        self.max_video_bitrate = max_video_bitrate
+        self.max_audio_bitrate = max_audio_bitrate
+
+    @classmethod
+    def codec_name(cls, stream: Dict) -> str:
+        name = cls.CODEC_IDS.get(stream.get('codecid'))
+        if name:
+            return name
+        codecs = str(stream.get('codecs', '')).lower()
+        for prefix, name in cls.CODEC_PREFIXES:
+            if codecs.startswith(prefix):
+                return name
+        return codecs
+
+    @staticmethod
+    def _within(streams: List[Dict], key: str, limit: int) -> List[Dict]:
+        """保留 key 不超过 limit 的流，全部超出时只保留 key 最小的流"""
+        if not limit:
+            return streams
+        allowed = [s for s in streams if s.get(key, 0) <= limit]
+        if allowed:
+            return allowed
+        lowest = min(s.get(key, 0) for s in streams)
+        return [s for s in streams if s.get(key, 0) == lowest]
+
+    def select_video(self, streams: List[Dict]) -> Optional[Dict]:
+        """在限制范围内选择画质最高的视频流，同一画质按编码偏好和带宽排序"""
+        if not streams:
+            return None
+        candidates = self._within(streams, 'height', self.max_height)
+        candidates = self._within(candidates, 'bandwidth', self.max_video_bitrate)
+
+        def codec_rank(stream):
+            name = self.codec_name(stream)
+            if name in self.codec_order:
+                return len(self.codec_order) - self.codec_order.index(name)
+            return 0
+
+        return max(
+            candidates,
+            key=lambda s: (
+                s.get('id', 0),
+                s.get('height', 0),
+                codec_rank(s),
+                s.get('bandwidth', 0)
+            )
+        )
+
+    def select_audio(self, dash_data: Dict, lossless: bool = True) -> Optional[Dict]:
+        """选择音频流：Hi-Res无损(FLAC) > 杜比全景声 > 普通音频，每一档中选不超过码率限制的最高码率
+
+        lossless 为 False 时只在普通音频中选择（封装进 mp4 的视频使用）。
+        """
+        normal = dash_data.get('audio') or []
+        tiers = [normal]
+        if lossless:
+            flac_audio = (dash_data.get('flac') or {}).get('audio')
+            tiers = [[flac_audio] if flac_audio else [], (dash_data.get('dolby') or {}).get('audio') or [], normal]
+        for tier in tiers:
+            allowed = [s for s in tier
+                       if not self.max_audio_bitrate or s.get('bandwidth', 0) <= self.max_audio_bitrate]
+            if allowed:
+                return max(allowed, key=lambda s: (s.get('bandwidth', 0), s.get('id', 0)))
+        candidates = normal or [s for tier in tiers for s in tier]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda s: s.get('bandwidth', 0))
+
+    @staticmethod
+    def estimate_size(stream: Optional[Dict], duration: float) -> int:
+        """按 bandwidth(bit/s) × 时长 估算流的字节数"""
+        if not stream:
+            return 0
+        return int(stream.get('bandwidth', 0) * duration / 8)
+
+
+class SlowMirrorError(Exception):
+    """当前CDN镜像的传输速度低于阈值，应切换到其他镜像"""
+
+
+class MirrorSet:
+    """同一文件的多个CDN地址（baseUrl + backupUrl），当前地址出错或过慢时轮换到下一个"""
+
+    def __init__(self, urls: List[str]):
+        self.urls = list(urls)
+        self._index = 0
+        self._no_range = set()  # 忽略Range、返回完整文件（200）的镜像
+        self._lock = threading.Lock()
+
+    def current(self) -> str:
+        with self._lock:
+            return self.urls[self._index]
+
+    def switch(self, bad_url: str) -> bool:
+        """放弃 bad_url 换用下一个镜像，没有其他镜像时返回False"""
+        with self._lock:
+            if len(self.urls) <= 1:
+                return False
+            # 其他分段已经切换过时不再重复切换
+            if self.urls[self._index] == bad_url:
+                self._index = (self._index + 1) % len(self.urls)
+                host = urllib.parse.urlparse(self.urls[self._index]).netloc
+                print(f"\n切换到镜像: {host}")
+            return True
+
+    def mark_no_range(self, url: str) -> bool:
+        """记录忽略Range的镜像，所有镜像都忽略时返回True"""
+        with self._lock:
+            self._no_range.add(url)
+            return self._no_range.issuperset(self.urls)
+
+
+class ThroughputMonitor:
+    """按时间窗口统计传输速度，低于 min_speed（字节/秒）时抛出 SlowMirrorError；min_speed 为0时不检查"""
+
+    def __init__(self, min_speed: float, interval: float):
+        self.min_speed = min_speed
+        self.interval = interval
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+
+    def update(self, size: int):
+        if not self.min_speed:
+            return
+        self._window_bytes += size
+        elapsed = time.monotonic() - self._window_start
+        if elapsed >= self.interval:
+            speed = self._window_bytes / elapsed
+            if speed < self.min_speed:
+                raise SlowMirrorError(f"镜像速度过慢（{speed / 1024:.0f} KB/s）")
+            self._window_start = time.monotonic()
+            self._window_bytes = 0
+
+
+class DownloadState:
+    """断点续传进度，保存在临时文件旁的 .state 文件中"""
+
+    def __init__(self, path: str, url_id: str, total_size: int, accept_ranges: bool = True,
+                 completed: List[List[int]] = None):
+        self.path = path
+        self.url_id = url_id
+        self.total_size = total_size
+        self.accept_ranges = accept_ranges
+        self.completed = completed or []  # 已完成的 [start, end) 区间，按起点排序且互不重叠
+        self._lock = threading.Lock()
+        self._last_save = 0.0
+
+    @staticmethod
+    def url_identity(url: str) -> str:
+        """CDN链接的查询参数包含过期时间和签名，只用路径标识同一个文件"""
+        return urllib.parse.urlparse(url).path
+
+    @classmethod
+    def load(cls, path: str, url: str) -> Optional['DownloadState']:
+        """读取状态文件，不存在、损坏或不属于该链接时返回None"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data['url_id'] != cls.url_identity(url):
+                return None
+            return cls(path, data['url_id'], int(data['total_size']),
+                       accept_ranges=bool(data.get('accept_ranges', True)),
+                       completed=[[int(s), int(e)] for s, e in data.get('completed', [])])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def add(self, start: int, length: int):
+        """记录 [start, start + length) 已写入，并合并相邻区间"""
+        with self._lock:
+            merged: List[List[int]] = []
+            for s, e in sorted(self.completed + [[start, start + length]]):
+                if merged and s <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], e)
+                else:
+                    merged.append([s, e])
+            self.completed = merged
+
+    @property
+    def downloaded(self) -> int:
+        with self._lock:
+            return sum(e - s for s, e in self.completed)
+
+    def next_missing(self, start: int, end: int) -> Optional[int]:
+        """返回 [start, end] 中第一个尚未下载的位置，全部完成时返回None"""
+        with self._lock:
+            pos = start
+            for s, e in self.completed:
+                if s <= pos < e:
+                    pos = e
+            return pos if pos <= end else None
+
+    def missing(self) -> List[tuple]:
+        """返回尚未下载的闭区间 (start, end) 列表"""
+        with self._lock:
+            gaps = []
+            pos = 0
+            for s, e in self.completed:
+                if s > pos:
+                    gaps.append((pos, s - 1))
+                pos = max(pos, e)
+            if pos < self.total_size:
+                gaps.append((pos, self.total_size - 1))
+            return gaps
+
+    def save(self, force: bool = False):
+        """写入状态文件，默认每秒最多一次以免频繁写盘"""
+        with self._lock:
+            now = time.time()
+            if not force and now - self._last_save < 1:
+                return
+            self._last_save = now
+            data = {
+                'url_id': self.url_id,
+                'total_size': self.total_size,
+                'accept_ranges': self.accept_ranges,
+                'completed': self.completed
+            }
+            temp_path = self.path + '.part'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.path)
+
+    def remove(self):
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+class AdaptiveTokenBucket:
+    """线程安全的自适应令牌桶：请求正常时逐步提速，被限流时速率减半并指数退避暂停"""
+
+    def __init__(self, rate: float, min_rate: float = 0.05, max_rate: float = 8.0,
+                 increase: float = 1.1, max_backoff: float = 60.0):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.increase = increase
+        self.max_backoff = max_backoff
+        self.tokens = 1.0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._backoff = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """尝试取走一个令牌，成功返回0，否则返回需要等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            # 桶容量为1，空闲后也不会突发多个请求
+            self.tokens = min(1.0, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if now >= self._paused_until and self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return max(self._paused_until - now, (1 - self.tokens) / self.rate)
+
+    def acquire(self):
+        """取走一个令牌，没有令牌或处于退避期间时阻塞等待"""
+        wait = self._reserve()
+        while wait:
+            time.sleep(wait)
+            wait = self._reserve()
+
+    async def acquire_async(self):
+        wait = self._reserve()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self._reserve()
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate * self.increase)
+            self._backoff = 0.0
+
+    def on_throttle(self) -> float:
+        """被限流：速率减半，并暂停一段逐次翻倍的时间，返回暂停秒数"""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._backoff = min(self.max_backoff, self._backoff * 2 if self._backoff else 2.0)
+            self._paused_until = time.monotonic() + self._backoff
+            self.tokens = 0.0
+            return self._backoff
+
+
+class RateLimiter:
+    """按接口划分的令牌桶（nav/medialist/view/playurl/search），由所有工作线程共享"""
+
+    THROTTLE_STATUS = (412, 429)
+    THROTTLE_CODES = (-412, -799)  # 请求被拦截 / 请求过于频繁
+
+    def __init__(self, rate: float, min_rate: float = 0.05, max_rate: float = 8.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self._buckets: Dict[str, AdaptiveTokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, endpoint: str) -> AdaptiveTokenBucket:
+        with self._lock:
+            if endpoint not in self._buckets:
+                self._buckets[endpoint] = AdaptiveTokenBucket(self.rate, self.min_rate, self.max_rate)
+            return self._buckets[endpoint]
+
+    @classmethod
+    def is_throttled(cls, status_code: int, data: Optional[Dict]) -> bool:
+        if status_code in cls.THROTTLE_STATUS:
+            return True
+        return isinstance(data, dict) and data.get('code') in cls.THROTTLE_CODES
+
+
+class MetadataCache:
+    """接口响应的本地SQLite缓存，按 (接口, 键) 存储，每个接口有独立的过期时间，超出容量时淘汰最久未用的条目"""
+
+    DEFAULT_TTL = {
+        'view': 7 * 24 * 3600,          # 视频分P信息（bvid）
+        'medialist_info': 24 * 3600,    # 用户信息（mid）
+        'medialist_first': 10 * 60,     # 列表第一页，新投稿会改变内容
+        'medialist_page': 6 * 3600,     # 按游标获取的后续页面
+        'playurl': 30 * 60,             # 下载链接带签名，约两小时后失效
+        'wbi': 12 * 3600,               # WBI密钥，签名被拒时会提前刷新
+    }
+
+    def __init__(self, path: str, ttl: Dict[str, float] = None, max_entries: int = 20000):
+        self.path = path
+        self.ttl = dict(self.DEFAULT_TTL)
+        self.ttl.update(ttl or {})
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'endpoint TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+            'created REAL NOT NULL, accessed REAL NOT NULL, PRIMARY KEY (endpoint, key))'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+        self._conn.commit()
+
+    def get(self, endpoint: str, key: str):
+        """读取未过期的缓存值，不存在或已过期时返回None"""
+        now = time.time()
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    'SELECT value, created FROM cache WHERE endpoint = ? AND key = ?', (endpoint, key)
+                ).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                if now - row[1] > self.ttl.get(endpoint, 0):
+                    self._conn.execute('DELETE FROM cache WHERE endpoint = ? AND key = ?', (endpoint, key))
+                    self._conn.commit()
+                    self.misses += 1
+                    return None
+                self._conn.execute('UPDATE cache SET accessed = ? WHERE endpoint = ? AND key = ?',
+                                   (now, endpoint, key))
+                self._conn.commit()
+                self.hits += 1
+            return json.loads(row[0])
+        except (sqlite3.Error, ValueError) as e:
+            print(f"读取缓存失败 {endpoint}/{key}: {e}")
+            return None
+
+    def set(self, endpoint: str, key: str, value):
+        """写入缓存值（需可JSON序列化），每写入一定次数检查一次容量"""
+        now = time.time()
+        try:
+            with self._lock:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO cache (endpoint, key, value, created, accessed) VALUES (?, ?, ?, ?, ?)',
+                    (endpoint, key, json.dumps(value, ensure_ascii=False), now, now)
+                )
+                self._writes += 1
+                if self._writes % 100 == 1:
+                    self._evict()
+                self._conn.commit()
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            print(f"写入缓存失败 {endpoint}/{key}: {e}")
+
+    def delete(self, endpoint: str, key: str):
+        try:
+            with self._lock:
+                self._conn.execute('DELETE FROM cache WHERE endpoint = ? AND key = ?', (endpoint, key))
+                self._conn.commit()
+        except sqlite3.Error as e:
+            print(f"删除缓存失败 {endpoint}/{key}: {e}")
+
+    def _evict(self):
+        """删除最久未访问的条目，使总数不超过 max_entries（调用方持有锁）"""
+        count = self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                'DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache ORDER BY accessed LIMIT ?)',
+                (count - self.max_entries,)
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class DownloadManifest:
+    """下载清单（JSON Lines），每成功下载一个文件追加一行，用于增量同步时跳过已下载的视频"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[tuple, Dict] = {}  # (bvid, cid) -> 最近一次的记录
+        self.bvids = set()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[(entry['bvid'], str(entry.get('cid')))] = entry
+                    except (ValueError, KeyError, TypeError):
+                        # 进程中断时最后一行可能不完整
+                        continue
+        except FileNotFoundError:
+            pass
+        self.bvids = {bvid for bvid, _ in self.entries}
+
+    def contains(self, bvid: str, cid: Optional[str] = None) -> bool:
+        """视频是否已下载；给出 cid 时判断的是该分P"""
+        with self._lock:
+            if cid is None:
+                return bvid in self.bvids
+            return (bvid, str(cid)) in self.entries
+
+    def record(self, entry: Dict):
+        """追加一条记录并立即写盘"""
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.entries[(entry['bvid'], str(entry.get('cid')))] = entry
+            self.bvids.add(entry['bvid'])
+
+    @staticmethod
+    def file_checksum(path: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(block)
+        return sha256.hexdigest()
+
+
+class MedialistCursor:
+    """Medialist 翻页状态：去重、数量限制和增量同步的停止条件，同步和异步两种实现共用"""
+
+    def __init__(self, downloader: 'BilibiliUserDownloader', user_id: str, max_count: int = None,
+                 page_size: int = 20):
+        self.downloader = downloader
+        self.max_count = max_count
+        self.page_size = page_size
+        self.fetched = 0
+        self.page = 1
+        self.oid = ''
+        self.done = False
+        self.seen = set()
+        self.user_id = str(user_id)
+        # 增量同步停在上次完整同步时记录的最新投稿处，而不是第一个出现在下载清单中的视频；
+        # 没有开启 all_parts 时记录的位置之前的视频可能缺分P，all_parts 模式下不使用，重新检查一遍完整列表
+        self.mark = downloader.get_sync_mark(self.user_id) if downloader.sync else None
+        if self.mark and downloader.all_parts and not self.mark.get('all_parts'):
+            print(f"用户 {user_id} 上次同步时没有下载全部分P，将检查完整列表")
+            self.mark = None
+        self.newest: Optional[Dict] = None
+        self.listed: List[Dict] = []
+        self.complete = False  # 列表完整获取到末尾或同步位置（没有被 max_count 截断，也没有请求失败）
+        
+        print(f"开始获取用户 {user_id} 的视频（使用Medialist方法）...")
+        if max_count:
+            print(f"目标获取数量: {max_count} 个视频")
+        print(f"正在获取第 {self.page} 页...")
+
+    def accept(self, videos: List[Dict], has_more: Optional[bool]) -> List[Dict]:
+        """处理一页结果，返回应当产出的视频，并更新下一页游标或结束状态；has_more 为 None 表示请求失败"""
+        if has_more is None:
+            self.done = True
+            return []
+        # 游标异常时接口可能返回重复内容，去重后为空即停止
+        videos = [v for v in videos if v['bvid'] not in self.seen]
+        if not videos:
+            self.done = True
+            self.complete = not has_more
+            return []
+        self.seen.update(v['bvid'] for v in videos)
+        if self.newest is None:
+            self.newest = videos[0]
+        
+        # 增量同步：列表按发布时间倒序，到达上次同步的最新投稿（或更早发布的视频）说明之后都已下载；
+        # 之前的视频是否已下载由 _is_downloaded 逐个过滤（all_parts 模式下逐个分P）
+        reached_known = False
+        if self.downloader.sync:
+            for pos, video in enumerate(videos):
+                if not self._reached_mark(video):
+                    continue
+                print(f"已到达上次同步的位置（{video['bvid']}），停止获取后续页面")
+                videos = videos[:pos]
+                reached_known = True
+                break
+        
+        if self.max_count and self.fetched + len(videos) >= self.max_count:
+            cut = len(videos) > self.max_count - self.fetched
+            videos = videos[:self.max_count - self.fetched]
+            self.fetched += len(videos)
+            self.listed.extend(videos)
+            print(f"第 {self.page} 页获取到 {len(videos)} 个视频（已达到目标数量 {self.max_count}）")
+            self.done = True
+            self.complete = not cut and (reached_known or not has_more)
+            return videos
+        
+        self.fetched += len(videos)
+        self.listed.extend(videos)
+        print(f"第 {self.page} 页获取到 {len(videos)} 个视频，累计 {self.fetched} 个")
+        if reached_known or not has_more:
+            self.done = True
+            self.complete = True
+        else:
+            self.oid = str(videos[-1]['aid'])
+            self.page += 1
+            print(f"正在获取第 {self.page} 页...")
+        return videos
+
+    def _reached_mark(self, video: Dict) -> bool:
+        if not self.mark:
+            return False
+        # 记录的视频被删除时按发布时间判断
+        return video['bvid'] == self.mark['bvid'] or (video.get('created') or 0) < self.mark['created']
+
+    def finish(self):
+        print(f"共获取到 {self.fetched} 个视频")
+        # 列出的视频都下载完成后才推进同步位置（见 download_videos 结束时的 _save_sync_marks）
+        if self.downloader.sync and self.complete and self.newest:
+            self.downloader._complete_listings.append((self.user_id, self.newest, self.listed))
+
+
+class RemuxError(Exception):
+    """输入不是可以直接按box拼接的分片MP4（fMP4）"""
+
+
+class FragmentedMP4Muxer:
+    """纯Python的分片MP4合并器：把B站DASH的视频流和音频流（各含一条轨道的fMP4）合并为一个MP4
+
+    只复制box，不解码：moov 中合并两条 trak 和 trex，音频轨道改为 track_ID 2；
+    随后按解码时间交错写出两条流的 moof+mdat 分片，mdat 按块流式复制，内存占用与文件大小无关。
+    sidx 等索引box不再复制（其中的偏移只对原文件有效）。
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, video_file: str, audio_file: str):
+        self.video_file = video_file
+        self.audio_file = audio_file
+
+    @staticmethod
+    def _read_header(f) -> Optional[tuple]:
+        """读取文件中的box头，返回 (类型, box总长度, 头长度)，文件结束返回None"""
+        start = f.tell()
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = os.fstat(f.fileno()).st_size - start
+        if size < header_size:
+            raise RemuxError(f"box长度错误: {box_type!r}")
+        return box_type, size, header_size
+
+    @staticmethod
+    def _children(data, start: int, end: int) -> Iterator[tuple]:
+        """遍历 data[start:end] 中的子box，依次返回 (类型, 内容起点, box终点)"""
+        pos = start
+        while pos + 8 <= end:
+            size, box_type = struct.unpack_from('>I4s', data, pos)
+            header_size = 8
+            if size == 1:
+                size = struct.unpack_from('>Q', data, pos + 8)[0]
+                header_size = 16
+            elif size == 0:
+                size = end - pos
+            if size < header_size or pos + size > end:
+                raise RemuxError(f"box长度错误: {box_type!r}")
+            yield box_type, pos + header_size, pos + size
+            pos += size
+
+    def _find(self, data, start: int, end: int, path: tuple) -> Optional[tuple]:
+        """按路径查找子box，返回 (内容起点, box终点)"""
+        for box_type, child_start, child_end in self._children(data, start, end):
+            if box_type == path[0]:
+                if len(path) == 1:
+                    return child_start, child_end
+                return self._find(data, child_start, child_end, path[1:])
+        return None
+
+    @staticmethod
+    def _box(box_type: bytes, payload: bytes) -> bytes:
+        if len(payload) + 8 > 0xFFFFFFFF:
+            return struct.pack('>I4sQ', 1, box_type, len(payload) + 16) + payload
+        return struct.pack('>I4s', len(payload) + 8, box_type) + payload
+
+    @staticmethod
+    def _timescale(data, start: int) -> int:
+        """mvhd/mdhd 中的 timescale（两者布局相同）"""
+        offset = 20 if data[start] == 1 else 12
+        return struct.unpack_from('>I', data, start + offset)[0]
+
+    @staticmethod
+    def _rescale(value: int, src: int, dst: int, limit: int) -> int:
+        if src == dst or not src:
+            return value
+        return min(value * dst // src, limit)
+
+    def _open(self, path: str, track_id: int) -> Dict:
+        """读取到第一个 moof 为止的初始化段，返回轨道信息"""
+        f = open(path, 'rb')
+        track = {'file': f, 'track_id': track_id, 'ftyp': None, 'moov': None, 'time': 0}
+        try:
+            while True:
+                pos = f.tell()
+                header = self._read_header(f)
+                if header is None:
+                    raise RemuxError(f"{path} 中没有分片（moof）")
+                box_type, size, header_size = header
+                if box_type == b'moof':
+                    f.seek(pos)
+                    break
+                if box_type in (b'ftyp', b'moov'):
+                    track[box_type.decode()] = bytearray(f.read(size - header_size))
+                else:
+                    f.seek(pos + size)
+            moov = track['moov']
+            if moov is None:
+                raise RemuxError(f"{path} 中没有moov")
+            traks = [(s, e) for t, s, e in self._children(moov, 0, len(moov)) if t == b'trak']
+            if len(traks) != 1 or self._find(moov, 0, len(moov), (b'mvex', b'trex')) is None:
+                raise RemuxError(f"{path} 不是单轨道的分片MP4")
+            mdhd = self._find(moov, traks[0][0], traks[0][1], (b'mdia', b'mdhd'))
+            mvhd = self._find(moov, 0, len(moov), (b'mvhd',))
+            if mdhd is None or mvhd is None:
+                raise RemuxError(f"{path} 缺少mvhd/mdhd")
+            track['trak'] = traks[0]
+            track['media_timescale'] = self._timescale(moov, mdhd[0]) or 1
+            track['movie_timescale'] = self._timescale(moov, mvhd[0])
+            return track
+        except Exception:
+            f.close()
+            raise
+
+    def _retrack(self, moov: bytearray, trak: tuple, track_id: int, src_scale: int, dst_scale: int):
+        """原地修改 trak 的 track_ID，并把 tkhd/elst 中的时长换算到新的 movie timescale"""
+        tkhd = self._find(moov, trak[0], trak[1], (b'tkhd',))
+        if tkhd is None:
+            raise RemuxError("trak 中没有tkhd")
+        start = tkhd[0]
+        if moov[start] == 1:
+            struct.pack_into('>I', moov, start + 20, track_id)
+            duration = struct.unpack_from('>Q', moov, start + 28)[0]
+            struct.pack_into('>Q', moov, start + 28, self._rescale(duration, src_scale, dst_scale, 2 ** 64 - 1))
+        else:
+            struct.pack_into('>I', moov, start + 12, track_id)
+            duration = struct.unpack_from('>I', moov, start + 20)[0]
+            struct.pack_into('>I', moov, start + 20, self._rescale(duration, src_scale, dst_scale, 0xFFFFFFFF))
+
+        elst = self._find(moov, trak[0], trak[1], (b'edts', b'elst'))
+        if elst is not None:
+            start = elst[0]
+            wide = moov[start] == 1
+            count = struct.unpack_from('>I', moov, start + 4)[0]
+            for i in range(count):
+                pos = start + 8 + i * (20 if wide else 12)
+                fmt, limit = ('>Q', 2 ** 64 - 1) if wide else ('>I', 0xFFFFFFFF)
+                value = struct.unpack_from(fmt, moov, pos)[0]
+                struct.pack_into(fmt, moov, pos, self._rescale(value, src_scale, dst_scale, limit))
+
+    def _build_moov(self, video: Dict, audio: Dict) -> bytes:
+        """以视频流的moov为基础，加入音频轨道的 trak 和 trex"""
+        video_moov, audio_moov = video['moov'], audio['moov']
+        self._retrack(audio_moov, audio['trak'], audio['track_id'],
+                      audio['movie_timescale'], video['movie_timescale'])
+        audio_trak = self._box(b'trak', bytes(audio_moov[audio['trak'][0]:audio['trak'][1]]))
+        audio_trex = None
+        mvex = self._find(audio_moov, 0, len(audio_moov), (b'mvex',))
+        for box_type, start, end in self._children(audio_moov, mvex[0], mvex[1]):
+            if box_type == b'trex':
+                trex = bytearray(audio_moov[start:end])
+                struct.pack_into('>I', trex, 4, audio['track_id'])
+                audio_trex = self._box(b'trex', bytes(trex))
+
+        parts = []
+        for box_type, start, end in self._children(video_moov, 0, len(video_moov)):
+            payload = bytearray(video_moov[start:end])
+            if box_type == b'mvhd':
+                # next_track_ID 位于 mvhd 末尾
+                struct.pack_into('>I', payload, len(payload) - 4, audio['track_id'] + 1)
+                parts.append(self._box(box_type, bytes(payload)))
+            elif box_type == b'trak':
+                parts.append(self._box(box_type, bytes(payload)))
+                parts.append(audio_trak)
+            elif box_type == b'mvex':
+                parts.append(self._box(box_type, bytes(payload) + audio_trex))
+            else:
+                parts.append(self._box(box_type, bytes(payload)))
+        return self._box(b'moov', b''.join(parts))
+
+    def _next_fragment(self, track: Dict) -> Optional[Dict]:
+        """读取下一个 moof 及其后 mdat 的位置，文件结束返回None"""
+        f = track['file']
+        while True:
+            pos = f.tell()
+            header = self._read_header(f)
+            if header is None:
+                return None
+            box_type, size, header_size = header
+            if box_type != b'moof':
+                f.seek(pos + size)
+                continue
+            f.seek(pos)
+            moof = bytearray(f.read(size))
+            mdat_pos = f.tell()
+            mdat = self._read_header(f)
+            if mdat is None or mdat[0] != b'mdat':
+                raise RemuxError("moof 之后不是 mdat")
+            f.seek(mdat_pos + mdat[1])
+            tfdt = self._find(moof, header_size, size, (b'traf', b'tfdt'))
+            if tfdt is not None:
+                fmt = '>Q' if moof[tfdt[0]] == 1 else '>I'
+                track['time'] = struct.unpack_from(fmt, moof, tfdt[0] + 4)[0]
+            return {'moof': moof, 'pos': pos, 'header_size': header_size,
+                    'mdat_pos': mdat_pos, 'mdat_size': mdat[1],
+                    'time': track['time'] / track['media_timescale']}
+
+    def _patch_moof(self, fragment: Dict, track_id: int, sequence: int, delta: int):
+        """原地修改分片序号和 track_ID；tfhd 带绝对 base_data_offset 时按新位置平移"""
+        moof = fragment['moof']
+        for box_type, start, end in self._children(moof, fragment['header_size'], len(moof)):
+            if box_type == b'mfhd':
+                struct.pack_into('>I', moof, start + 4, sequence)
+            elif box_type == b'traf':
+                tfhd = self._find(moof, start, end, (b'tfhd',))
+                if tfhd is None:
+                    raise RemuxError("traf 中没有tfhd")
+                flags = struct.unpack_from('>I', moof, tfhd[0])[0] & 0xFFFFFF
+                struct.pack_into('>I', moof, tfhd[0] + 4, track_id)
+                if flags & 0x000001:
+                    base = struct.unpack_from('>Q', moof, tfhd[0] + 8)[0]
+                    struct.pack_into('>Q', moof, tfhd[0] + 8, base + delta)
+
+    def mux(self, output_file: str):
+        """合并到 output_file，输入格式不支持时抛出 RemuxError"""
+        tracks = []
+        try:
+            tracks.append(self._open(self.video_file, 1))
+            tracks.append(self._open(self.audio_file, 2))
+            video, audio = tracks
+            with open(output_file, 'wb') as out:
+                if video['ftyp'] is not None:
+                    out.write(self._box(b'ftyp', bytes(video['ftyp'])))
+                out.write(self._build_moov(video, audio))
+
+                fragments = [self._next_fragment(track) for track in tracks]
+                sequence = 0
+                while any(fragments):
+                    # 按解码时间交错写出，时间相同时视频在前
+                    i = min((i for i, frag in enumerate(fragments) if frag),
+                            key=lambda i: (fragments[i]['time'], i))
+                    fragment, track = fragments[i], tracks[i]
+                    sequence += 1
+                    self._patch_moof(fragment, track['track_id'], sequence, out.tell() - fragment['pos'])
+                    out.write(fragment['moof'])
+                    f = track['file']
+                    f.seek(fragment['mdat_pos'])
+                    remaining = fragment['mdat_size']
+                    while remaining > 0:
+                        chunk = f.read(min(self.CHUNK_SIZE, remaining))
+                        if not chunk:
+                            raise RemuxError("mdat 不完整")
+                        out.write(chunk)
+                        remaining -= len(chunk)
+                    fragments[i] = self._next_fragment(track)
+        except (struct.error, IndexError) as e:
+            raise RemuxError(f"解析分片MP4失败: {e}")
+        finally:
+            for track in tracks:
+                track['file'].close()
+
 
 class BilibiliUserDownloader:
     def __init__(self, cookie_string: str = None):
         self.session = requests.Session()
+        self.api_base = "https://api.bilibili.com"  # API地址，基准测试时指向本地模拟服务器
         # 严格按照BilibiliDown项目的配置
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/109.0',
@@ -29,6 +1356,10 @@ class BilibiliUserDownloader:
             'Connection': 'keep-alive'
         }
         self.session.headers.update(self.headers)
+        # 并发下载与分段下载会同时占用多个连接，放大连接池避免连接被丢弃
+        adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=64)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         
         # 设置cookies
         if cookie_string:
@@ -40,6 +1371,8 @@ class BilibiliUserDownloader:
         # WBI签名相关
         self.wbi_img = None
         self.mixin_key = None
+        self._wbi_lock = threading.RLock()
+        self._rate_limiter: Optional[RateLimiter] = None
         self.mixin_array = [46, 47, 18, 2, 53, 8, 23, 32, 15, 50, 10, 31, 58, 3, 45, 35, 27, 43, 5, 49, 33, 9, 42,
                            19, 29, 28, 14, 39, 12, 38, 41, 13, 37, 48, 7, 16, 24, 55, 40, 61, 26, 17, 0, 1, 60, 51, 30, 4, 22, 25, 54,
                            21, 56, 59, 6, 63, 57, 62, 11, 36, 20, 34, 44, 52]
@@ -47,8 +1380,179 @@ class BilibiliUserDownloader:
         # 下载配置
         self.download_dir = "./downloads"
         self.max_retries = 3
-        self.delay_between_requests = 3  # 增加请求间隔避免限流
-        self.api_delay = 2  # API请求前的额外延迟
+        # API限速：每个接口从 api_rate 次/秒开始，请求正常时逐步提速到 api_max_rate，被限流时减速退避
+        self.api_rate = 0.5
+        self.api_min_rate = 0.05
+        self.api_max_rate = 8.0
+        self.download_jobs = 1  # 同时下载的视频数量（1为顺序下载）
+        self.download_segments = 4  # 单个文件的分段连接数（1为单连接下载）
+        self.min_segment_size = 4 * 1024 * 1024  # 每个分段的最小字节数，文件过小时减少分段
+        self.mirror_probe_size = 256 * 1024  # 有多个CDN镜像时，开始下载前用多大的范围请求测速（0为不测速）
+        self.mirror_probe_timeout = 2  # 测速最多等待的秒数，超时按已收到的数据计算速度
+        self.min_mirror_speed = 64 * 1024  # 传输速度低于该值（字节/秒）时切换镜像，0为不切换
+        self.mirror_check_interval = 5  # 检查传输速度的时间窗口（秒）
+        self.audio_only = False  # 仅下载音频（保存为 .m4a/.flac，不下载视频流）
+        self.quality = 127  # 请求的画质代码 qn（127为最高，服务端会向下兼容）
+        self.all_parts = False  # 下载多P视频的全部分P（默认只下载第一个分P）
+        self.stream_policy = StreamPolicy()  # 最高分辨率、编码偏好和码率上限，默认选择最高画质
+        self.byte_budget = 0  # 本次运行最多下载的字节数（按预计大小计算），0为不限制
+        self._budget_used = 0
+        self._budget_lock = threading.Lock()
+        self.quiet = False  # 不显示下载进度（进度事件仍会发送给 progress 的监听者）
+        self.progress_interval = 0.25  # 进度行最短重绘间隔（秒）
+        self._progress: Optional[ProgressReporter] = None
+
+        # 各阶段计时和计数；运行报告保存在下载目录中（report_name 为空时不写），
+        # prometheus_path 不为空时另外写出 Prometheus textfile
+        self.metrics = RunMetrics()
+        self.report_name = "run_report.json"
+        self.prometheus_path: Optional[str] = None
+        self.profiler: Optional[RunProfiler] = None  # --profile 模式的性能分析器
+        self.resolve_workers = 2  # 流水线中解析cid/下载链接的线程数
+        # 合并音视频的线程数，与网络并发数分开配置（ffmpeg 流复制主要受CPU和磁盘限制）
+        self.merge_workers = max(1, min(4, (os.cpu_count() or 2) // 2))
+        # 'ffmpeg'：有ffmpeg时用ffmpeg合并，否则用内置的fMP4合并器；'builtin'：优先用内置合并器，失败再用ffmpeg
+        self.muxer = 'ffmpeg'
+        # 边下载边合并：DASH响应体经命名管道直接送入ffmpeg，不写临时文件（需要ffmpeg，仅支持有 os.mkfifo 的系统；
+        # 不支持断点续传和分段下载，适合磁盘是瓶颈的环境）
+        self.stream_merge = False
+        self.pipeline_queue_size = 8  # 流水线相邻阶段之间的队列长度（背压）
+        self._print_lock = threading.Lock()
+
+        # 元数据缓存（view/playurl/medialist 响应），cache_path 为空时不使用缓存
+        self.cache_path = "./.cache/metadata.db"
+        self.cache_ttl: Dict[str, float] = {}  # 按接口覆盖 MetadataCache.DEFAULT_TTL
+        self.cache_max_entries = 20000
+        self._cache: Optional[MetadataCache] = None
+        self._cache_lock = threading.Lock()
+
+        # 下载清单保存在下载目录中；sync 模式跳过清单中已有的视频，并在列表到达上次同步的位置时停止翻页
+        self.manifest_name = "manifest.jsonl"
+        self.sync_state_name = "sync_state.json"  # 每个用户上次完整同步时的最新投稿
+        self.sync = False
+        self._manifest: Optional[DownloadManifest] = None
+        self._complete_listings: List[tuple] = []  # (用户ID, 最新投稿, 列出的视频)，本次运行完整获取的列表
+
+    @property
+    def cache(self) -> Optional[MetadataCache]:
+        """首次使用时打开元数据缓存，打开失败则本次运行不再使用缓存"""
+        with self._cache_lock:
+            if self._cache is None and self.cache_path:
+                try:
+                    self._cache = MetadataCache(self.cache_path, self.cache_ttl, self.cache_max_entries)
+                except (OSError, sqlite3.Error) as e:
+                    print(f"无法打开元数据缓存 {self.cache_path}: {e}")
+                    self.cache_path = None
+            return self._cache
+
+    @property
+    def progress(self) -> ProgressReporter:
+        """下载进度事件源，可用 progress.add_listener(callback) 接收每个文件的进度"""
+        with self._cache_lock:
+            if self._progress is None:
+                self._progress = ProgressReporter()
+                if not self.quiet:
+                    self._progress.add_listener(ConsoleProgressRenderer(self.progress_interval))
+            return self._progress
+
+    @property
+    def rate_limiter(self) -> RateLimiter:
+        with self._cache_lock:
+            if self._rate_limiter is None:
+                self._rate_limiter = RateLimiter(self.api_rate, self.api_min_rate, self.api_max_rate)
+            return self._rate_limiter
+
+    def _api_get(self, endpoint: str, url: str, headers: Dict, timeout: float = 15) -> tuple:
+        """经限速器发送API请求，返回 (响应, JSON数据)；被限流（412/429/-412/-799）时退避后重试"""
+        bucket = self.rate_limiter.bucket(endpoint)
+        for _ in range(self.max_retries + 1):
+            bucket.acquire()
+            response = self.session.get(url, headers=headers, timeout=timeout)
+            try:
+                data = response.json()
+            except ValueError:
+                data = None
+            self.metrics.record_status(endpoint, response.status_code, self._api_code(data))
+            if not RateLimiter.is_throttled(response.status_code, data):
+                if response.status_code == 200:
+                    bucket.on_success()
+                return response, data
+            self.metrics.count('api_throttled')
+            backoff = bucket.on_throttle()
+            print(f"请求被限流（{endpoint}，状态码 {response.status_code}），"
+                  f"{backoff:.1f} 秒后重试，速率降至 {bucket.rate:.2f} 次/秒")
+        return response, data
+
+    def _inherit_span(self, func):
+        """交给线程池执行的函数继承当前的性能分析区间（未启用 --profile 时原样返回）"""
+        return self.profiler.inherit(func) if self.profiler else func
+
+    @staticmethod
+    def _api_code(data) -> Optional[int]:
+        return data.get('code') if isinstance(data, dict) else None
+
+    def write_run_report(self, stats: Optional[DownloadStats] = None) -> Optional[str]:
+        """写出运行报告（JSON，可选 Prometheus textfile），返回JSON报告路径"""
+        report = self.metrics.report(stats, self._cache)
+        path = None
+        try:
+            if self.report_name:
+                path = os.path.join(self.download_dir, self.report_name)
+                self.metrics.write_json(path, report)
+            if self.prometheus_path:
+                self.metrics.write_prometheus(self.prometheus_path, report)
+        except OSError as e:
+            print(f"写入运行报告失败: {e}")
+            return None
+        return path
+
+    @property
+    def manifest(self) -> DownloadManifest:
+        """下载目录中的下载清单，下载目录变化时重新读取"""
+        path = os.path.join(self.download_dir, self.manifest_name)
+        with self._cache_lock:
+            if self._manifest is None or self._manifest.path != path:
+                self._manifest = DownloadManifest(path)
+            return self._manifest
+
+    def _load_sync_marks(self) -> Dict[str, Dict]:
+        path = os.path.join(self.download_dir, self.sync_state_name)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print(f"读取同步位置失败，将获取完整列表: {e}")
+            return {}
+
+    def get_sync_mark(self, user_id: str) -> Optional[Dict]:
+        """用户上次完整同步时的最新投稿 {'bvid', 'aid', 'created', 'all_parts'}，没有同步过时为 None"""
+        return self._load_sync_marks().get(str(user_id))
+
+    def _save_sync_marks(self):
+        """本次完整获取列表的用户，列出的视频都已下载时把同步位置推进到最新投稿
+
+        有视频下载失败、跳过或被中断时保留原来的位置，下次同步会重新检查这些视频。
+        """
+        listings, self._complete_listings = self._complete_listings, []
+        marks = None
+        for user_id, newest, listed in listings:
+            missing = [video['bvid'] for video in listed if not self._is_synced(video)]
+            if missing:
+                print(f"用户 {user_id} 有 {len(missing)} 个视频未下载完成，同步位置保持不变")
+                continue
+            if marks is None:
+                marks = self._load_sync_marks()
+            marks[user_id] = {'bvid': newest['bvid'], 'aid': newest['aid'], 'created': newest.get('created') or 0,
+                              'all_parts': self.all_parts}
+        if marks is None:
+            return
+        try:
+            RunMetrics._write_atomic(os.path.join(self.download_dir, self.sync_state_name),
+                                     json.dumps(marks, ensure_ascii=False, indent=2))
+        except OSError as e:
+            print(f"保存同步位置失败: {e}")
 
     def _set_cookies_from_string(self, cookie_string: str):
         """从cookie字符串设置cookies"""
@@ -106,71 +1610,91 @@ class BilibiliUserDownloader:
         time_hex = hex(current_time).upper()[2:]
         return f"{hex_part}_{time_hex}"
 
-    def init_wbi_keys(self):
-        """初始化WBI签名密钥（参考原项目API.java的实现）"""
+    @timed('wbi_init')
+    def init_wbi_keys(self, force_refresh: bool = False):
+        """初始化WBI签名密钥（参考原项目API.java的实现），优先使用缓存中未过期的密钥"""
+        if not force_refresh and self._load_cached_wbi_keys():
+            return True
         try:
-            url = "https://api.bilibili.com/x/web-interface/nav"
-            headers = {
-                'User-Agent': self.headers['User-Agent'],
-                'Accept': 'application/json, text/plain, */*',
-                'Accept-Language': 'zh-CN,zh;q=0.8',
-                'Connection': 'keep-alive'
-            }
-            
-            response = self.session.get(url, headers=headers, timeout=10)
+            response, data = self._api_get('nav', self.api_base + self.NAV_PATH, self._nav_headers(), timeout=10)
             print(f"WBI初始化响应状态: {response.status_code}")
             
             if response.status_code != 200:
                 print(f"WBI初始化失败，状态码: {response.status_code}")
                 return False
-            
-            data = response.json()
-            
-            if data['code'] == 0:
-                wbi_img = data['data']['wbi_img']
-                img_url = wbi_img['img_url']
-                sub_url = wbi_img['sub_url']
-                
-                # 提取文件名（严格按照原项目逻辑）
-                img_key = img_url.split('/')[-1].split('.')[0]
-                sub_key = sub_url.split('/')[-1].split('.')[0]
-                
-                self.wbi_img = img_key + sub_key
-                self.mixin_key = self._get_mixin_key(self.wbi_img)
-                print(f"WBI密钥初始化成功: {self.mixin_key}")
-                return True
-            elif data['code'] == -101:
-                # 账号未登录，但仍然可以获取wbi_img
-                print("检测到账号未登录状态，但仍可以获取WBI密钥")
-                wbi_img = data['data']['wbi_img']
-                img_url = wbi_img['img_url']
-                sub_url = wbi_img['sub_url']
-                
-                img_key = img_url.split('/')[-1].split('.')[0]
-                sub_key = sub_url.split('/')[-1].split('.')[0]
-                
-                self.wbi_img = img_key + sub_key
-                self.mixin_key = self._get_mixin_key(self.wbi_img)
-                print(f"WBI密钥初始化成功: {self.mixin_key}")
-                return True
-            else:
-                print(f"WBI密钥初始化失败: {data}")
-                return False
+            return self._apply_nav_data(data)
         except Exception as e:
             print(f"WBI密钥初始化错误: {e}")
             return False
 
-    def _get_mixin_key(self, content: str) -> str:
-        """生成混合密钥"""
-        return ''.join([content[i] for i in self.mixin_array[:32]])
+    NAV_PATH = "/x/web-interface/nav"
 
-    def _encode_wbi(self, params: dict) -> str:
-        """WBI签名"""
-        if not self.mixin_key:
-            self.init_wbi_keys()
-        
-        # 添加时间戳
-        params['wts'] = int(time.time())
+    def _nav_headers(self) -> Dict[str, str]:
+        return {
+            'User-Agent': self.headers['User-Agent'],
+            'Accept': 'application/json, text/plain, */*',
+            'Accept-Language': 'zh-CN,zh;q=0.8',
+            'Connection': 'keep-alive'
+        }
+
+    def _load_cached_wbi_keys(self) -> bool:
+        cache = self.cache
+        cached = cache.get('wbi', 'keys') if cache else None
+        if not cached:
+            return False
+        self.wbi_img = cached['img_key'] + cached['sub_key']
+        self.mixin_key = cached['mixin_key']
+        print(f"使用缓存的WBI密钥: {self.mixin_key}")
+        return True
+
+    def _apply_nav_data(self, data: Dict) -> bool:
+        """从 nav 接口的响应中提取WBI密钥并写入缓存"""
+        if data['code'] in (0, -101):
+            if data['code'] == -101:
+                # 账号未登录，但仍然可以获取wbi_img
+                print("检测到账号未登录状态，但仍可以获取WBI密钥")
+            wbi_img = data['data']['wbi_img']
+            img_url = wbi_img['img_url']
+            sub_url = wbi_img['sub_url']
+            
+            # 提取文件名（严格按照原项目逻辑）
+            img_key = img_url.split('/')[-1].split('.')[0]
+            sub_key = sub_url.split('/')[-1].split('.')[0]
+            
+            self.wbi_img = img_key + sub_key
+            self.mixin_key = self._get_mixin_key(self.wbi_img)
+            cache = self.cache
+            if cache:
+                cache.set('wbi', 'keys', {'img_key': img_key, 'sub_key': sub_key, 'mixin_key': self.mixin_key})
+            print(f"WBI密钥初始化成功: {self.mixin_key}")
+            return True
+        print(f"WBI密钥初始化失败: {data}")
+        return False
+
+    def _refresh_wbi_keys(self, stale_mixin_key: Optional[str]) -> bool:
+        """签名被拒绝时重新获取密钥；多个线程同时遇到时只刷新一次"""
+        with self._wbi_lock:
+            if self.mixin_key and self.mixin_key != stale_mixin_key:
+                return True
+            print("WBI签名被拒绝，重新获取密钥...")
+            return self.init_wbi_keys(force_refresh=True)
+
+    def _get_mixin_key(self, content: str) -> str:
+        """生成混合密钥"""
+        return ''.join([content[i] for i in self.mixin_array[:32]])
+
+    def _encode_wbi(self, params: dict) -> str:
+        """WBI签名"""
+        if not self.mixin_key:
+            # 第一次签名时才加载密钥
+            with self._wbi_lock:
+                if not self.mixin_key:
+                    self.init_wbi_keys()
+        if not self.mixin_key:
+            raise RuntimeError("WBI密钥不可用")
+        
+        # 添加时间戳
+        params['wts'] = int(time.time())
         
         # URL编码并排序
         encoded_params = []
@@ -184,6 +1708,24 @@ class BilibiliUserDownloader:
         
         return f"{param_string}&w_rid={w_rid}"
 
+    # 签名失效或触发风控时接口返回的错误码，刷新密钥后重试一次
+    WBI_RETRY_CODES = (-352, -403)
+
+    def _wbi_get(self, endpoint: str, url: str, params: dict, headers: dict, timeout: float = 15) -> Dict:
+        """发送带WBI签名的GET请求并返回JSON，签名被拒绝时刷新密钥后自动重试一次"""
+        for attempt in range(2):
+            mixin_key = self.mixin_key
+            query_string = self._encode_wbi(dict(params))
+            response, data = self._api_get(endpoint, f"{url}?{query_string}", headers, timeout)
+            if data is None:
+                raise ValueError(f"接口返回非JSON内容，状态码 {response.status_code}")
+            if attempt or data.get('code') not in self.WBI_RETRY_CODES:
+                return data
+            self.metrics.count('wbi_rejected')
+            if not self._refresh_wbi_keys(mixin_key or self.mixin_key):
+                return data
+        return data
+
     def extract_user_id(self, user_url: str) -> Optional[str]:
         """从用户空间URL提取用户ID"""
         import re
@@ -205,7 +1747,8 @@ class BilibiliUserDownloader:
             
         return None
 
-    def _format_duration(self, seconds):
+    @staticmethod
+    def _format_duration(seconds):
         """格式化时长，返回 m:ss"""
         try:
             total = int(seconds or 0)
@@ -217,204 +1760,354 @@ class BilibiliUserDownloader:
         secs = total % 60
         return f"{minutes}:{secs:02d}"
 
+    @staticmethod
+    def _format_size(size) -> str:
+        """格式化字节数，返回如 12.3MB"""
+        size = float(size or 0)
+        for unit in ('B', 'KB', 'MB'):
+            if size < 1024:
+                return f"{size:.1f}{unit}"
+            size /= 1024
+        return f"{size:.2f}GB"
+
     def sanitize_filename(self, name: str) -> str:
         """仅移除Windows非法字符，保留中文符号如《》"""
         illegal = '\\/:*?"<>|'
         cleaned = ''.join(ch for ch in str(name) if ord(ch) >= 32 and ch not in illegal)
         return cleaned.strip().rstrip('.')
 
+    def _medialist_headers(self) -> Dict[str, str]:
+        return {
+            'User-Agent': self.headers['User-Agent'],
+            'Accept': 'application/json, text/plain, */*',
+            'Accept-Language': 'zh-CN,zh;q=0.8',
+            'Connection': 'keep-alive',
+            'Referer': 'https://space.bilibili.com/',
+            'Origin': 'https://space.bilibili.com/'
+        }
+
+    @timed('medialist_info')
+    def _get_medialist_info(self, user_id: str) -> Optional[Dict]:
+        """获取用户的 Medialist 信息（优先读缓存），失败返回None"""
+        cache = self.cache
+        if cache:
+            cached = cache.get('medialist_info', str(user_id))
+            if cached is not None:
+                print(f"使用缓存的Medialist信息: {user_id}")
+                return cached
+
+        info_url = f"{self.api_base}/x/v1/medialist/info?type=1&tid=0&biz_id={user_id}"
+        print(f"正在获取Medialist信息: {info_url}")
+
+        response, data = self._api_get('medialist', info_url, self._medialist_headers())
+        print(f"Medialist信息响应状态: {response.status_code}")
+
+        if response.status_code != 200:
+            print(f"Medialist信息获取失败，状态码: {response.status_code}")
+            return None
+
+        if data['code'] != 0:
+            print(f"Medialist信息获取失败: {data}")
+            return None
+
+        if cache:
+            cache.set('medialist_info', str(user_id), data['data'])
+        return data['data']
+
     def get_user_info_from_medialist(self, user_id: str) -> Optional[Dict]:
         """从 Medialist API 获取用户信息（避免单独请求用户信息API）"""
         try:
-            headers = {
-                'User-Agent': self.headers['User-Agent'],
-                'Accept': 'application/json, text/plain, */*',
-                'Accept-Language': 'zh-CN,zh;q=0.8',
-                'Connection': 'keep-alive',
-                'Referer': 'https://space.bilibili.com/',
-                'Origin': 'https://space.bilibili.com/'
-            }
-            
-            # 增加延迟
-            time.sleep(self.api_delay)
-            
             # 获取medialist信息，其中包含用户信息
-            info_url = f"https://api.bilibili.com/x/v1/medialist/info?type=1&tid=0&biz_id={user_id}"
-            print(f"从Medialist获取用户信息: {info_url}")
-            
-            response = self.session.get(info_url, headers=headers, timeout=15)
-            print(f"Medialist用户信息响应状态: {response.status_code}")
-            
-            if response.status_code != 200:
-                print(f"Medialist用户信息获取失败，状态码: {response.status_code}")
-                return None
-            
-            data = response.json()
-            if data['code'] != 0:
-                print(f"Medialist用户信息获取失败: {data}")
+            medialist_data = self._get_medialist_info(user_id)
+            if not medialist_data:
                 return None
-            
-            # 从 medialist 数据中提取用户信息
-            medialist_data = data['data']
-            upper_info = medialist_data['upper']
-            
-            return {
-                'mid': upper_info['mid'],
-                'name': upper_info['name'],
-                'face': upper_info['face'],
-                'sign': medialist_data.get('intro', ''),  # 使用列表介绍作为用户简介
-                'level': 0,  # medialist中没有等级信息
-                'sex': '',
-                'official': {'role': 0, 'title': '', 'desc': ''}
-            }
+            return self._user_info_from_medialist(medialist_data)
             
         except Exception as e:
             print(f"Medialist获取用户信息错误: {e}")
             return None
 
-    def get_user_videos(self, user_id: str, page: int = 1, page_size: int = 50) -> List[Dict]:
+    def _user_info_from_medialist(self, medialist_data: Dict) -> Dict:
+        """从 medialist 数据中提取用户信息"""
+        upper_info = medialist_data['upper']
+        
+        return {
+            'mid': upper_info['mid'],
+            'name': upper_info['name'],
+            'face': upper_info['face'],
+            'sign': medialist_data.get('intro', ''),  # 使用列表介绍作为用户简介
+            'level': 0,  # medialist中没有等级信息
+            'sex': '',
+            'official': {'role': 0, 'title': '', 'desc': ''}
+        }
+
+    def get_user_videos(self, user_id: str, page: int = 1, page_size: int = 50, oid: str = '') -> List[Dict]:
         """获取用户投稿视频列表（使用原项目的Medialist方法）"""
-        return self._get_user_videos_medialist(user_id, page, page_size)
+        return self._get_user_videos_medialist(user_id, page, page_size, oid)
     
-    def _get_user_videos_medialist(self, user_id: str, page: int = 1, page_size: int = 20) -> List[Dict]:
-        """使用Medialist API获取用户视频（参考原项目 URL4UPAllMedialistParser）"""
+    def _get_user_videos_medialist(self, user_id: str, page: int = 1, page_size: int = 20, oid: str = '') -> List[Dict]:
+        """使用Medialist API获取一页用户视频（参考原项目 URL4UPAllMedialistParser）
+
+        Medialist 按游标分页：oid 为上一页最后一个视频的 aid，为空时获取第一页。
+        page 仅用于日志显示。
+        """
+        videos, _ = self._fetch_medialist_page(user_id, page_size, oid)
+        return videos
+
+    @timed('medialist_page')
+    def _fetch_medialist_page(self, user_id: str, page_size: int = 20, oid: str = '') -> tuple:
+        """请求一页 Medialist 视频，返回 (视频列表, 是否还有下一页)，请求失败时为 ([], None)"""
         try:
-            # 第一步：获取用户Medialist信息
-            headers = {
-                'User-Agent': self.headers['User-Agent'],
-                'Accept': 'application/json, text/plain, */*',
-                'Accept-Language': 'zh-CN,zh;q=0.8',
-                'Connection': 'keep-alive',
-                'Referer': 'https://space.bilibili.com/',
-                'Origin': 'https://space.bilibili.com/'
-            }
-            
-            # 增加延迟
-            time.sleep(self.api_delay)
-            
-            # 获取medialist信息
-            info_url = f"https://api.bilibili.com/x/v1/medialist/info?type=1&tid=0&biz_id={user_id}"
-            print(f"正在获取Medialist信息: {info_url}")
-            
-            response = self.session.get(info_url, headers=headers, timeout=15)
-            print(f"Medialist信息响应状态: {response.status_code}")
-            
-            if response.status_code != 200:
-                print(f"Medialist信息获取失败，状态码: {response.status_code}")
-                return []
-            
-            info_data = response.json()
-            if info_data['code'] != 0:
-                print(f"Medialist信息获取失败: {info_data}")
-                return []
-            
-            # 第二步：使用medialist resource API获取视频列表
-            time.sleep(self.api_delay)
-            
-            # 构建 resource list URL
-            resource_url = f"https://api.bilibili.com/x/v2/medialist/resource/list?type=1&oid=&otype=2&biz_id={user_id}&bvid=&with_current=true&mobi_app=web&ps={page_size}&direction=false&sort_field=1&tid=0&desc=true"
-            print(f"正在获取视频列表: {resource_url}")
-            
-            response = self.session.get(resource_url, headers=headers, timeout=15)
-            print(f"Medialist视频列表响应状态: {response.status_code}")
-            
-            if response.status_code != 200:
-                print(f"Medialist视频列表获取失败，状态码: {response.status_code}")
-                return []
+            # 第一步：获取用户Medialist信息（仅首页需要）
+            if not oid and not self._get_medialist_info(user_id):
+                return [], None
             
-            data = response.json()
-            if data['code'] != 0:
-                print(f"Medialist视频列表获取失败: {data}")
-                return []
-            
-            # 解析视频列表
-            media_list = data['data']['media_list']
-            videos = []
-            
-            for media in media_list:
-                # 转换为与原来API兼容的格式
-                video = {
-                    'bvid': media['bv_id'],
-                    'aid': media['id'],
-                    'title': media['title'],
-                    'pic': media['cover'],
-                    'author': media['upper']['name'],
-                    'mid': media['upper']['mid'],
-                    'created': media['pubtime'],
-                    'length': self._format_duration(media.get('duration', 0)),
-                    'play': media.get('cnt_info', {}).get('play', 0),
-                    'video_review': media.get('cnt_info', {}).get('reply', 0)
-                }
-                videos.append(video)
+            # 第二步：使用medialist resource API获取视频列表（第一页缓存时间较短，以便发现新投稿）
+            endpoint = 'medialist_page' if oid else 'medialist_first'
+            cache_key = f"{user_id}:{oid}:{page_size}"
+            cache = self.cache
+            list_data = cache.get(endpoint, cache_key) if cache else None
+            if list_data is not None:
+                print(f"使用缓存的视频列表: {cache_key}")
+            else:
+                list_data = self._request_medialist_resource(user_id, page_size, oid)
+                if list_data is None:
+                    return [], None
+                if cache:
+                    cache.set(endpoint, cache_key, list_data)
             
-            print(f"Medialist成功获取 {len(videos)} 个视频")
-            return videos
+            return self._parse_medialist_page(list_data, page_size)
             
         except Exception as e:
             print(f"Medialist获取视频列表错误: {e}")
+            return [], None
+
+    def _parse_medialist_page(self, list_data: Dict, page_size: int) -> tuple:
+        """把 resource/list 的 data 字段转换为视频列表，返回 (视频列表, 是否还有下一页)"""
+        media_list = list_data.get('media_list') or []
+        videos = []
+        
+        for media in media_list:
+            # 列表项自带各分P的cid（pages[].id），保留下来可省去逐个请求view接口
+            pages = [
+                {
+                    'cid': str(page_info['id']),
+                    'page': page_info.get('page', idx),
+                    'part': page_info.get('title', ''),
+                    'duration': page_info.get('duration', 0)
+                }
+                for idx, page_info in enumerate(media.get('pages') or [], 1) if page_info.get('id')
+            ]
+            # 转换为与原来API兼容的格式
+            video = {
+                'bvid': media['bv_id'],
+                'aid': media['id'],
+                'title': media['title'],
+                'pic': media['cover'],
+                'author': media['upper']['name'],
+                'mid': media['upper']['mid'],
+                'created': media['pubtime'],
+                'length': self._format_duration(media.get('duration', 0)),
+                'play': media.get('cnt_info', {}).get('play', 0),
+                'video_review': media.get('cnt_info', {}).get('reply', 0),
+                'cid': pages[0]['cid'] if pages else None,
+                'pages': pages
+            }
+            videos.append(video)
+        
+        has_more = bool(list_data.get('has_more', len(videos) >= page_size))
+        print(f"Medialist成功获取 {len(videos)} 个视频")
+        return videos, has_more
+
+    def _medialist_resource_url(self, user_id: str, page_size: int, oid: str) -> str:
+        # 构建 resource list URL；带游标时不再包含游标所指的视频本身
+        with_current = 'false' if oid else 'true'
+        return f"{self.api_base}/x/v2/medialist/resource/list?type=1&oid={oid}&otype=2&biz_id={user_id}&bvid=&with_current={with_current}&mobi_app=web&ps={page_size}&direction=false&sort_field=1&tid=0&desc=true"
+
+    def classify_targets(self, targets: Iterable[str]) -> tuple:
+        """把下载目标分为用户ID和BV号，返回 (用户ID列表, BV号列表)，去重并保持顺序，无法识别的目标会被忽略"""
+        import re
+
+        user_ids: List[str] = []
+        bvids: List[str] = []
+        for target in targets:
+            match = re.search(r'BV[0-9A-Za-z]{10}', target)
+            if match:
+                if match.group(0) not in bvids:
+                    bvids.append(match.group(0))
+                continue
+            user_id = self.extract_user_id(target)
+            if not user_id:
+                print(f"无法识别的下载目标，已忽略: {target}")
+            elif user_id not in user_ids:
+                user_ids.append(user_id)
+        return user_ids, bvids
+
+    def _request_medialist_resource(self, user_id: str, page_size: int, oid: str) -> Optional[Dict]:
+        """请求 medialist resource/list 接口，返回响应中的 data 字段，失败返回None"""
+        resource_url = self._medialist_resource_url(user_id, page_size, oid)
+        print(f"正在获取视频列表: {resource_url}")
+        
+        response, data = self._api_get('medialist', resource_url, self._medialist_headers())
+        print(f"Medialist视频列表响应状态: {response.status_code}")
+        
+        if response.status_code != 200:
+            print(f"Medialist视频列表获取失败，状态码: {response.status_code}")
+            return None
+        
+        if data['code'] != 0:
+            print(f"Medialist视频列表获取失败: {data}")
+            return None
+        return data['data']
+
+    def iter_user_video_pages(self, user_id: str, max_count: int = None, page_size: int = 20) -> Iterator[List[Dict]]:
+        """按页流式获取用户投稿视频，以上一页最后一个视频的 aid 作为下一页游标"""
+        cursor = MedialistCursor(self, user_id, max_count, page_size)
+        while not cursor.done:
+            videos, has_more = self._fetch_medialist_page(user_id, page_size, cursor.oid)
+            videos = cursor.accept(videos, has_more)
+            if videos:
+                yield videos
+        cursor.finish()
+
+    def iter_user_videos(self, user_id: str, max_count: int = None) -> Iterator[Dict]:
+        """逐个产出用户投稿视频，下载可以在后续页面获取完成前开始"""
+        for videos in self.iter_user_video_pages(user_id, max_count):
+            for video in videos:
+                yield video
+
+    def iter_batch_videos(self, user_ids: List[str], bvids: List[str] = (), max_count: int = None) -> Iterator[Dict]:
+        """多个用户和单个视频一起下载时，按来源轮流产出视频（每轮每个来源一个）
+
+        投稿很多的用户不会占满下载队列，其他用户的视频也能尽早开始下载；总并发数仍由 download_jobs 决定。
+        各用户的列表在轮到时才按页获取，max_count 为每个用户最多下载的数量。
+        """
+        sources = [self.iter_user_videos(user_id, max_count) for user_id in user_ids]
+        if bvids:
+            sources.insert(0, self._iter_bvid_videos(bvids))
+        while sources:
+            for source in list(sources):
+                video = next(source, None)
+                if video is None:
+                    sources.remove(source)
+                else:
+                    yield video
+
+    def _iter_bvid_videos(self, bvids: Iterable[str]) -> Iterator[Dict]:
+        for bvid in bvids:
+            video = self.get_video_info(bvid)
+            if video:
+                yield video
+
+    def get_latest_videos(self, user_id: str, page_size: int = 20) -> List[Dict]:
+        """不读缓存获取用户最新的一页投稿（监视模式轮询用），失败返回空列表"""
+        try:
+            list_data = self._request_medialist_resource(user_id, page_size, '')
+            if list_data is None:
+                return []
+            cache = self.cache
+            if cache:
+                cache.set('medialist_first', f"{user_id}::{page_size}", list_data)
+            return self._parse_medialist_page(list_data, page_size)[0]
+        except Exception as e:
+            print(f"获取用户 {user_id} 的最新投稿失败: {e}")
             return []
 
     def get_all_user_videos(self, user_id: str, max_count: int = None) -> List[Dict]:
         """获取用户投稿视频（使用Medialist方法），支持限制数量"""
         all_videos: List[Dict] = []
-        page = 1
-        page_size = 20  # 与 Medialist API 对齐
-        
-        print(f"开始获取用户 {user_id} 的视频（使用Medialist方法）...")
-        if max_count:
-            print(f"目标获取数量: {max_count} 个视频")
-        
-        while True:
-            print(f"正在获取第 {page} 页...")
-            videos = self.get_user_videos(user_id, page, page_size)
-            if not videos:
-                break
-            
-            if max_count and len(all_videos) + len(videos) > max_count:
-                needed = max_count - len(all_videos)
-                videos = videos[:needed]
-                all_videos.extend(videos)
-                print(f"第 {page} 页获取到 {len(videos)} 个视频（已达到目标数量 {max_count}）")
-                break
-            
+        for videos in self.iter_user_video_pages(user_id, max_count):
             all_videos.extend(videos)
-            print(f"第 {page} 页获取到 {len(videos)} 个视频，累计 {len(all_videos)} 个")
-            
-            if max_count and len(all_videos) >= max_count:
-                print(f"已获取到目标数量 {max_count} 个视频")
-                break
-            
-            if len(videos) < page_size:
-                break
-            
-            page += 1
-            time.sleep(self.delay_between_requests)
-        
-        print(f"共获取到 {len(all_videos)} 个视频")
         return all_videos
 
-    def get_video_cid(self, bvid: str) -> Optional[str]:
-        """获取视频的第一个分P的cid"""
-        try:
-            url = f"https://api.bilibili.com/x/web-interface/view?bvid={bvid}"
-            headers = {
-                'User-Agent': self.headers['User-Agent'],
-                'Referer': f'https://www.bilibili.com/video/{bvid}',
-                'Accept': 'application/json, text/plain, */*'
+    def _view_request(self, bvid: str) -> tuple:
+        """view 接口的URL和请求头"""
+        url = f"{self.api_base}/x/web-interface/view?bvid={bvid}"
+        headers = {
+            'User-Agent': self.headers['User-Agent'],
+            'Referer': f'https://www.bilibili.com/video/{bvid}',
+            'Accept': 'application/json, text/plain, */*'
+        }
+        return url, headers
+
+    def _parse_view(self, info: Dict) -> Dict:
+        """把 view 接口的 data 字段转换为与用户视频列表相同格式的视频信息，分P列表同时写入缓存"""
+        raw_pages = info.get('pages') or []
+        cache = self.cache
+        if cache and raw_pages:
+            cache.set('view', info['bvid'], raw_pages)
+        pages = [
+            {
+                'cid': str(page_info['cid']),
+                'page': page_info.get('page', idx),
+                'part': page_info.get('part', ''),
+                'duration': page_info.get('duration', 0)
             }
-            resp = self.session.get(url, headers=headers, timeout=15)
+            for idx, page_info in enumerate(raw_pages, 1) if page_info.get('cid')
+        ]
+        owner = info.get('owner') or {}
+        stat = info.get('stat') or {}
+        return {
+            'bvid': info['bvid'],
+            'aid': info.get('aid'),
+            'title': info.get('title', ''),
+            'pic': info.get('pic', ''),
+            'author': owner.get('name', ''),
+            'mid': owner.get('mid'),
+            'created': info.get('pubdate', 0),
+            'length': self._format_duration(info.get('duration', 0)),
+            'play': stat.get('view', 0),
+            'video_review': stat.get('reply', 0),
+            'cid': pages[0]['cid'] if pages else None,
+            'pages': pages
+        }
+
+    @timed('view')
+    def get_video_info(self, bvid: str) -> Optional[Dict]:
+        """获取单个视频的信息（用于按BV号下载），失败返回None"""
+        try:
+            url, headers = self._view_request(bvid)
+            resp, data = self._api_get('view', url, headers)
+            if resp.status_code == 200 and data.get('code') == 0:
+                return self._parse_view(data['data'])
+            print(f"获取视频信息失败 {bvid}: 状态码 {resp.status_code}")
+        except Exception as e:
+            print(f"获取视频信息失败 {bvid}: {e}")
+        return None
+
+    @timed('view')
+    def get_video_pages(self, bvid: str) -> Optional[List[Dict]]:
+        """获取视频的分P列表（view接口的 data.pages，优先读缓存）"""
+        cache = self.cache
+        if cache:
+            pages = cache.get('view', bvid)
+            if pages is not None:
+                return pages
+        try:
+            url, headers = self._view_request(bvid)
+            resp, data = self._api_get('view', url, headers)
             if resp.status_code == 200:
-                data = resp.json()
                 if data.get('code') == 0:
                     pages = data.get('data', {}).get('pages', [])
                     if pages:
-                        return str(pages[0].get('cid'))
-            print(f"获取视频cid失败 {bvid}: 状态码 {resp.status_code}")
+                        if cache:
+                            cache.set('view', bvid, pages)
+                        return pages
+            print(f"获取视频分P信息失败 {bvid}: 状态码 {resp.status_code}")
             return None
         except Exception as e:
-            print(f"获取视频cid失败 {bvid}: {e}")
+            print(f"获取视频分P信息失败 {bvid}: {e}")
             return None
 
+    @profiled('get_video_cid', bvid_arg=True)
+    def get_video_cid(self, bvid: str) -> Optional[str]:
+        """获取视频的第一个分P的cid"""
+        pages = self.get_video_pages(bvid)
+        if pages:
+            return str(pages[0].get('cid'))
+        print(f"获取视频cid失败 {bvid}")
+        return None
+
     def _get_user_videos_wbi(self, user_id: str, page: int = 1, page_size: int = 50) -> List[Dict]:
         """使用WBI签名获取用户投稿视频列表"""
         # 构建参数
@@ -428,59 +2121,443 @@ class BilibiliUserDownloader:
             'platform': 'web',
             'web_location': '1550101'
         }
-        # WBI签名
-        query_string = self._encode_wbi(params)
-        url = f"https://api.bilibili.com/x/space/wbi/arc/search?{query_string}"
-        # ... (rest of the code remains the same)
+        url = f"{self.api_base}/x/space/wbi/arc/search"
+        headers = {
+            'User-Agent': self.headers['User-Agent'],
+            'Referer': f'https://space.bilibili.com/{user_id}/video',
+            'Accept': 'application/json, text/plain, */*'
+        }
+        try:
+            data = self._wbi_get('search', url, params, headers)
+            if data.get('code') == 0:
+                return data['data']['list']['vlist']
+            print(f"获取用户视频列表失败: {data}")
+        except Exception as e:
+            print(f"获取用户视频列表错误: {e}")
+        return []
+
+    @profiled('download_video_file')
+    def download_video_file(self, url: str, filename: str, backup_urls: List[str] = None) -> bool:
+        """下载视频文件（支持分段并行下载和断点续传）
 
-    def download_video_file(self, url: str, filename: str) -> bool:
-        """下载视频文件"""
+        backup_urls 为同一文件的其他CDN镜像：开始前测速选择最快的镜像，
+        传输出错或速度过低时换用其他镜像，从已下载的位置继续。
+        """
         headers = {
             'User-Agent': self.headers['User-Agent'],
             'Referer': 'https://www.bilibili.com/',
             'Range': 'bytes=0-'
         }
-        for attempt in range(self.max_retries):
+        # 断点续传状态始终以 baseUrl 标识，与实际使用哪个镜像无关
+        state_file = filename + '.state'
+        state = DownloadState.load(state_file, url)
+        if state and (not os.path.exists(filename) or os.path.getsize(filename) != state.total_size):
+            state = None
+        mirrors = MirrorSet(self._rank_mirrors(self._unique_urls([url] + list(backup_urls or []))))
+
+        failures = 0
+        while failures < self.max_retries:
+            progress_before = state.downloaded if state else 0
+            mirror_url = mirrors.current()
             try:
-                if attempt > 0:
-                    wait_time = min(30, 2 ** attempt * 2)
-                    print(f"重试第 {attempt + 1} 次，等待 {wait_time} 秒...")
+                if failures > 0:
+                    wait_time = min(30, 2 ** failures * 2)
+                    print(f"重试第 {failures + 1} 次，等待 {wait_time} 秒...")
                     time.sleep(wait_time)
 
-                print(f"正在下载: {filename}")
-                response = self.session.get(url, headers=headers, stream=True, timeout=60)
+                if state:
+                    print(f"继续下载: {filename}（已完成 {state.downloaded}/{state.total_size}）")
+                    self._download_missing(mirrors, filename, state)
+                else:
+                    print(f"正在下载: {filename}")
+                    response = self.session.get(mirror_url, headers=headers, stream=True, timeout=60)
+
+                    if response.status_code in [200, 206]:
+                        total_size = int(response.headers.get('content-length', 0))
+                        if total_size <= 0:
+                            # 服务器未返回文件大小，无法续传，按原方式整体写入
+                            with open(filename, 'wb') as f:
+                                for chunk in response.iter_content(chunk_size=1024 * 512):
+                                    if chunk:
+                                        f.write(chunk)
+                                        self.progress.update(filename, f.tell())
+                            self.progress.finish(filename)
+                            print(f"\n✓ 下载完成: {filename}")
+                            return True
 
-                if response.status_code in [200, 206]:
-                    total_size = int(response.headers.get('content-length', 0))
-                    downloaded = 0
+                        state = DownloadState(state_file, DownloadState.url_identity(url), total_size,
+                                              accept_ranges=self._supports_ranges(response, total_size))
+                        # 预分配文件，各分段直接写入自己的偏移位置
+                        with open(filename, 'wb') as f:
+                            f.truncate(total_size)
+                        state.save(force=True)
 
-                    with open(filename, 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=1024 * 512):
-                            if chunk:
-                                f.write(chunk)
-                                downloaded += len(chunk)
-                                if total_size > 0:
-                                    progress = (downloaded / total_size) * 100
-                                    print(f"\r下载进度: {progress:.1f}% ({downloaded}/{total_size})", end='')
+                        ranges = self._split_ranges(state)
+                        if len(ranges) > 1:
+                            response.close()
+                            self._download_missing(mirrors, filename, state)
+                        else:
+                            self._write_response(response, filename, 0, total_size - 1, state,
+                                                 can_switch=len(mirrors.urls) > 1)
+                    else:
+                        print(f"下载失败，状态码: {response.status_code}")
+                        mirrors.switch(mirror_url)
 
+                if state and self._validate_download(filename, state):
+                    state.remove()
+                    self.progress.finish(filename)
                     print(f"\n✓ 下载完成: {filename}")
                     return True
-                else:
-                    print(f"下载失败，状态码: {response.status_code}")
+            except RestartDownloadError as e:
+                print(f"\n{e}，从头重新下载")
+                state.remove()
+                state = None
+            except SlowMirrorError as e:
+                print(f"\n{e}")
+                self.metrics.count('slow_mirror')
+                mirrors.switch(mirror_url)
+            except Exception as e:
+                print(f"\n下载文件时出错(尝试 {failures + 1}/{self.max_retries}): {e}")
+                self.metrics.count('transfer_errors')
+                mirrors.switch(mirror_url)
+
+            # 有进展的尝试不计入失败次数，弱网下也能逐步完成大文件
+            if state and state.downloaded > progress_before:
+                continue
+            failures += 1
+        self.progress.finish(filename, success=False)
+        return False
+
+    @staticmethod
+    def _unique_urls(urls: List[Optional[str]]) -> List[str]:
+        unique = []
+        for url in urls:
+            if url and url not in unique:
+                unique.append(url)
+        return unique
+
+    def _rank_mirrors(self, urls: List[str]) -> List[str]:
+        """同时向每个镜像请求一小段数据测速，按速度从快到慢排序，请求失败的排在最后
+
+        最快的镜像收完测速数据后其余镜像立即停止，按已收到的数据计算速度。
+        """
+        if len(urls) <= 1 or self.mirror_probe_size <= 0:
+            return urls
+        finished = threading.Event()
+        with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+            speeds = list(pool.map(lambda url: self._probe_mirror(url, finished), urls))
+        return self._order_by_speed(urls, speeds)
+
+    def _order_by_speed(self, urls: List[str], speeds: List[float]) -> List[str]:
+        order = sorted(range(len(urls)), key=lambda i: -speeds[i])
+        print("镜像测速: " + ", ".join(
+            f"{urllib.parse.urlparse(urls[i]).netloc} {speeds[i] / 1024:.0f} KB/s" for i in order))
+        return [urls[i] for i in order]
+
+    def _probe_mirror(self, url: str, finished: threading.Event) -> float:
+        """返回镜像的下载速度（字节/秒），请求失败返回0"""
+        headers = {
+            'User-Agent': self.headers['User-Agent'],
+            'Referer': 'https://www.bilibili.com/',
+            'Range': f'bytes=0-{self.mirror_probe_size - 1}'
+        }
+        start = time.monotonic()
+        received = 0
+        try:
+            with self.session.get(url, headers=headers, stream=True, timeout=self.mirror_probe_timeout) as response:
+                if response.status_code not in (200, 206):
+                    return 0.0
+                for chunk in response.iter_content(chunk_size=16 * 1024):
+                    received += len(chunk)
+                    if received >= self.mirror_probe_size:
+                        finished.set()
+                        break
+                    if finished.is_set() or time.monotonic() - start > self.mirror_probe_timeout:
+                        break
+        except Exception:
+            return 0.0
+        return received / max(time.monotonic() - start, 1e-6)
+
+    def _supports_ranges(self, response, total_size: int) -> bool:
+        """服务器忽略Range时会返回200；返回206且覆盖整个文件才说明支持分段和续传"""
+        if response.status_code != 206:
+            return False
+        content_range = response.headers.get('content-range', '')
+        return content_range.startswith('bytes 0-') and content_range.endswith(f"/{total_size}")
+
+    def _split_ranges(self, state: 'DownloadState') -> List[tuple]:
+        """把尚未完成的部分切分成若干分段，每段不小于 min_segment_size"""
+        missing = state.missing()
+        if not state.accept_ranges or self.download_segments <= 1:
+            return missing
+        remaining = sum(end - start + 1 for start, end in missing)
+        piece = max(self.min_segment_size, -(-remaining // self.download_segments))
+        ranges = []
+        for start, end in missing:
+            while start <= end:
+                ranges.append((start, min(end, start + piece - 1)))
+                start += piece
+        return ranges
+
+    def _download_missing(self, mirrors: MirrorSet, filename: str, state: 'DownloadState'):
+        """并行下载尚未完成的字节范围，多个连接直接写入预分配的文件"""
+        ranges = self._split_ranges(state)
+        if len(ranges) == 1:
+            self._download_range(mirrors, filename, ranges[0][0], ranges[0][1], state)
+            return
+
+        workers = min(self.download_segments, len(ranges))
+        remaining = sum(end - start + 1 for start, end in ranges)
+        print(f"分段下载: {workers} 个连接，剩余 {remaining}/{state.total_size} 字节")
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self._inherit_span(self._download_range), mirrors, filename, start, end, state)
+                       for start, end in ranges]
+            for future in futures:
+                future.result()
+
+    def _download_range(self, mirrors: MirrorSet, filename: str, start: int, end: int,
+                        state: 'DownloadState') -> bool:
+        """下载 [start, end] 字节范围并写入文件对应位置，镜像出错或过慢时换用其他镜像从断点继续"""
+        for _ in range(len(mirrors.urls)):
+            pos = state.next_missing(start, end)
+            if pos is None:
+                return True
+            url = mirrors.current()
+            headers = {
+                'User-Agent': self.headers['User-Agent'],
+                'Referer': 'https://www.bilibili.com/',
+                'Range': f'bytes={pos}-{end}'
+            }
+            try:
+                response = self.session.get(url, headers=headers, stream=True, timeout=60)
+                self._check_range_response(response.status_code, response.headers.get('content-range', ''),
+                                           pos, end, state, mirrors, url)
+                self._write_response(response, filename, pos, end, state, can_switch=len(mirrors.urls) > 1)
+            except RestartDownloadError:
+                raise
+            except SlowMirrorError as e:
+                print(f"\n分段 {pos}-{end}: {e}")
+                self.metrics.count('slow_mirror')
+                mirrors.switch(url)
             except Exception as e:
-                print(f"下载文件时出错(尝试 {attempt + 1}/{self.max_retries}): {e}")
+                print(f"\n分段 {pos}-{end} 下载出错: {e}")
+                self.metrics.count('transfer_errors')
+                if not mirrors.switch(url):
+                    return False
+        return state.next_missing(start, end) is None
+
+    def _check_range_response(self, status_code: int, content_range: str, start: int, end: int,
+                              state: 'DownloadState', mirrors: MirrorSet, url: str):
+        """检查分段请求的响应；镜像不可用时抛出异常，没有其他镜像可换时要求从头下载"""
+        if status_code == 200:
+            # 开始下载时服务器就不支持Range，或者每个镜像都忽略了Range，换镜像重试没有意义
+            if not state.accept_ranges or mirrors.mark_no_range(url) or not mirrors.switch(url):
+                raise RestartDownloadError("服务器不支持断点续传")
+            raise IOError("镜像不支持断点续传")
+        if status_code != 206:
+            raise IOError(f"状态码: {status_code}")
+        if not (content_range.startswith(f"bytes {start}-")
+                and content_range.endswith(f"/{state.total_size}")):
+            # 其他镜像上的文件可能不一样，换镜像前先确认
+            if mirrors.switch(url):
+                raise IOError(f"镜像返回的范围不匹配: {content_range}")
+            raise RestartDownloadError(f"服务器返回的范围不匹配: {content_range}")
+
+    def _write_response(self, response, filename: str, start: int, end: int, state: 'DownloadState',
+                        can_switch: bool = False):
+        """把响应内容写入文件的 [start, end] 位置，并实时记录已完成的范围
+
+        can_switch 为True（还有其他镜像）时检查传输速度，过慢则抛出 SlowMirrorError。
+        """
+        monitor = ThroughputMonitor(self.min_mirror_speed if can_switch else 0, self.mirror_check_interval)
+        pos = start
+        started = time.monotonic()
+        try:
+            with open(filename, 'r+b') as f:
+                f.seek(start)
+                for chunk in response.iter_content(chunk_size=1024 * 512):
+                    if not chunk:
+                        continue
+                    chunk = chunk[:end + 1 - pos]
+                    f.write(chunk)
+                    # 先落盘再记录进度，进程被杀时状态文件不会超前于实际数据
+                    f.flush()
+                    state.add(pos, len(chunk))
+                    pos += len(chunk)
+                    state.save()
+
+                    self.progress.update(filename, state.downloaded, state.total_size)
+                    if pos > end:
+                        break
+                    monitor.update(len(chunk))
+        finally:
+            response.close()
+            state.save(force=True)
+            self.metrics.record_transfer(response.url, pos - start, time.monotonic() - started)
+
+    def _can_stream_merge(self, job: Dict) -> bool:
+        if not self.stream_merge or not hasattr(os, 'mkfifo') or not find_ffmpeg():
+            return False
+        return job['mode'] == 'audio' or (job['mode'] == 'dash' and bool(job['audio_url']))
+
+    def _stream_merge(self, job: Dict) -> bool:
+        """边下载边合并：各个流的响应体写入命名管道，ffmpeg从管道读取并直接写出最终文件"""
+        import shutil
+        import subprocess
+        import tempfile
+
+        if job['mode'] == 'dash':
+            sources = [('视频流', [job['video_url']] + job['video_backup_urls']),
+                       ('音频流', [job['audio_url']] + job['audio_backup_urls'])]
+            args = ['-map', '0:v:0', '-map', '1:a:0', '-c', 'copy', '-f', 'mp4']
+        else:
+            sources = [('音频流', [job['audio_url']] + job['audio_backup_urls'])]
+            args = ['-vn', '-c:a', 'copy', '-f', job['audio_container']]
+
+        fifo_dir = tempfile.mkdtemp(prefix='bilibili_')
+        fifos = [os.path.join(fifo_dir, f"input{i}") for i in range(len(sources))]
+        for fifo in fifos:
+            os.mkfifo(fifo)
+        # 先写到 .part，ffmpeg 成功退出后再改名，中断时不会留下不完整的最终文件
+        part_file = job['output_file'] + '.part'
+        cmd = [find_ffmpeg(), '-loglevel', 'error']
+        for fifo in fifos:
+            cmd += ['-i', fifo]
+        cmd += args + ['-y', part_file]
+
+        print("边下载边合并（" + " + ".join(label for label, _ in sources) + "）...")
+        process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.PIPE)
+        try:
+            with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+                futures = [pool.submit(self._inherit_span(self._stream_to_pipe), label, self._unique_urls(urls), fifo, process,
+                                       f"{part_file}#{i}")
+                           for i, ((label, urls), fifo) in enumerate(zip(sources, fifos))]
+                streamed = all([future.result() for future in futures])
+            _, stderr = process.communicate()
+            if streamed and process.returncode == 0:
+                os.replace(part_file, job['output_file'])
+                print("\n✓ 边下载边合并完成")
+                return True
+            if process.returncode:
+                print(f"\nffmpeg合并失败: {stderr.decode('utf-8', 'replace').strip()}")
+            return False
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            if os.path.exists(part_file):
+                os.remove(part_file)
+            shutil.rmtree(fifo_dir, ignore_errors=True)
+
+    @staticmethod
+    def _open_fifo(path: str, process) -> Optional[int]:
+        """以写方式打开命名管道；ffmpeg 尚未打开读端时等待，ffmpeg 已退出则返回None"""
+        import errno
+
+        while True:
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                if process.poll() is not None:
+                    return None
+                time.sleep(0.05)
+                continue
+            os.set_blocking(fd, True)
+            return fd
+
+    def _stream_to_pipe(self, label: str, urls: List[str], fifo: str, process, task: str) -> bool:
+        """按顺序下载一个流并写入命名管道，镜像出错或过慢时换用其他镜像，用Range从已写出的位置继续
+
+        task 为进度事件中的任务名。
+        """
+        fd = self._open_fifo(fifo, process)
+        if fd is None:
+            return False
+        mirrors = MirrorSet(urls)
+        pos = 0
+        total = None
+        failures = 0
+        try:
+            with os.fdopen(fd, 'wb') as pipe:
+                while failures < self.max_retries:
+                    url = mirrors.current()
+                    progress_before = pos
+                    headers = {
+                        'User-Agent': self.headers['User-Agent'],
+                        'Referer': 'https://www.bilibili.com/',
+                        'Range': f'bytes={pos}-'
+                    }
+                    started = time.monotonic()
+                    try:
+                        with self.session.get(url, headers=headers, stream=True, timeout=60) as response:
+                            if response.status_code == 200 and pos > 0:
+                                raise IOError("镜像不支持断点续传")
+                            if response.status_code not in (200, 206):
+                                raise IOError(f"状态码: {response.status_code}")
+                            if total is None:
+                                content_range = response.headers.get('content-range', '')
+                                if '/' in content_range and content_range.rsplit('/', 1)[1].isdigit():
+                                    total = int(content_range.rsplit('/', 1)[1])
+                                else:
+                                    total = int(response.headers.get('content-length', 0)) or None
+                            monitor = ThroughputMonitor(self.min_mirror_speed if len(mirrors.urls) > 1 else 0,
+                                                        self.mirror_check_interval)
+                            for chunk in response.iter_content(chunk_size=1024 * 512):
+                                if not chunk:
+                                    continue
+                                pipe.write(chunk)
+                                pos += len(chunk)
+                                self.progress.update(task, pos, total or 0)
+                                monitor.update(len(chunk))
+                        self.metrics.record_transfer(url, pos - progress_before, time.monotonic() - started)
+                        if total is None or pos >= total:
+                            self.progress.finish(task)
+                            return True
+                        raise IOError(f"连接提前结束（{pos}/{total}）")
+                    except BrokenPipeError:
+                        raise
+                    except SlowMirrorError as e:
+                        print(f"\n{label}: {e}")
+                        self.metrics.count('slow_mirror')
+                        self.metrics.record_transfer(url, pos - progress_before, time.monotonic() - started)
+                        mirrors.switch(url)
+                    except Exception as e:
+                        print(f"\n{label}下载出错: {e}")
+                        self.metrics.count('transfer_errors')
+                        mirrors.switch(url)
+                        # 有进展的尝试不计入失败次数
+                        if pos == progress_before:
+                            failures += 1
+        except BrokenPipeError:
+            print(f"\nffmpeg已停止读取{label}")
+        self.progress.finish(task, success=False)
         return False
 
+    def _validate_download(self, filename: str, state: 'DownloadState') -> bool:
+        """所有范围均已完成且文件大小与 content-length 一致才算下载成功"""
+        if state.missing():
+            return False
+        actual_size = os.path.getsize(filename)
+        if actual_size != state.total_size:
+            print(f"\n文件大小校验失败: {actual_size}/{state.total_size}")
+            return False
+        return True
+
+    @profiled('merge_video_audio')
     def merge_video_audio(self, video_file: str, audio_file: str, output_file: str) -> bool:
         """合并视频和音频文件"""
         try:
             import subprocess
             
-            # 检查ffmpeg是否可用
-            try:
-                subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
-            except (subprocess.CalledProcessError, FileNotFoundError):
-                print("警告: 未找到ffmpeg，将尝试简单合并或仅保存视频文件")
+            # 检查ffmpeg是否可用（进程内只查找一次）
+            ffmpeg = find_ffmpeg()
+            if (self.muxer == 'builtin' or not ffmpeg) and self._remux(video_file, audio_file, output_file):
+                return True
+            if not ffmpeg:
+                print("警告: 未找到ffmpeg，仅保存视频文件")
                 # 如果没有ffmpeg，至少保存视频文件
                 if os.path.exists(video_file):
                     os.rename(video_file, output_file)
@@ -489,7 +2566,7 @@ class BilibiliUserDownloader:
             
             # 使用ffmpeg合并音视频
             cmd = [
-                'ffmpeg', '-i', video_file, '-i', audio_file,
+                ffmpeg, '-i', video_file, '-i', audio_file,
                 '-c', 'copy', '-y', output_file
             ]
             
@@ -520,117 +2597,501 @@ class BilibiliUserDownloader:
                 print("已保存视频文件（无音频）")
             return True
 
-    def _download_video(self, video: Dict) -> bool:
-        """下载单个视频（支持音视频分离格式）"""
+    def _remux(self, video_file: str, audio_file: str, output_file: str) -> bool:
+        """用内置的 FragmentedMP4Muxer 合并音视频，不支持的格式返回False"""
+        print("正在合并音视频（内置合并器）...")
         try:
-            print(f"\n开始下载: {video['title']}")
-            
-            # 创建下载目录
-            os.makedirs(self.download_dir, exist_ok=True)
-            
-            # 1. 获取视频的cid
-            cid = self.get_video_cid(video['bvid'])
-            if not cid:
-                print(f"获取cid失败: {video['bvid']}")
-                return False
-            
-            print(f"获取到cid: {cid}")
-            
-            # 2. 获取下载链接
-            download_data = self.get_video_download_url(video['bvid'], cid)
-            if not download_data:
-                print(f"获取下载链接失败: {video['bvid']}")
-                return False
-            
-            # 清理文件名中的非法字符，仅移除Windows不允许的字符，保留《》
-            safe_title = self.sanitize_filename(video['title'])
-            if not safe_title:
-                safe_title = "video"
-            base_filename = f"{video['bvid']}_{safe_title}"
-            final_filepath = os.path.join(self.download_dir, f"{base_filename}.mp4")
-            
-            # 3. 解析下载链接
-            if 'dash' in download_data and download_data['dash']:
-                # DASH格式 - 音视频分离
-                dash_data = download_data['dash']
-                
-                video_url = None
-                audio_url = None
-                
-                # 获取视频流
-                if 'video' in dash_data and dash_data['video']:
-                    video_streams = dash_data['video']
-                    # 选择最高质量的视频流（优先id/height/带宽）
-                    best_v = max(
-                        video_streams,
-                        key=lambda s: (
-                            s.get('id', 0),
-                            s.get('height', 0),
-                            s.get('bandwidth', 0)
-                        )
-                    )
-                    video_url = best_v.get('baseUrl') or best_v.get('backupUrl', [None])[0]
-                
-                # 获取音频流
-                if 'audio' in dash_data and dash_data['audio']:
-                    audio_streams = dash_data['audio']
-                    best_a = max(
-                        audio_streams,
-                        key=lambda s: (
-                            s.get('bandwidth', 0),
-                            s.get('id', 0)
-                        )
-                    )
-                    audio_url = best_a.get('baseUrl') or best_a.get('backupUrl', [None])[0]
-                
-                if not video_url:
-                    print(f"未找到视频流: {video['bvid']}")
-                    return False
-                
-                # 下载视频文件
-                video_temp_file = os.path.join(self.download_dir, f"{base_filename}_video.tmp")
-                print("下载视频流...")
-                if not self.download_video_file(video_url, video_temp_file):
-                    return False
-                
-                # 下载音频文件（如果存在）
-                audio_temp_file = None
-                if audio_url:
-                    audio_temp_file = os.path.join(self.download_dir, f"{base_filename}_audio.tmp")
-                    print("下载音频流...")
-                    if not self.download_video_file(audio_url, audio_temp_file):
-                        print("音频下载失败，将保存无音频视频")
-                        audio_temp_file = None
-                
-                # 合并音视频
-                if audio_temp_file and os.path.exists(audio_temp_file):
-                    success = self.merge_video_audio(video_temp_file, audio_temp_file, final_filepath)
-                else:
-                    # 只有视频，直接重命名
-                    print("只保存视频文件（无音频）")
-                    os.rename(video_temp_file, final_filepath)
-                    success = True
-                    
-            elif 'durl' in download_data and download_data['durl']:
-                # FLV格式 - 音视频一体
-                video_url = download_data['durl'][0]['url']
-                print("下载FLV格式视频（包含音频）...")
-                success = self.download_video_file(video_url, final_filepath)
-            else:
-                print(f"未找到可用的下载链接: {video['bvid']}")
+            FragmentedMP4Muxer(video_file, audio_file).mux(output_file)
+        except (RemuxError, OSError) as e:
+            print(f"内置合并器无法合并: {e}")
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            return False
+        os.remove(video_file)
+        os.remove(audio_file)
+        print("✓ 音视频合并完成")
+        return True
+
+    def extract_audio(self, source_file: str, output_file: str, container: str = 'mp4') -> bool:
+        """用ffmpeg以流复制方式封装音频（-vn -c:a copy，不重新编码）"""
+        try:
+            import subprocess
+
+            ffmpeg = find_ffmpeg()
+            if not ffmpeg:
+                print("警告: 未找到ffmpeg，无法封装音频")
                 return False
+            cmd = [
+                ffmpeg, '-i', source_file, '-vn', '-c:a', 'copy',
+                '-f', container, '-y', output_file
+            ]
+            print("正在封装音频...")
+            result = subprocess.run(cmd, capture_output=True, text=True)
+            if result.returncode == 0:
+                if os.path.exists(source_file):
+                    os.remove(source_file)
+                print("✓ 音频封装完成")
+                return True
+            print(f"ffmpeg封装音频失败: {result.stderr}")
+        except Exception as e:
+            print(f"封装音频时出错: {e}")
+        return False
+
+    def _stream_urls(self, stream: Dict) -> List[str]:
+        """流的全部下载地址：baseUrl 在前，其后是各个 backupUrl"""
+        urls = [stream.get('baseUrl') or stream.get('base_url') or stream.get('url')]
+        urls += stream.get('backupUrl') or stream.get('backup_url') or []
+        return self._unique_urls(urls)
+
+    def _select_audio_stream(self, dash_data: Dict) -> Optional[Dict]:
+        """选择最佳音频流：Hi-Res无损(FLAC) > 杜比全景声 > 普通音频中码率最高者（受 stream_policy 限制）"""
+        return self.stream_policy.select_audio(dash_data)
+
+    def _media_duration(self, download_data: Dict) -> float:
+        """playurl 返回的媒体时长（秒）"""
+        dash_data = download_data.get('dash') or {}
+        if dash_data.get('duration'):
+            return float(dash_data['duration'])
+        return (download_data.get('timelength') or 0) / 1000
+
+    def _resolve_audio_only(self, job: Dict, download_data: Dict) -> Optional[Dict]:
+        """仅音频模式：选择最佳音频流，跳过视频流"""
+        video = job['video']
+        base_filename = job['base_filename']
+        if 'dash' in download_data and download_data['dash']:
+            best_a = self._select_audio_stream(download_data['dash'])
+            audio_urls = self._stream_urls(best_a) if best_a else []
+            if not audio_urls:
+                print(f"未找到音频流: {video['bvid']}")
+                return None
+
+            is_flac = 'flac' in str(best_a.get('codecs', '')).lower()
+            job.update({
+                'mode': 'audio',
+                'audio_url': audio_urls[0],
+                'audio_backup_urls': audio_urls[1:],
+                'audio_codecs': best_a.get('codecs'),
+                'quality': best_a.get('id'),
+                'audio_container': 'flac' if is_flac else 'mp4',
+                'output_file': os.path.join(self.download_dir, f"{base_filename}.{'flac' if is_flac else 'm4a'}"),
+                'estimated_size': StreamPolicy.estimate_size(best_a, self._media_duration(download_data))
+            })
+            return job
+
+        elif 'durl' in download_data and download_data['durl']:
+            # FLV格式 - 音视频一体，下载后提取音轨
+            job.update({
+                'mode': 'audio_flv',
+                'video_url': download_data['durl'][0]['url'],
+                'video_backup_urls': self._stream_urls(download_data['durl'][0])[1:],
+                'quality': download_data.get('quality'),
+                'audio_container': 'mp4',
+                'output_file': os.path.join(self.download_dir, f"{base_filename}.m4a"),
+                'estimated_size': download_data['durl'][0].get('size', 0)
+            })
+            return job
+
+        print(f"未找到可用的下载链接: {video['bvid']}")
+        return None
+
+    def _build_base_filename(self, video: Dict) -> str:
+        """生成输出文件名（不含扩展名）"""
+        # 清理文件名中的非法字符，仅移除Windows不允许的字符，保留《》
+        safe_title = self.sanitize_filename(video['title'])
+        if not safe_title:
+            safe_title = "video"
+        return f"{video['bvid']}_{safe_title}{self._part_suffix(video)}"
+
+    def _part_suffix(self, video: Dict) -> str:
+        """展开后的分P的文件名后缀（_P序号_分P标题），未展开的视频为空"""
+        if not video.get('part_index'):
+            return ''
+        width = max(2, len(str(video.get('part_count') or '')))
+        suffix = f"_P{video['part_index']:0{width}d}"
+        part = self.sanitize_filename(video.get('part') or '')
+        return f"{suffix}_{part}" if part else suffix
+
+    def _part_items(self, video: Dict, pages: List[Dict]) -> List[Dict]:
+        """多P视频展开为每个分P一项（带该分P的cid、序号和标题），单P视频原样返回"""
+        if len(pages) <= 1:
+            return [video]
+        print(f"{video['bvid']} 共 {len(pages)} 个分P，全部下载")
+        return [
+            dict(video,
+                 cid=str(page['cid']),
+                 part_index=page.get('page') or idx,
+                 part=page.get('part', ''),
+                 part_count=len(pages),
+                 length=self._format_duration(page['duration']) if page.get('duration') else video.get('length'))
+            for idx, page in enumerate(pages, 1) if page.get('cid')
+        ]
+
+    def _expand_parts(self, videos: Iterable[Dict]) -> Iterator[Dict]:
+        """all_parts 模式：逐个展开视频的分P，列表项没有分P信息时请求view接口"""
+        for video in videos:
+            pages = video.get('pages') or self.get_video_pages(video['bvid']) or []
+            for item in self._part_items(video, pages):
+                yield item
+
+    def _resolve_download(self, video: Dict, reserve_budget: bool = True) -> Optional[Dict]:
+        """解析下载任务：获取cid和下载链接并选择音视频流，失败返回None，超出流量预算时抛出 BudgetExceededError"""
+        # 1. 获取视频的cid（列表中已带cid时不再请求view接口）
+        cid = video.get('cid')
+        if cid:
+            print(f"使用列表中的cid: {cid}")
+        else:
+            cid = self.get_video_cid(video['bvid'])
+            if not cid:
+                print(f"获取cid失败: {video['bvid']}")
+                return None
             
-            if success:
+            print(f"获取到cid: {cid}")
+        
+        # 2. 获取下载链接
+        download_data = self.get_video_download_url(video['bvid'], cid, self.quality)
+        if not download_data:
+            print(f"获取下载链接失败: {video['bvid']}")
+            return None
+        
+        job = self._build_job(video, cid, download_data)
+        if job and reserve_budget:
+            self._reserve_budget(job)
+        return job
+
+    def _reserve_budget(self, job: Dict):
+        """从流量预算中预留该任务的预计大小，预算不足时抛出 BudgetExceededError"""
+        if not self.byte_budget:
+            return
+        size = job.get('estimated_size') or 0
+        with self._budget_lock:
+            if self._budget_used + size > self.byte_budget:
+                raise BudgetExceededError(
+                    f"预计大小 {self._format_size(size)}，剩余预算 "
+                    f"{self._format_size(self.byte_budget - self._budget_used)}"
+                )
+            self._budget_used += size
+
+    def _print_plan(self, jobs: List[Dict]) -> int:
+        """打印下载计划，返回预计总字节数"""
+        total = 0
+        for idx, job in enumerate(jobs, 1):
+            size = job.get('estimated_size') or 0
+            total += size
+            stream = job.get('video_codecs') or job.get('audio_codecs') or job['mode']
+            print(f"{idx}. {job['video']['title']}{self._part_suffix(job['video'])} [{job.get('quality')} {stream}] 约 {self._format_size(size)}")
+        print(f"共 {len(jobs)} 个视频，预计 {self._format_size(total)}")
+        if self.byte_budget and total > self.byte_budget:
+            print(f"超出流量预算 {self._format_size(self.byte_budget)}，超出部分将被跳过")
+        return total
+
+    def plan_downloads(self, videos: Iterable[Dict]) -> List[Dict]:
+        """只解析下载链接不下载，打印每个视频选中的流和预计大小（playurl会进入缓存，随后下载时复用）"""
+        if self.all_parts:
+            videos = self._expand_parts(videos)
+        jobs = []
+        for video in videos:
+            if self.sync and self._is_downloaded(video):
+                continue
+            job = self._resolve_download(video, reserve_budget=False)
+            if job:
+                jobs.append(job)
+        self._print_plan(jobs)
+        return jobs
+
+    def _build_job(self, video: Dict, cid: str, download_data: Dict) -> Optional[Dict]:
+        """根据 playurl 数据选择音视频流，生成下载任务"""
+        base_filename = self._build_base_filename(video)
+        job = {'video': video, 'cid': cid, 'base_filename': base_filename}
+        if self.audio_only:
+            return self._resolve_audio_only(job, download_data)
+
+        final_filepath = os.path.join(self.download_dir, f"{base_filename}.mp4")
+        
+        # 3. 解析下载链接
+        if 'dash' in download_data and download_data['dash']:
+            # DASH格式 - 音视频分离
+            dash_data = download_data['dash']
+            
+            video_urls = []
+            audio_urls = []
+            
+            # 获取视频流
+            # 按 stream_policy 选择视频流（默认最高画质，优先id/height/带宽）
+            best_v = self.stream_policy.select_video(dash_data.get('video') or [])
+            if best_v:
+                video_urls = self._stream_urls(best_v)
+            
+            # 获取音频流（mp4 中只封装普通音频）
+            best_a = self.stream_policy.select_audio(dash_data, lossless=False)
+            if best_a:
+                audio_urls = self._stream_urls(best_a)
+            
+            if not video_urls:
+                print(f"未找到视频流: {video['bvid']}")
+                return None
+            
+            duration = self._media_duration(download_data)
+            estimated_size = StreamPolicy.estimate_size(best_v, duration)
+            if audio_urls:
+                estimated_size += StreamPolicy.estimate_size(best_a, duration)
+            job.update({'mode': 'dash', 'video_url': video_urls[0], 'video_backup_urls': video_urls[1:],
+                        'audio_url': audio_urls[0] if audio_urls else None, 'audio_backup_urls': audio_urls[1:],
+                        'quality': best_v.get('id'), 'video_codecs': best_v.get('codecs'),
+                        'output_file': final_filepath, 'estimated_size': estimated_size})
+        elif 'durl' in download_data and download_data['durl']:
+            # FLV格式 - 音视频一体
+            job.update({'mode': 'flv', 'video_url': download_data['durl'][0]['url'],
+                        'video_backup_urls': self._stream_urls(download_data['durl'][0])[1:],
+                        'quality': download_data.get('quality'), 'output_file': final_filepath,
+                        'estimated_size': download_data['durl'][0].get('size', 0)})
+        else:
+            print(f"未找到可用的下载链接: {video['bvid']}")
+            return None
+        return job
+
+    @timed('transfer')
+    @profiled(None, job_arg=True)
+    def _fetch_streams(self, job: Dict) -> bool:
+        """下载任务所需的音视频流，DASH流先写入临时文件（stream_merge 时直接送入ffmpeg）"""
+        os.makedirs(self.download_dir, exist_ok=True)
+        base_filename = job['base_filename']
+
+        if self._can_stream_merge(job):
+            if self._stream_merge(job):
+                job['merged'] = True
                 return True
+            print("边下载边合并失败，改为先下载到临时文件")
+
+        if job['mode'] == 'dash':
+            # 视频流和音频流来自相互独立的CDN地址，同时下载
+            video_temp_file = os.path.join(self.download_dir, f"{base_filename}_video.tmp")
+            audio_temp_file = None
+            if job['audio_url']:
+                audio_temp_file = os.path.join(self.download_dir, f"{base_filename}_audio.tmp")
+                print("同时下载视频流和音频流...")
             else:
+                print("下载视频流...")
+
+            with ThreadPoolExecutor(max_workers=2) as stream_pool:
+                download = self._inherit_span(self.download_video_file)
+                video_future = stream_pool.submit(download, job['video_url'], video_temp_file,
+                                                  job['video_backup_urls'])
+                audio_future = None
+                if job['audio_url']:
+                    audio_future = stream_pool.submit(download, job['audio_url'], audio_temp_file,
+                                                      job['audio_backup_urls'])
+                video_ok = video_future.result()
+                audio_ok = audio_future.result() if audio_future else False
+
+            if job['audio_url'] and not audio_ok:
+                print("音频下载失败，将保存无音频视频")
+                audio_temp_file = None
+            job['video_temp_file'] = video_temp_file
+            job['audio_temp_file'] = audio_temp_file
+            return video_ok
+
+        elif job['mode'] == 'audio':
+            job['audio_temp_file'] = os.path.join(self.download_dir, f"{base_filename}_audio.tmp")
+            print(f"下载音频流（{job['audio_codecs'] or '未知编码'}）...")
+            return self.download_video_file(job['audio_url'], job['audio_temp_file'], job['audio_backup_urls'])
+
+        elif job['mode'] == 'audio_flv':
+            job['video_temp_file'] = os.path.join(self.download_dir, f"{base_filename}_flv.tmp")
+            print("下载FLV格式视频（将从中提取音频）...")
+            return self.download_video_file(job['video_url'], job['video_temp_file'], job['video_backup_urls'])
+
+        print("下载FLV格式视频（包含音频）...")
+        return self.download_video_file(job['video_url'], job['output_file'], job['video_backup_urls'])
+
+    @timed('merge')
+    @profiled(None, job_arg=True)
+    def _finalize_download(self, job: Dict) -> bool:
+        """合并或封装已下载的流，生成最终文件"""
+        if job.get('merged'):
+            # 已在下载时由ffmpeg直接生成最终文件
+            return True
+        if job['mode'] == 'dash':
+            # 合并音视频
+            audio_temp_file = job['audio_temp_file']
+            if audio_temp_file and os.path.exists(audio_temp_file):
+                return self.merge_video_audio(job['video_temp_file'], audio_temp_file, job['output_file'])
+            # 只有视频，直接重命名
+            print("只保存视频文件（无音频）")
+            os.rename(job['video_temp_file'], job['output_file'])
+            return True
+
+        elif job['mode'] == 'audio':
+            if self.extract_audio(job['audio_temp_file'], job['output_file'], job['audio_container']):
+                return True
+            # DASH音频流本身就是MP4封装，没有ffmpeg时直接保存为 .m4a
+            job['output_file'] = os.path.join(self.download_dir, f"{job['base_filename']}.m4a")
+            os.replace(job['audio_temp_file'], job['output_file'])
+            print("已直接保存音频流（.m4a）")
+            return True
+
+        elif job['mode'] == 'audio_flv':
+            if self.extract_audio(job['video_temp_file'], job['output_file'], job['audio_container']):
+                return True
+            job['output_file'] = os.path.join(self.download_dir, f"{job['base_filename']}.flv")
+            os.replace(job['video_temp_file'], job['output_file'])
+            print("无法提取音频，已保存原始FLV文件")
+            return True
+
+        # FLV已直接下载为最终文件
+        return True
+
+    def _complete_download(self, job: Dict) -> bool:
+        """生成最终文件并写入下载清单"""
+        if not self._finalize_download(job):
+            return False
+        try:
+            output_file = job['output_file']
+            self.manifest.record({
+                'bvid': job['video']['bvid'],
+                'cid': job['cid'],
+                'page': job['video'].get('part_index', 1),
+                'part_count': job['video'].get('part_count') or len(job['video'].get('pages') or []) or 1,
+                'quality': job.get('quality'),
+                'size': os.path.getsize(output_file),
+                'output': output_file,
+                'sha256': DownloadManifest.file_checksum(output_file),
+                'timestamp': int(time.time())
+            })
+        except OSError as e:
+            print(f"写入下载清单失败 {job['video']['bvid']}: {e}")
+        return True
+
+    def _download_video(self, video: Dict) -> bool:
+        """下载单个视频（支持音视频分离格式）"""
+        try:
+            print(f"\n开始下载: {video['title']}")
+            
+            job = self._download_streams(video)
+            if not job:
                 return False
+            return self._complete_download(job)
             
+        except BudgetExceededError:
+            raise
         except Exception as e:
             print(f"下载视频 {video['title']} 时出错: {e}")
             return False
 
+    def _download_streams(self, video: Dict) -> Optional[Dict]:
+        """解析并下载单个视频的音视频流，返回待合并的任务，失败返回None"""
+        # 创建下载目录
+        os.makedirs(self.download_dir, exist_ok=True)
+        
+        job = self._resolve_download(video)
+        if not job or not self._fetch_streams(job):
+            return None
+        return job
+
+    def _print_video_header(self, idx: int, total: Optional[int], video: Dict):
+        """打印单个视频的处理信息"""
+        with self._print_lock:
+            if total:
+                print(f"\n===== 处理第 {idx}/{total} 个视频 =====")
+            else:
+                print(f"\n===== 处理第 {idx} 个视频 =====")
+            print(f"标题: {video['title']}")
+            print(f"BV号: {video['bvid']}")
+            if video.get('part_index'):
+                print(f"分P: {video['part_index']}/{video['part_count']} {video.get('part', '')}")
+            print(f"作者: {video['author']}")
+            print(f"时长: {video['length']}")
+
+    def _download_and_record(self, idx: int, video: Dict, stats: DownloadStats, merger: 'MergeWorkerPool'):
+        """下载单个视频的音视频流并交给合并线程池，下载失败时直接记录结果"""
+        try:
+            job = self._download_streams(video)
+        except BudgetExceededError as e:
+            print(f"- 第 {idx} 个视频超出流量预算，跳过（{e}）")
+            stats.record_skipped()
+            return
+        except Exception as e:
+            print(f"下载视频 {video.get('title')} 时出错: {e}")
+            job = None
+        if job:
+            merger.submit(idx, job)
+        else:
+            stats.record(False)
+            print(f"✗ 第 {idx} 个视频下载失败")
+
+    def download_videos(self, videos: Iterable[Dict], delay: float = 0) -> DownloadStats:
+        """批量下载视频，download_jobs > 1 时使用分阶段流水线并发下载
+
+        videos 可以是列表，也可以是 iter_user_videos 这样的生成器（边获取列表边下载）。
+        all_parts 为True时多P视频的每个分P作为单独一项并发下载，分别计入统计和下载清单。
+        """
+        if self.all_parts:
+            parts = self._expand_parts(videos)
+            videos = list(parts) if isinstance(videos, (list, tuple)) else parts
+        if self.sync:
+            if isinstance(videos, (list, tuple)):
+                videos = [video for video in videos if not self._is_downloaded(video)]
+            else:
+                videos = (video for video in videos if not self._is_downloaded(video))
+        total = len(videos) if isinstance(videos, (list, tuple)) else None
+
+        if self.download_jobs <= 1:
+            stats = DownloadStats(total or 0)
+            # 合并在独立的线程池中进行，当前视频的流下载完后立即开始下载下一个视频
+            merger = MergeWorkerPool(self, stats, self.merge_workers, self.pipeline_queue_size)
+            try:
+                for idx, video in enumerate(videos, 1):
+                    # 下载间隔
+                    if idx > 1 and delay:
+                        print(f"等待 {delay} 秒后继续下载...")
+                        time.sleep(delay)
+
+                    stats.total = max(stats.total, idx)
+                    self._print_video_header(idx, total, video)
+                    merger.wait_for(self._build_base_filename(video))
+                    self._download_and_record(idx, video, stats, merger)
+            finally:
+                merger.close()
+            self._save_sync_marks()
+            return stats
+
+        pipeline = DownloadPipeline(
+            self,
+            resolve_workers=self.resolve_workers,
+            download_workers=self.download_jobs,
+            merge_workers=self.merge_workers,
+            queue_size=self.pipeline_queue_size,
+            delay=delay
+        )
+        print(f"流水线下载模式：解析 {self.resolve_workers} / 下载 {self.download_jobs} / "
+              f"合并 {self.merge_workers} 个线程")
+        stats = pipeline.run(videos, total)
+        self._save_sync_marks()
+        return stats
+
+    def _is_synced(self, video: Dict) -> bool:
+        """列表中的视频是否已完整下载；all_parts 模式下要求列表给出的全部分P都在下载清单中"""
+        pages = video.get('pages') or []
+        if self.all_parts and pages:
+            return all(self.manifest.contains(video['bvid'], page['cid']) for page in pages)
+        return self.manifest.contains(video['bvid'])
+
+    def _is_downloaded(self, video: Dict) -> bool:
+        if self.manifest.contains(video['bvid'], video['cid'] if video.get('part_index') else None):
+            print(f"跳过已下载的视频: {video['bvid']}{self._part_suffix(video)} {video['title']}")
+            return True
+        return False
+
+    @timed('playurl')
+    @profiled('get_video_download_url', bvid_arg=True)
     def get_video_download_url(self, bvid: str, cid: str, quality: int = 127) -> Optional[Dict]:
-        """获取视频下载链接（请求最高画质，DASH优先）"""
+        """获取视频下载链接（请求最高画质，DASH优先，短时间内重复请求读缓存）"""
+        cache = self.cache
+        cache_key = f"{bvid}:{cid}:{quality}"
+        if cache:
+            cached = cache.get('playurl', cache_key)
+            if cached is not None:
+                print(f"使用缓存的下载链接: {bvid}")
+                return cached
         # 构建参数
         params = {
             'bvid': bvid,
@@ -640,18 +3101,18 @@ class BilibiliUserDownloader:
             'fnval': 4048,       # DASH + 杜比/8K等按位配置，4048涵盖常见组合
             'fourk': 1
         }
-        # WBI签名
-        query_string = self._encode_wbi(params)
-        url = f"https://api.bilibili.com/x/player/wbi/playurl?{query_string}"
+        url = f"{self.api_base}/x/player/wbi/playurl"
         headers = {
             'User-Agent': self.headers['User-Agent'],
             'Referer': f'https://www.bilibili.com/video/{bvid}',
             'Accept': 'application/json, text/plain, */*'
         }
         try:
-            response = self.session.get(url, headers=headers, timeout=15)
-            data = response.json()
+            # WBI签名
+            data = self._wbi_get('playurl', url, params, headers)
             if data.get('code') == 0:
+                if cache and data.get('data'):
+                    cache.set('playurl', cache_key, data['data'])
                 return data.get('data')
             else:
                 print(f"获取视频下载链接失败 {bvid}: {data}")
@@ -661,17 +3122,1140 @@ class BilibiliUserDownloader:
             return None
 
 
-def check_ffmpeg():
-    """检查ffmpeg是否可用"""
-    try:
-        import subprocess
-        subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
+class MergeWorkerPool:
+    """顺序下载时使用的合并线程池：下载线程把下载好的流交给它，随即开始下一个视频
+
+    线程数按CPU和磁盘能力单独配置；等待合并的任务数有上限，合并跟不上时下载线程阻塞，
+    临时文件不会无限堆积。
+    """
+
+    def __init__(self, downloader: 'BilibiliUserDownloader', stats: DownloadStats,
+                 workers: int = 1, backlog: int = 8):
+        self.downloader = downloader
+        self.stats = stats
+        workers = max(1, workers)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers + max(0, backlog))
+        # 输出文件名 -> 最近一个同名任务的合并结果
+        self._pending: Dict[str, object] = {}
+
+    def wait_for(self, name: str):
+        """同名输出文件必须按顺序生成，且临时文件名相同：先等前一个同名任务合并完成"""
+        future = self._pending.pop(name, None)
+        if future is not None:
+            wait([future])
+
+    def submit(self, idx: int, job: Dict):
+        self._slots.acquire()
+        # 已合并完成的任务不必再等待，移除记录，只保留尚未完成的（最多 workers + backlog 个）
+        for name in [name for name, future in self._pending.items() if future.done()]:
+            del self._pending[name]
+        self._pending[job['base_filename']] = self._executor.submit(self._merge, idx, job)
+
+    def _merge(self, idx: int, job: Dict):
+        try:
+            success = self.downloader._complete_download(job)
+        except Exception as e:
+            print(f"合并 {job['video']['title']} 时出错: {e}")
+            success = False
+        finally:
+            self._slots.release()
+        self.stats.record(success)
+        if success:
+            print(f"✓ 第 {idx} 个视频下载完成")
+        else:
+            print(f"✗ 第 {idx} 个视频下载失败")
+
+    def close(self):
+        """等待所有合并完成"""
+        self._executor.shutdown(wait=True)
+
+
+class DownloadPipeline:
+    """分阶段下载流水线：获取列表 → 解析cid/下载链接 → 下载音视频流 → 合并
+
+    阶段之间用有界队列衔接，队列满时上游阻塞（背压）；每个阶段有独立的线程数，
+    网络和ffmpeg在整个运行期间都能保持忙碌。
+    """
+
+    _DONE = object()
+
+    def __init__(self, downloader: 'BilibiliUserDownloader', resolve_workers: int = 2,
+                 download_workers: int = 4, merge_workers: int = 1, queue_size: int = 8,
+                 delay: float = 0):
+        self.downloader = downloader
+        self.resolve_workers = max(1, resolve_workers)
+        self.download_workers = max(1, download_workers)
+        self.merge_workers = max(1, merge_workers)
+        self.delay = delay
+        self.resolve_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.download_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.merge_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.stats = DownloadStats()
+        self.total: Optional[int] = None
+        # 输出文件名 -> 最近一个同名任务的完成事件，任务完成后移除
+        self._pending: Dict[str, threading.Event] = {}
+        self._pending_lock = threading.Lock()
+
+    def run(self, videos: Iterable[Dict], total: Optional[int] = None) -> DownloadStats:
+        """在调用线程中获取列表并送入流水线，全部完成后返回统计"""
+        self.total = total
+        self.stats.total = total or 0
+        stages = [
+            (self.resolve_queue, self.resolve_workers, self._resolve_stage),
+            (self.download_queue, self.download_workers, self._download_stage),
+            (self.merge_queue, self.merge_workers, self._merge_stage),
+        ]
+        workers = []
+        for stage_queue, count, handler in stages:
+            threads = [threading.Thread(target=self._worker, args=(stage_queue, handler), daemon=True)
+                       for _ in range(count)]
+            for thread in threads:
+                thread.start()
+            workers.append(threads)
+
+        self._produce(videos)
+
+        # 上游阶段的线程全部退出后，再通知下游阶段结束
+        for (stage_queue, count, _), threads in zip(stages, workers):
+            for _ in range(count):
+                stage_queue.put(self._DONE)
+            for thread in threads:
+                thread.join()
+        return self.stats
+
+    def _produce(self, videos: Iterable[Dict]):
+        """列表阶段：逐个送入解析队列，队列满时暂停获取后续页面"""
+        for idx, video in enumerate(videos, 1):
+            self.stats.total = max(self.stats.total, idx)
+            name = self.downloader._build_base_filename(video)
+            with self._pending_lock:
+                previous = self._pending.get(name)
+            if previous is not None:
+                # 同名输出文件必须按原顺序生成，与顺序下载的覆盖结果保持一致
+                previous.wait()
+            done = threading.Event()
+            with self._pending_lock:
+                self._pending[name] = done
+            self.resolve_queue.put({'idx': idx, 'video': video, 'name': name, 'done': done})
+
+    def _worker(self, stage_queue: queue.Queue, handler):
+        while True:
+            item = stage_queue.get()
+            if item is self._DONE:
+                return
+            try:
+                handler(item)
+            except Exception as e:
+                print(f"下载视频 {item['video'].get('title')} 时出错: {e}")
+                self._finish(item, False)
+
+    def _resolve_stage(self, item: Dict):
+        self.downloader._print_video_header(item['idx'], self.total, item['video'])
+        try:
+            job = self.downloader._resolve_download(item['video'])
+        except BudgetExceededError as e:
+            print(f"- 第 {item['idx']} 个视频超出流量预算，跳过（{e}）")
+            self.stats.record_skipped()
+            self._release(item)
+            return
+        if self.delay:
+            time.sleep(self.delay)
+        if not job:
+            self._finish(item, False)
+            return
+        item['job'] = job
+        self.download_queue.put(item)
+
+    def _download_stage(self, item: Dict):
+        if not self.downloader._fetch_streams(item['job']):
+            self._finish(item, False)
+            return
+        self.merge_queue.put(item)
+
+    def _merge_stage(self, item: Dict):
+        self._finish(item, self.downloader._complete_download(item['job']))
+
+    def _finish(self, item: Dict, success: bool):
+        self.stats.record(success)
+        if success:
+            print(f"✓ 第 {item['idx']} 个视频下载完成")
+        else:
+            print(f"✗ 第 {item['idx']} 个视频下载失败")
+        self._release(item)
+
+    def _release(self, item: Dict):
+        """通知等待同名文件的后续任务；没有后续任务时移除记录，监视模式长时间运行也不会一直增长"""
+        with self._pending_lock:
+            if self._pending.get(item['name']) is item['done']:
+                del self._pending[item['name']]
+        item['done'].set()
+
+
+class CreatorWatcher:
+    """监视模式：常驻进程，定时轮询各用户投稿列表的第一页，只把新视频交给下载器
+
+    整个运行期间复用同一个下载器，HTTP会话、WBI密钥和元数据缓存都保持可用，不必每次重新启动进程。
+    每个用户的轮询间隔按投稿频率调整：以最近投稿平均间隔的 1/4 为基准，连续没有新视频时逐渐放宽，
+    限制在 [min_interval, max_interval] 之间，并加入随机抖动，避免多个用户的请求集中在同一时刻。
+    下载在独立线程中进行（沿用 download_videos 的流水线），轮询不会被下载阻塞。
+    """
+
+    def __init__(self, downloader: 'BilibiliUserDownloader', user_ids: List[str], bvids: List[str] = (),
+                 min_interval: float = 300, max_interval: float = 6 * 3600, jitter: float = 0.2):
+        self.downloader = downloader
+        self.bvids = list(bvids)
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.jitter = jitter
+        self.retry_after = 3600  # 已排队但仍未出现在下载清单中（下载失败）的视频，多久后重新排队
+        now = time.monotonic()
+        self.creators: Dict[str, Dict] = {
+            user_id: {'interval': min_interval, 'next_poll': now, 'idle_polls': 0, 'found': 0}
+            for user_id in user_ids
+        }
+        self.stats = DownloadStats()
+        self._queued: Dict[str, tuple] = {}  # bvid -> (排队时间, 视频)
+        self._queue: queue.Queue = queue.Queue()
+        self._stop = threading.Event()
+
+    def run(self) -> DownloadStats:
+        """开始监视，直到 stop() 或按 Ctrl+C；已排队的视频下载完成后返回累计统计"""
+        worker = threading.Thread(target=self._download_loop, name='watch-download', daemon=True)
+        worker.start()
+        print(f"监视模式：跟踪 {len(self.creators)} 个用户，轮询间隔 {self.min_interval / 60:g} ~ "
+              f"{self.max_interval / 60:g} 分钟（Ctrl+C 停止）")
+        try:
+            for video in self.downloader._iter_bvid_videos(self.bvids):
+                self._enqueue(video)
+            while not self._stop.is_set():
+                self._poll_due()
+                self._stop.wait(self._seconds_until_next_poll())
+        except KeyboardInterrupt:
+            print("\n停止监视，等待已排队的视频下载完成（再按 Ctrl+C 立即退出）...")
+        self._stop.set()
+        self._queue.put(None)
+        worker.join()
+        return self.stats
+
+    def stop(self):
+        self._stop.set()
+
+    def _download_loop(self):
+        self.stats = self.downloader.download_videos(self._iter_queue())
+
+    def _iter_queue(self) -> Iterator[Dict]:
+        while True:
+            video = self._queue.get()
+            if video is None:
+                return
+            yield video
+
+    def _seconds_until_next_poll(self) -> float:
+        if not self.creators:
+            return self.max_interval
+        next_poll = min(state['next_poll'] for state in self.creators.values())
+        return max(0.0, next_poll - time.monotonic())
+
+    def _poll_due(self):
+        self._prune_queued()
+        for user_id, state in self.creators.items():
+            if self._stop.is_set():
+                return
+            if state['next_poll'] > time.monotonic():
+                continue
+            videos = self.downloader.get_latest_videos(user_id)
+            new_count = sum(self._enqueue(video) for video in videos)
+            self._schedule(state, videos, new_count)
+            minutes = (state['next_poll'] - time.monotonic()) / 60
+            print(f"[监视] 用户 {user_id}: 新视频 {new_count} 个，下次轮询约 {minutes:.0f} 分钟后")
+
+    def _enqueue(self, video: Dict) -> bool:
+        """新视频（不在下载清单中，且没有刚排过队）加入下载队列，返回是否加入"""
+        bvid = video['bvid']
+        queued_at, _ = self._queued.get(bvid, (None, None))
+        now = time.monotonic()
+        if queued_at is not None and now - queued_at < self.retry_after:
+            return False
+        if self.downloader._is_synced(video):
+            return False
+        self._queued[bvid] = (now, video)
+        self._queue.put(video)
         return True
-    except (subprocess.CalledProcessError, FileNotFoundError):
+
+    def _prune_queued(self):
+        """移除已下载完成或已超过 retry_after 的排队记录，之后由下载清单判断是否需要下载"""
+        now = time.monotonic()
+        for bvid, (queued_at, video) in list(self._queued.items()):
+            if now - queued_at >= self.retry_after or self.downloader._is_synced(video):
+                del self._queued[bvid]
+
+    def _schedule(self, state: Dict, videos: List[Dict], new_count: int):
+        """根据投稿频率和本次是否有新视频安排下次轮询"""
+        import random
+
+        times = sorted((video['created'] for video in videos if video.get('created')), reverse=True)[:10]
+        if len(times) >= 2 and times[0] > times[-1]:
+            interval = (times[0] - times[-1]) / (len(times) - 1) / 4
+        else:
+            interval = self.max_interval
+        if new_count:
+            state['idle_polls'] = 0
+            state['found'] += new_count
+        else:
+            state['idle_polls'] += 1
+            interval *= 1.5 ** min(state['idle_polls'], 6)
+        interval = min(self.max_interval, max(self.min_interval, interval))
+        state['interval'] = interval
+        state['next_poll'] = time.monotonic() + interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class AsyncBilibiliUserDownloader(BilibiliUserDownloader):
+    """基于 asyncio + aiohttp 的下载后端，公开方法与 BilibiliUserDownloader 同名，但都是协程
+
+    所有请求在一个事件循环中完成，不再是一个连接一个线程；同时下载的视频数由信号量限制，
+    连接总数由连接池限制。合并仍调用ffmpeg，在独立的线程池中执行，不阻塞事件循环。
+
+        async with AsyncBilibiliUserDownloader(cookie) as downloader:
+            stats = await downloader.download_videos(downloader.iter_user_videos(user_id))
+    """
+
+    def __init__(self, cookie_string: str = None):
+        if aiohttp is None:
+            raise RuntimeError("异步下载后端需要安装aiohttp: pip install aiohttp")
+        super().__init__(cookie_string)
+        self.max_connections = 32  # 事件循环中同时打开的连接数上限
+        self.write_buffer_size = 2 * 1024 * 1024  # 响应数据攒够这么多字节后在线程池中写盘，不阻塞事件循环
+        self.http = None
+        self._merge_pool: Optional[ThreadPoolExecutor] = None
+        self._wbi_async_lock: Optional[asyncio.Lock] = None
+
+    async def __aenter__(self):
+        # 沿用同步会话中设置好的cookie（用户提供或指纹cookie）
+        cookies = {cookie.name: cookie.value for cookie in self.session.cookies}
+        self.http = aiohttp.ClientSession(
+            headers=self.headers,
+            cookies=cookies,
+            connector=aiohttp.TCPConnector(limit=self.max_connections)
+        )
+        self._merge_pool = ThreadPoolExecutor(max_workers=max(1, self.merge_workers))
+        self._wbi_async_lock = asyncio.Lock()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.http.close()
+        self._merge_pool.shutdown(wait=True)
+
+    async def _api_get(self, endpoint: str, url: str, headers: Dict, timeout: float = 15) -> tuple:
+        """经限速器发送API请求，返回 (状态码, JSON数据)；被限流时退避后重试"""
+        bucket = self.rate_limiter.bucket(endpoint)
+        for _ in range(self.max_retries + 1):
+            await bucket.acquire_async()
+            async with self.http.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                status = response.status
+                body = await response.read()
+            try:
+                data = json.loads(body)
+            except ValueError:
+                data = None
+            self.metrics.record_status(endpoint, status, self._api_code(data))
+            if not RateLimiter.is_throttled(status, data):
+                if status == 200:
+                    bucket.on_success()
+                return status, data
+            self.metrics.count('api_throttled')
+            backoff = bucket.on_throttle()
+            print(f"请求被限流（{endpoint}，状态码 {status}），"
+                  f"{backoff:.1f} 秒后重试，速率降至 {bucket.rate:.2f} 次/秒")
+        return status, data
+
+    @timed('wbi_init')
+    async def init_wbi_keys(self, force_refresh: bool = False):
+        if not force_refresh and self._load_cached_wbi_keys():
+            return True
+        try:
+            status, data = await self._api_get('nav', self.api_base + self.NAV_PATH, self._nav_headers(), timeout=10)
+            print(f"WBI初始化响应状态: {status}")
+            if status != 200:
+                print(f"WBI初始化失败，状态码: {status}")
+                return False
+            return self._apply_nav_data(data)
+        except Exception as e:
+            print(f"WBI密钥初始化错误: {e}")
+            return False
+
+    async def _refresh_wbi_keys(self, stale_mixin_key: Optional[str]) -> bool:
+        async with self._wbi_async_lock:
+            if self.mixin_key and self.mixin_key != stale_mixin_key:
+                return True
+            print("WBI签名被拒绝，重新获取密钥...")
+            return await self.init_wbi_keys(force_refresh=True)
+
+    def _encode_wbi(self, params: dict) -> str:
+        # 密钥由 _wbi_get 在事件循环中加载；这里的 init_wbi_keys 是协程，不能在签名时调用
+        if not self.mixin_key:
+            raise RuntimeError("WBI密钥不可用")
+        return super()._encode_wbi(params)
+
+    async def _wbi_get(self, endpoint: str, url: str, params: dict, headers: dict, timeout: float = 15) -> Dict:
+        if not self.mixin_key:
+            # 先在事件循环中加载密钥，_encode_wbi 就不会发起同步请求
+            async with self._wbi_async_lock:
+                if not self.mixin_key:
+                    await self.init_wbi_keys()
+        for attempt in range(2):
+            mixin_key = self.mixin_key
+            query_string = self._encode_wbi(dict(params))
+            status, data = await self._api_get(endpoint, f"{url}?{query_string}", headers, timeout)
+            if data is None:
+                raise ValueError(f"接口返回非JSON内容，状态码 {status}")
+            if attempt or data.get('code') not in self.WBI_RETRY_CODES:
+                return data
+            self.metrics.count('wbi_rejected')
+            if not await self._refresh_wbi_keys(mixin_key):
+                return data
+        return data
+
+    @timed('medialist_info')
+    async def _get_medialist_info(self, user_id: str) -> Optional[Dict]:
+        cache = self.cache
+        if cache:
+            cached = cache.get('medialist_info', str(user_id))
+            if cached is not None:
+                print(f"使用缓存的Medialist信息: {user_id}")
+                return cached
+
+        info_url = f"{self.api_base}/x/v1/medialist/info?type=1&tid=0&biz_id={user_id}"
+        print(f"正在获取Medialist信息: {info_url}")
+        status, data = await self._api_get('medialist', info_url, self._medialist_headers())
+        print(f"Medialist信息响应状态: {status}")
+        if status != 200:
+            print(f"Medialist信息获取失败，状态码: {status}")
+            return None
+        if data['code'] != 0:
+            print(f"Medialist信息获取失败: {data}")
+            return None
+
+        if cache:
+            cache.set('medialist_info', str(user_id), data['data'])
+        return data['data']
+
+    async def get_user_info_from_medialist(self, user_id: str) -> Optional[Dict]:
+        try:
+            medialist_data = await self._get_medialist_info(user_id)
+            if not medialist_data:
+                return None
+            return self._user_info_from_medialist(medialist_data)
+        except Exception as e:
+            print(f"Medialist获取用户信息错误: {e}")
+            return None
+
+    async def _request_medialist_resource(self, user_id: str, page_size: int, oid: str) -> Optional[Dict]:
+        resource_url = self._medialist_resource_url(user_id, page_size, oid)
+        print(f"正在获取视频列表: {resource_url}")
+        status, data = await self._api_get('medialist', resource_url, self._medialist_headers())
+        print(f"Medialist视频列表响应状态: {status}")
+        if status != 200:
+            print(f"Medialist视频列表获取失败，状态码: {status}")
+            return None
+        if data['code'] != 0:
+            print(f"Medialist视频列表获取失败: {data}")
+            return None
+        return data['data']
+
+    @timed('medialist_page')
+    async def _fetch_medialist_page(self, user_id: str, page_size: int = 20, oid: str = '') -> tuple:
+        try:
+            if not oid and not await self._get_medialist_info(user_id):
+                return [], None
+
+            endpoint = 'medialist_page' if oid else 'medialist_first'
+            cache_key = f"{user_id}:{oid}:{page_size}"
+            cache = self.cache
+            list_data = cache.get(endpoint, cache_key) if cache else None
+            if list_data is not None:
+                print(f"使用缓存的视频列表: {cache_key}")
+            else:
+                list_data = await self._request_medialist_resource(user_id, page_size, oid)
+                if list_data is None:
+                    return [], None
+                if cache:
+                    cache.set(endpoint, cache_key, list_data)
+            return self._parse_medialist_page(list_data, page_size)
+        except Exception as e:
+            print(f"Medialist获取视频列表错误: {e}")
+            return [], None
+
+    async def iter_user_video_pages(self, user_id: str, max_count: int = None, page_size: int = 20):
+        cursor = MedialistCursor(self, user_id, max_count, page_size)
+        while not cursor.done:
+            videos, has_more = await self._fetch_medialist_page(user_id, page_size, cursor.oid)
+            videos = cursor.accept(videos, has_more)
+            if videos:
+                yield videos
+        cursor.finish()
+
+    async def iter_user_videos(self, user_id: str, max_count: int = None):
+        async for videos in self.iter_user_video_pages(user_id, max_count):
+            for video in videos:
+                yield video
+
+    async def iter_batch_videos(self, user_ids: List[str], bvids: List[str] = (), max_count: int = None):
+        sources = [self.iter_user_videos(user_id, max_count) for user_id in user_ids]
+        if bvids:
+            sources.insert(0, self._iter_bvid_videos(bvids))
+        while sources:
+            for source in list(sources):
+                try:
+                    video = await source.__anext__()
+                except StopAsyncIteration:
+                    sources.remove(source)
+                else:
+                    yield video
+
+    async def _iter_bvid_videos(self, bvids: Iterable[str]):
+        for bvid in bvids:
+            video = await self.get_video_info(bvid)
+            if video:
+                yield video
+
+    async def get_all_user_videos(self, user_id: str, max_count: int = None) -> List[Dict]:
+        all_videos: List[Dict] = []
+        async for videos in self.iter_user_video_pages(user_id, max_count):
+            all_videos.extend(videos)
+        return all_videos
+
+    @timed('view')
+    async def get_video_info(self, bvid: str) -> Optional[Dict]:
+        try:
+            url, headers = self._view_request(bvid)
+            status, data = await self._api_get('view', url, headers)
+            if status == 200 and data.get('code') == 0:
+                return self._parse_view(data['data'])
+            print(f"获取视频信息失败 {bvid}: 状态码 {status}")
+        except Exception as e:
+            print(f"获取视频信息失败 {bvid}: {e}")
+        return None
+
+    @timed('view')
+    async def get_video_pages(self, bvid: str) -> Optional[List[Dict]]:
+        cache = self.cache
+        if cache:
+            pages = cache.get('view', bvid)
+            if pages is not None:
+                return pages
+        try:
+            url, headers = self._view_request(bvid)
+            status, data = await self._api_get('view', url, headers)
+            if status == 200 and data.get('code') == 0:
+                pages = data.get('data', {}).get('pages', [])
+                if pages:
+                    if cache:
+                        cache.set('view', bvid, pages)
+                    return pages
+            print(f"获取视频分P信息失败 {bvid}: 状态码 {status}")
+            return None
+        except Exception as e:
+            print(f"获取视频分P信息失败 {bvid}: {e}")
+            return None
+
+    @profiled('get_video_cid', bvid_arg=True)
+    async def get_video_cid(self, bvid: str) -> Optional[str]:
+        pages = await self.get_video_pages(bvid)
+        if pages:
+            return str(pages[0].get('cid'))
+        print(f"获取视频cid失败 {bvid}")
+        return None
+
+    @timed('playurl')
+    @profiled('get_video_download_url', bvid_arg=True)
+    async def get_video_download_url(self, bvid: str, cid: str, quality: int = 127) -> Optional[Dict]:
+        cache = self.cache
+        cache_key = f"{bvid}:{cid}:{quality}"
+        if cache:
+            cached = cache.get('playurl', cache_key)
+            if cached is not None:
+                print(f"使用缓存的下载链接: {bvid}")
+                return cached
+        params = {'bvid': bvid, 'cid': cid, 'qn': quality, 'fnver': 0, 'fnval': 4048, 'fourk': 1}
+        headers = {
+            'User-Agent': self.headers['User-Agent'],
+            'Referer': f'https://www.bilibili.com/video/{bvid}',
+            'Accept': 'application/json, text/plain, */*'
+        }
+        try:
+            data = await self._wbi_get('playurl', f"{self.api_base}/x/player/wbi/playurl", params, headers)
+            if data.get('code') == 0:
+                if cache and data.get('data'):
+                    cache.set('playurl', cache_key, data['data'])
+                return data.get('data')
+            print(f"获取视频下载链接失败 {bvid}: {data}")
+            return None
+        except Exception as e:
+            print(f"获取视频下载链接错误 {bvid}: {e}")
+            return None
+
+    @profiled('download_video_file')
+    async def download_video_file(self, url: str, filename: str, backup_urls: List[str] = None) -> bool:
+        """下载视频文件（分段并行、断点续传、镜像测速与切换，状态文件与线程后端通用）"""
+        headers = {
+            'User-Agent': self.headers['User-Agent'],
+            'Referer': 'https://www.bilibili.com/',
+            'Range': 'bytes=0-'
+        }
+        state_file = filename + '.state'
+        state = DownloadState.load(state_file, url)
+        if state and (not os.path.exists(filename) or os.path.getsize(filename) != state.total_size):
+            state = None
+        mirrors = MirrorSet(await self._rank_mirrors(self._unique_urls([url] + list(backup_urls or []))))
+
+        failures = 0
+        while failures < self.max_retries:
+            progress_before = state.downloaded if state else 0
+            mirror_url = mirrors.current()
+            try:
+                if failures > 0:
+                    wait_time = min(30, 2 ** failures * 2)
+                    print(f"重试第 {failures + 1} 次，等待 {wait_time} 秒...")
+                    await asyncio.sleep(wait_time)
+
+                if state:
+                    print(f"继续下载: {filename}（已完成 {state.downloaded}/{state.total_size}）")
+                    await self._download_missing(mirrors, filename, state)
+                else:
+                    print(f"正在下载: {filename}")
+                    async with self.http.get(mirror_url, headers=headers,
+                                             timeout=aiohttp.ClientTimeout(sock_read=60)) as response:
+                        if response.status in [200, 206]:
+                            total_size = response.content_length or 0
+                            if total_size <= 0:
+                                await self._write_unsized(response, filename)
+                                self.progress.finish(filename)
+                                print(f"\n✓ 下载完成: {filename}")
+                                return True
+
+                            content_range = response.headers.get('content-range', '')
+                            accept_ranges = (response.status == 206 and content_range.startswith('bytes 0-')
+                                             and content_range.endswith(f"/{total_size}"))
+                            state = DownloadState(state_file, DownloadState.url_identity(url), total_size,
+                                                  accept_ranges=accept_ranges)
+                            with open(filename, 'wb') as f:
+                                f.truncate(total_size)
+                            state.save(force=True)
+
+                            if len(self._split_ranges(state)) == 1:
+                                await self._write_response(response, filename, 0, total_size - 1, state,
+                                                           can_switch=len(mirrors.urls) > 1)
+                        else:
+                            print(f"下载失败，状态码: {response.status}")
+                            mirrors.switch(mirror_url)
+                    if state and len(self._split_ranges(state)) > 1:
+                        await self._download_missing(mirrors, filename, state)
+
+                if state and self._validate_download(filename, state):
+                    state.remove()
+                    self.progress.finish(filename)
+                    print(f"\n✓ 下载完成: {filename}")
+                    return True
+            except RestartDownloadError as e:
+                print(f"\n{e}，从头重新下载")
+                state.remove()
+                state = None
+            except SlowMirrorError as e:
+                print(f"\n{e}")
+                self.metrics.count('slow_mirror')
+                mirrors.switch(mirror_url)
+            except Exception as e:
+                print(f"\n下载文件时出错(尝试 {failures + 1}/{self.max_retries}): {e}")
+                self.metrics.count('transfer_errors')
+                mirrors.switch(mirror_url)
+
+            if state and state.downloaded > progress_before:
+                continue
+            failures += 1
+        self.progress.finish(filename, success=False)
         return False
 
-def main():
-    """B站用户视频批量下载器主函数"""
+    async def _rank_mirrors(self, urls: List[str]) -> List[str]:
+        if len(urls) <= 1 or self.mirror_probe_size <= 0:
+            return urls
+        finished = asyncio.Event()
+        speeds = await asyncio.gather(*(self._probe_mirror(url, finished) for url in urls))
+        return self._order_by_speed(urls, list(speeds))
+
+    async def _probe_mirror(self, url: str, finished: asyncio.Event) -> float:
+        headers = {
+            'User-Agent': self.headers['User-Agent'],
+            'Referer': 'https://www.bilibili.com/',
+            'Range': f'bytes=0-{self.mirror_probe_size - 1}'
+        }
+        start = time.monotonic()
+        received = 0
+        try:
+            async with self.http.get(url, headers=headers,
+                                     timeout=aiohttp.ClientTimeout(sock_read=self.mirror_probe_timeout)) as response:
+                if response.status not in (200, 206):
+                    return 0.0
+                async for chunk in response.content.iter_chunked(16 * 1024):
+                    received += len(chunk)
+                    if received >= self.mirror_probe_size:
+                        finished.set()
+                        break
+                    if finished.is_set() or time.monotonic() - start > self.mirror_probe_timeout:
+                        break
+        except Exception:
+            return 0.0
+        return received / max(time.monotonic() - start, 1e-6)
+
+    async def _download_missing(self, mirrors: MirrorSet, filename: str, state: 'DownloadState'):
+        ranges = self._split_ranges(state)
+        workers = min(self.download_segments, len(ranges))
+        if workers > 1:
+            remaining = sum(end - start + 1 for start, end in ranges)
+            print(f"分段下载: {workers} 个连接，剩余 {remaining}/{state.total_size} 字节")
+        segment_sem = asyncio.Semaphore(max(1, workers))
+
+        async def fetch(start: int, end: int):
+            async with segment_sem:
+                return await self._download_range(mirrors, filename, start, end, state)
+
+        # 等所有分段结束后再抛出异常，避免还有分段在写文件时就重新开始下载
+        results = await asyncio.gather(*(fetch(start, end) for start, end in ranges), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def _download_range(self, mirrors: MirrorSet, filename: str, start: int, end: int,
+                              state: 'DownloadState') -> bool:
+        for _ in range(len(mirrors.urls)):
+            pos = state.next_missing(start, end)
+            if pos is None:
+                return True
+            url = mirrors.current()
+            headers = {
+                'User-Agent': self.headers['User-Agent'],
+                'Referer': 'https://www.bilibili.com/',
+                'Range': f'bytes={pos}-{end}'
+            }
+            try:
+                async with self.http.get(url, headers=headers,
+                                         timeout=aiohttp.ClientTimeout(sock_read=60)) as response:
+                    self._check_range_response(response.status, response.headers.get('content-range', ''),
+                                               pos, end, state, mirrors, url)
+                    await self._write_response(response, filename, pos, end, state,
+                                               can_switch=len(mirrors.urls) > 1)
+            except RestartDownloadError:
+                raise
+            except SlowMirrorError as e:
+                print(f"\n分段 {pos}-{end}: {e}")
+                self.metrics.count('slow_mirror')
+                mirrors.switch(url)
+            except Exception as e:
+                print(f"\n分段 {pos}-{end} 下载出错: {e}")
+                self.metrics.count('transfer_errors')
+                if not mirrors.switch(url):
+                    return False
+        return state.next_missing(start, end) is None
+
+    async def _write_response(self, response, filename: str, start: int, end: int, state: 'DownloadState',
+                              can_switch: bool = False):
+        monitor = ThroughputMonitor(self.min_mirror_speed if can_switch else 0, self.mirror_check_interval)
+        loop = asyncio.get_running_loop()
+        pos = start  # 已写入文件的位置
+        buffer = bytearray()
+        started = time.monotonic()
+
+        async def flush():
+            nonlocal pos
+            if buffer:
+                data = bytes(buffer)
+                buffer.clear()
+                await loop.run_in_executor(None, self._write_block, f, pos, data, state)
+                pos += len(data)
+
+        f = await loop.run_in_executor(None, open, filename, 'r+b')
+        try:
+            async for chunk in response.content.iter_chunked(1024 * 512):
+                chunk = chunk[:end + 1 - pos - len(buffer)]
+                buffer += chunk
+                self.progress.update(filename, state.downloaded + len(buffer), state.total_size)
+                if pos + len(buffer) > end:
+                    break
+                if len(buffer) >= self.write_buffer_size:
+                    await flush()
+                monitor.update(len(chunk))
+        finally:
+            # 出错或切换镜像时已收到的数据同样有效，写盘后再记录断点
+            try:
+                await flush()
+            finally:
+                await loop.run_in_executor(None, f.close)
+                await loop.run_in_executor(None, functools.partial(state.save, force=True))
+                self.metrics.record_transfer(response.url, pos - start, time.monotonic() - started)
+
+    @staticmethod
+    def _write_block(f, offset: int, data: bytes, state: 'DownloadState'):
+        """在线程池中写入一段数据并更新断点状态"""
+        f.seek(offset)
+        f.write(data)
+        f.flush()
+        state.add(offset, len(data))
+        state.save()
+
+    async def _write_unsized(self, response, filename: str):
+        """服务器未返回文件大小，无法续传，按顺序整体写入；写盘同样在线程池中进行"""
+        loop = asyncio.get_running_loop()
+        buffer = bytearray()
+        written = 0
+        f = await loop.run_in_executor(None, open, filename, 'wb')
+        try:
+            async for chunk in response.content.iter_chunked(1024 * 512):
+                buffer += chunk
+                self.progress.update(filename, written + len(buffer))
+                if len(buffer) >= self.write_buffer_size:
+                    data = bytes(buffer)
+                    buffer.clear()
+                    await loop.run_in_executor(None, f.write, data)
+                    written += len(data)
+            if buffer:
+                await loop.run_in_executor(None, f.write, bytes(buffer))
+        finally:
+            await loop.run_in_executor(None, f.close)
+
+    async def _resolve_download(self, video: Dict, reserve_budget: bool = True) -> Optional[Dict]:
+        cid = video.get('cid')
+        if cid:
+            print(f"使用列表中的cid: {cid}")
+        else:
+            cid = await self.get_video_cid(video['bvid'])
+            if not cid:
+                print(f"获取cid失败: {video['bvid']}")
+                return None
+            print(f"获取到cid: {cid}")
+
+        download_data = await self.get_video_download_url(video['bvid'], cid, self.quality)
+        if not download_data:
+            print(f"获取下载链接失败: {video['bvid']}")
+            return None
+        job = self._build_job(video, cid, download_data)
+        if job and reserve_budget:
+            self._reserve_budget(job)
+        return job
+
+    async def plan_downloads(self, videos) -> List[Dict]:
+        if self.all_parts:
+            videos = self._expand_parts(self._iterate(videos))
+        jobs = []
+        async for video in self._iterate(videos):
+            if self.sync and self._is_downloaded(video):
+                continue
+            job = await self._resolve_download(video, reserve_budget=False)
+            if job:
+                jobs.append(job)
+        self._print_plan(jobs)
+        return jobs
+
+    @timed('transfer')
+    @profiled(None, job_arg=True)
+    async def _fetch_streams(self, job: Dict) -> bool:
+        os.makedirs(self.download_dir, exist_ok=True)
+        base_filename = job['base_filename']
+
+        if self._can_stream_merge(job):
+            # 写管道是阻塞操作，在线程中进行，不阻塞事件循环
+            loop = asyncio.get_event_loop()
+            if await loop.run_in_executor(None, self._stream_merge, job):
+                job['merged'] = True
+                return True
+            print("边下载边合并失败，改为先下载到临时文件")
+
+        if job['mode'] == 'dash':
+            video_temp_file = os.path.join(self.download_dir, f"{base_filename}_video.tmp")
+            audio_temp_file = None
+            downloads = [self.download_video_file(job['video_url'], video_temp_file, job['video_backup_urls'])]
+            if job['audio_url']:
+                audio_temp_file = os.path.join(self.download_dir, f"{base_filename}_audio.tmp")
+                downloads.append(self.download_video_file(job['audio_url'], audio_temp_file,
+                                                          job['audio_backup_urls']))
+                print("同时下载视频流和音频流...")
+            else:
+                print("下载视频流...")
+            results = await asyncio.gather(*downloads)
+            if job['audio_url'] and not results[1]:
+                print("音频下载失败，将保存无音频视频")
+                audio_temp_file = None
+            job['video_temp_file'] = video_temp_file
+            job['audio_temp_file'] = audio_temp_file
+            return results[0]
+
+        elif job['mode'] == 'audio':
+            job['audio_temp_file'] = os.path.join(self.download_dir, f"{base_filename}_audio.tmp")
+            print(f"下载音频流（{job['audio_codecs'] or '未知编码'}）...")
+            return await self.download_video_file(job['audio_url'], job['audio_temp_file'], job['audio_backup_urls'])
+
+        elif job['mode'] == 'audio_flv':
+            job['video_temp_file'] = os.path.join(self.download_dir, f"{base_filename}_flv.tmp")
+            print("下载FLV格式视频（将从中提取音频）...")
+            return await self.download_video_file(job['video_url'], job['video_temp_file'], job['video_backup_urls'])
+
+        print("下载FLV格式视频（包含音频）...")
+        return await self.download_video_file(job['video_url'], job['output_file'], job['video_backup_urls'])
+
+    async def _download_video(self, video: Dict) -> bool:
+        """下载单个视频；合并在线程池中进行，不占用下载名额"""
+        job = None
+        try:
+            print(f"\n开始下载: {video['title']}")
+            os.makedirs(self.download_dir, exist_ok=True)
+            job = await self._resolve_download(video)
+            if not job or not await self._fetch_streams(job):
+                return False
+        except Exception as e:
+            print(f"下载视频 {video['title']} 时出错: {e}")
+            return False
+        return await self._merge(job)
+
+    async def _merge(self, job: Dict) -> bool:
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(self._merge_pool, self._complete_download, job)
+        except Exception as e:
+            print(f"合并 {job['video']['title']} 时出错: {e}")
+            return False
+
+    async def download_videos(self, videos, delay: float = 0) -> DownloadStats:
+        """批量下载视频，最多 download_jobs 个视频同时下载；videos 可以是列表或异步生成器"""
+        total = len(videos) if isinstance(videos, (list, tuple)) else None
+        stats = DownloadStats(total or 0)
+        jobs = max(1, self.download_jobs)
+        download_sem = asyncio.Semaphore(jobs)
+        # 已创建但未完成的任务数上限，下载跟不上时暂停获取后续页面（背压）
+        backlog = asyncio.Semaphore(jobs + self.pipeline_queue_size)
+        pending: Dict[str, asyncio.Event] = {}
+        tasks = []
+
+        async def process(idx: int, video: Dict, name: str, previous: Optional[asyncio.Event], done: asyncio.Event):
+            try:
+                if previous is not None:
+                    # 同名输出文件按列表顺序生成，与顺序下载的覆盖结果一致
+                    await previous.wait()
+                async with download_sem:
+                    self._print_video_header(idx, total, video)
+                    try:
+                        job = await self._resolve_download(video)
+                        if delay:
+                            await asyncio.sleep(delay)
+                        fetched = bool(job) and await self._fetch_streams(job)
+                    except BudgetExceededError as e:
+                        print(f"- 第 {idx} 个视频超出流量预算，跳过（{e}）")
+                        stats.record_skipped()
+                        return
+                    except Exception as e:
+                        print(f"下载视频 {video['title']} 时出错: {e}")
+                        fetched = False
+                success = fetched and await self._merge(job)
+                stats.record(success)
+                if success:
+                    print(f"✓ 第 {idx} 个视频下载完成")
+                else:
+                    print(f"✗ 第 {idx} 个视频下载失败")
+            finally:
+                if pending.get(name) is done:
+                    del pending[name]
+                done.set()
+                backlog.release()
+
+        print(f"异步下载模式：同时下载 {jobs} 个视频，合并 {max(1, self.merge_workers)} 个线程")
+        if self.all_parts:
+            videos = self._expand_parts(self._iterate(videos))
+            total = None
+        idx = 0
+        async for video in self._iterate(videos):
+            if self.sync and self._is_downloaded(video):
+                continue
+            idx += 1
+            stats.total = max(stats.total, idx)
+            await backlog.acquire()
+            name = self._build_base_filename(video)
+            done = asyncio.Event()
+            tasks.append(asyncio.ensure_future(process(idx, video, name, pending.get(name), done)))
+            pending[name] = done
+        await asyncio.gather(*tasks)
+        self._save_sync_marks()
+        return stats
+
+    async def _expand_parts(self, videos):
+        async for video in videos:
+            pages = video.get('pages') or await self.get_video_pages(video['bvid']) or []
+            for item in self._part_items(video, pages):
+                yield item
+
+    @staticmethod
+    async def _iterate(videos):
+        if hasattr(videos, '__aiter__'):
+            async for video in videos:
+                yield video
+        else:
+            for video in videos:
+                yield video
+
+
+async def download_batch_async(downloader: AsyncBilibiliUserDownloader, user_ids: List[str],
+                               bvids: List[str] = (), max_videos: int = None) -> DownloadStats:
+    """使用异步后端获取各用户信息，并按用户轮流边获取视频列表边下载"""
+    async with downloader:
+        for user_id in user_ids:
+            user_info = await downloader.get_user_info_from_medialist(user_id)
+            if user_info:
+                print(f"用户信息: {user_info['name']}（ID: {user_info['mid']}）")
+            else:
+                print(f"无法获取用户 {user_id} 的信息，继续尝试下载视频")
+
+        print("\n开始获取视频列表并下载...")
+        print("=" * 50)
+        return await downloader.download_videos(downloader.iter_batch_videos(user_ids, bvids, max_videos))
+
+
+async def plan_batch_async(downloader: AsyncBilibiliUserDownloader, user_ids: List[str],
+                            bvids: List[str] = (), max_videos: int = None) -> List[Dict]:
+    """使用异步后端只生成下载计划，不下载"""
+    async with downloader:
+        return await downloader.plan_downloads(downloader.iter_batch_videos(user_ids, bvids, max_videos))
+
+
+_ffmpeg_path: Optional[str] = None
+_ffmpeg_checked = False
+_ffmpeg_lock = threading.Lock()
+
+
+def find_ffmpeg() -> Optional[str]:
+    """查找可用的ffmpeg并在进程内缓存结果，返回可执行文件路径，未找到返回None"""
+    global _ffmpeg_path, _ffmpeg_checked
+    with _ffmpeg_lock:
+        if not _ffmpeg_checked:
+            import shutil
+            import subprocess
+            path = shutil.which('ffmpeg')
+            if path:
+                try:
+                    subprocess.run([path, '-version'], capture_output=True, check=True)
+                except (subprocess.CalledProcessError, OSError):
+                    path = None
+            _ffmpeg_path = path
+            _ffmpeg_checked = True
+        return _ffmpeg_path
+
+
+def check_ffmpeg():
+    """检查ffmpeg是否可用"""
+    return find_ffmpeg() is not None
+
+
+def load_cookie_file(path: str) -> str:
+    """读取Cookie文件，支持浏览器导出的 Netscape cookies.txt 和直接保存的 "name=value; ..." 字符串"""
+    with open(path, encoding='utf-8') as f:
+        lines = [line.strip() for line in f]
+    cookies = []
+    for line in lines:
+        if line.startswith('#HttpOnly_'):
+            line = line[len('#HttpOnly_'):]
+        elif not line or line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        if len(fields) == 7:
+            if 'bilibili.com' in fields[0]:
+                cookies.append(f"{fields[5]}={fields[6]}")
+        else:
+            cookies.append(line.rstrip(';'))
+    return '; '.join(cookies)
+
+
+def read_targets(args: argparse.Namespace) -> List[str]:
+    """命令行中的下载目标加上 --file 文件中的目标（每行一个，# 开头为注释）"""
+    targets = list(args.targets)
+    for path in args.file:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    targets.append(line)
+    return targets
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="B站用户视频批量下载器：可一次下载多个用户的投稿和单个视频，各用户的视频轮流下载",
+        epilog="不带下载目标运行时进入交互模式"
+    )
+    parser.add_argument('targets', nargs='*', help="用户ID、用户空间链接、BV号或视频链接")
+    parser.add_argument('-f', '--file', action='append', default=[], help="从文件读取下载目标，每行一个，可重复指定")
+    parser.add_argument('-o', '--output', default="./downloads", help="下载目录（默认 ./downloads）")
+    parser.add_argument('-j', '--jobs', type=int, default=4, help="同时下载的视频数量（默认4）")
+    parser.add_argument('-n', '--max-videos', type=int, help="每个用户最多下载的视频数量（默认全部）")
+    parser.add_argument('-q', '--quality', type=int, default=127,
+                        help="请求的画质代码 qn（127=8K 120=4K 116=1080P60 80=1080P 64=720P，默认127）")
+    parser.add_argument('--max-height', type=int, default=0, help="最高分辨率，如1080（默认不限制）")
+    parser.add_argument('--codec', default="", help="视频编码偏好，逗号分隔，如 hevc,avc（可选 avc/hevc/av1）")
+    parser.add_argument('--max-video-kbps', type=int, default=0, help="视频流码率上限（kbps，默认不限制）")
+    parser.add_argument('--max-audio-kbps', type=int, default=0, help="音频流码率上限（kbps，默认不限制）")
+    parser.add_argument('--cookie', default="", help="Cookie 字符串")
+    parser.add_argument('--cookie-file', help="Cookie 文件（Netscape cookies.txt 或 name=value 格式）")
+    parser.add_argument('--delay', type=float, default=2, help="初始请求间隔（秒，之后根据限流情况自动调整，默认2）")
+    parser.add_argument('--budget-mb', type=int, default=0, help="本次最多下载多少MB（按预计大小计算）")
+    parser.add_argument('--sync', action='store_true', help="增量同步，只下载下载目录清单中没有的新视频")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="使用异步下载后端（需要aiohttp）")
+    parser.add_argument('--prometheus', metavar='PATH',
+                        help="另外把运行指标写成 Prometheus textfile（node_exporter textfile collector 格式）")
+    parser.add_argument('--profile', action='store_true', help="开启性能分析，结果保存在下载目录的 profile 中")
+    parser.add_argument('--muxer', choices=['ffmpeg', 'builtin'], default='ffmpeg',
+                        help="合并音视频的方式：ffmpeg（没有ffmpeg时用内置合并器）或 builtin（优先用内置的fMP4合并器）")
+    parser.add_argument('--quiet', action='store_true', help="不显示下载进度行")
+    parser.add_argument('--stream-merge', action='store_true',
+                        help="边下载边合并：音视频流经命名管道直接送入ffmpeg，不写临时文件（需要ffmpeg，不支持断点续传）")
+    parser.add_argument('--plan', action='store_true', help="只列出每个视频将下载的流和预计大小，不下载")
+    parser.add_argument('--all-parts', action='store_true', help="下载多P视频的全部分P（默认只下载第一个分P）")
+    parser.add_argument('--watch', action='store_true', help="监视模式：常驻运行，定时检查各用户的新投稿并下载")
+    parser.add_argument('--poll-min', type=float, default=5, help="监视模式的最短轮询间隔（分钟，默认5）")
+    parser.add_argument('--poll-max', type=float, default=360, help="监视模式的最长轮询间隔（分钟，默认360）")
+    return parser
+
+
+def prompt_options(args: argparse.Namespace):
+    """交互模式：逐项询问下载目标和选项"""
+    user_url = input("请输入B站用户空间链接或用户ID: ").strip()
+    cookie_str = input("请输入Cookie（可选，直接回车跳过）: ").strip()
+    max_videos_input = input("请输入最大下载数量（可选，直接回车下载全部）: ").strip()
+    output_dir = input("请输入下载目录（可选，直接回车使用默认目录./downloads）: ").strip()
+    delay_input = input("请输入初始请求间隔时间（秒，默认2秒，之后会根据限流情况自动调整）: ").strip()
+    jobs_input = input("请输入同时下载的视频数量（默认1，即顺序下载）: ").strip()
+    height_input = input("请输入最高分辨率（如1080，直接回车选择最高画质）: ").strip()
+    budget_input = input("请输入本次最多下载多少MB（按预计大小计算，直接回车不限制）: ").strip()
+    sync_input = input("是否增量同步，只下载下载目录清单中没有的新视频？(y/n，默认n): ").strip().lower()
+    async_input = ''
+    if aiohttp is not None:
+        async_input = input("是否使用异步下载后端？(y/n，默认n): ").strip().lower()
+
+    # 处理输入参数
+    args.targets = [user_url]
+    args.cookie = cookie_str
+    args.max_videos = int(max_videos_input) if max_videos_input else None
+    args.output = output_dir if output_dir else "./downloads"
+    args.delay = int(delay_input) if delay_input and delay_input.isdigit() else 2
+    args.jobs = int(jobs_input) if jobs_input.isdigit() and int(jobs_input) > 0 else 1
+    args.max_height = int(height_input) if height_input.isdigit() else 0
+    args.budget_mb = int(budget_input) if budget_input.isdigit() else 0
+    args.sync = sync_input == 'y'
+    args.use_async = async_input == 'y'
+
+
+def main(argv: List[str] = None):
+    """B站用户视频批量下载器主函数：带下载目标时批量下载，否则进入交互模式"""
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+    codecs = [name.strip().lower() for name in args.codec.split(',') if name.strip()]
+    unknown = [name for name in codecs if name not in ('avc', 'hevc', 'av1')]
+    if unknown:
+        parser.error(f"不支持的视频编码: {', '.join(unknown)}（可选 avc/hevc/av1）")
+    interactive = not args.targets and not args.file
     print("===== B站用户视频批量下载器 =====")
     
     # 检查ffmpeg
@@ -681,95 +4265,111 @@ def main():
         print("   - Windows: 下载 https://ffmpeg.org/download.html 并添加到PATH")
         print("   - macOS: brew install ffmpeg")
         print("   - Linux: sudo apt install ffmpeg 或 sudo yum install ffmpeg")
-        print("   没有ffmpeg将只能下载无声音的视频文件")
+        print("   没有ffmpeg时使用内置合并器，仅支持DASH分片MP4格式")
         
-        continue_choice = input("\n是否继续下载？(y/n): ").strip().lower()
-        if continue_choice != 'y':
-            print("程序退出")
-            return
+        if interactive:
+            continue_choice = input("\n是否继续下载？(y/n): ").strip().lower()
+            if continue_choice != 'y':
+                print("程序退出")
+                return
         print()
     else:
         print("✓ 检测到ffmpeg，支持音视频合并")
         print()
     
-    # 交互式输入用户信息
-    user_url = input("请输入B站用户空间链接或用户ID: ").strip()
-    cookie_str = input("请输入Cookie（可选，直接回车跳过）: ").strip()
-    max_videos_input = input("请输入最大下载数量（可选，直接回车下载全部）: ").strip()
-    output_dir = input("请输入下载目录（可选，直接回车使用默认目录./downloads）: ").strip()
-    delay_input = input("请输入请求间隔时间（秒，默认3秒）: ").strip()
-
-    # 处理输入参数
-    max_videos = int(max_videos_input) if max_videos_input else None
-    download_dir = output_dir if output_dir else "./downloads"
-    delay = int(delay_input) if delay_input and delay_input.isdigit() else 3
+    if interactive:
+        prompt_options(args)
+    targets = read_targets(args)
+    if args.use_async and aiohttp is None:
+        print("未安装aiohttp，使用线程下载后端")
+        args.use_async = False
+    if args.watch and args.use_async:
+        print("监视模式使用线程下载后端")
+        args.use_async = False
 
     # 初始化下载器
-    downloader = BilibiliUserDownloader(cookie_str)
-    downloader.download_dir = download_dir
-    downloader.delay_between_requests = delay
+    cookie_str = load_cookie_file(args.cookie_file) if args.cookie_file else args.cookie
+    downloader_class = AsyncBilibiliUserDownloader if args.use_async else BilibiliUserDownloader
+    downloader = downloader_class(cookie_str)
+    downloader.download_dir = args.output
+    downloader.api_rate = 1 / args.delay if args.delay > 0 else downloader.api_max_rate
+    downloader.download_jobs = max(1, args.jobs)
+    downloader.quality = args.quality
+    downloader.all_parts = args.all_parts
+    downloader.prometheus_path = args.prometheus
+    downloader.stream_merge = args.stream_merge
+    downloader.muxer = args.muxer
+    downloader.quiet = args.quiet
+    if args.stream_merge and not (hasattr(os, 'mkfifo') and find_ffmpeg()):
+        print("边下载边合并需要ffmpeg和命名管道（os.mkfifo），将先下载临时文件再合并")
+    downloader.stream_policy.max_height = args.max_height
+    downloader.stream_policy.codec_order = codecs
+    downloader.stream_policy.max_video_bitrate = args.max_video_kbps * 1000
+    downloader.stream_policy.max_audio_bitrate = args.max_audio_kbps * 1000
+    downloader.byte_budget = args.budget_mb * 1024 * 1024
+    downloader.sync = args.sync
+    if args.profile:
+        downloader.profiler = RunProfiler(os.path.join(args.output, 'profile'))
+        downloader.profiler.start()
+        print("性能分析已开启")
 
-    # 初始化WBI密钥
-    if not downloader.init_wbi_keys():
-        print("WBI密钥初始化失败，程序退出")
+    # 提取用户ID和BV号
+    user_ids, bvids = downloader.classify_targets(targets)
+    if not user_ids and not bvids:
+        print("无法从输入中提取用户ID或BV号，请检查链接是否正确")
         return
+    print(f"用户ID: {', '.join(user_ids) or '无'}，单个视频: {len(bvids)} 个")
 
-    # 提取用户ID
-    user_id = downloader.extract_user_id(user_url)
-    if not user_id:
-        print("无法从输入中提取用户ID，请检查链接是否正确")
+    if args.plan:
+        if args.use_async:
+            asyncio.run(plan_batch_async(downloader, user_ids, bvids, args.max_videos))
+        else:
+            downloader.plan_downloads(downloader.iter_batch_videos(user_ids, bvids, args.max_videos))
+        if downloader.profiler:
+            print(f"性能分析结果: {downloader.profiler.stop()}（cpu.folded 可用 flamegraph.pl 或 speedscope 查看）")
         return
-    print(f"提取到用户ID: {user_id}")
 
-    # 获取用户信息
-    user_info = downloader.get_user_info_from_medialist(user_id)
-    if user_info:
-        print(f"用户信息: {user_info['name']}（ID: {user_info['mid']}）")
+    if args.watch:
+        watcher = CreatorWatcher(downloader, user_ids, bvids, args.poll_min * 60, args.poll_max * 60)
+        stats = watcher.run()
+    elif args.use_async:
+        stats = asyncio.run(download_batch_async(downloader, user_ids, bvids, args.max_videos))
     else:
-        print("无法获取用户信息，继续尝试下载视频")
+        # 获取用户信息
+        for user_id in user_ids:
+            user_info = downloader.get_user_info_from_medialist(user_id)
+            if user_info:
+                print(f"用户信息: {user_info['name']}（ID: {user_info['mid']}）")
+            else:
+                print(f"无法获取用户 {user_id} 的信息，继续尝试下载视频")
 
-    # 获取视频列表（按需获取指定数量）
-    print("\n开始获取视频列表...")
-    all_videos = downloader.get_all_user_videos(user_id, max_videos)
-    if not all_videos:
-        print("未获取到任何视频，程序退出")
+        # 边获取视频列表边下载：各用户轮流取视频，第一页返回后即开始下载，后续页面在下载过程中继续获取
+        print("\n开始获取视频列表并下载...")
+        print("=" * 50)
+        stats = downloader.download_videos(downloader.iter_batch_videos(user_ids, bvids, args.max_videos))
+    if downloader.profiler:
+        print(f"性能分析结果: {downloader.profiler.stop()}（cpu.folded 可用 flamegraph.pl 或 speedscope 查看）")
+    # 没有新视频的运行也写出报告，便于跟踪接口和列表阶段的耗时
+    report_path = downloader.write_run_report(stats)
+    if stats.total == 0:
+        print("没有需要下载的新视频" if args.sync else "未获取到任何视频，程序退出")
+        if report_path:
+            print(f"运行报告: {report_path}")
         return
 
-    print(f"\n准备下载 {len(all_videos)} 个视频...")
-    print("=" * 50)
-
-    # 开始下载
-    success_count = 0
-    fail_count = 0
-    
-    for idx, video in enumerate(all_videos, 1):
-        print(f"\n===== 处理第 {idx}/{len(all_videos)} 个视频 =====")
-        print(f"标题: {video['title']}")
-        print(f"BV号: {video['bvid']}")
-        print(f"作者: {video['author']}")
-        print(f"时长: {video['length']}")
-        
-        success = downloader._download_video(video)
-        if success:
-            success_count += 1
-            print(f"✓ 第 {idx} 个视频下载完成")
-        else:
-            fail_count += 1
-            print(f"✗ 第 {idx} 个视频下载失败")
-        
-        # 下载间隔
-        if idx < len(all_videos):
-            print(f"等待 {delay} 秒后继续下载...")
-            time.sleep(delay)
-    
     # 下载完成统计
     print("\n" + "=" * 50)
     print("下载完成！")
-    print(f"成功下载: {success_count} 个视频")
-    print(f"下载失败: {fail_count} 个视频")
-    print(f"下载目录: {download_dir}")
+    unit = "个视频/分P" if args.all_parts else "个视频"
+    print(f"成功下载: {stats.success} {unit}")
+    print(f"下载失败: {stats.fail} {unit}")
+    if stats.skipped:
+        print(f"超出流量预算跳过: {stats.skipped} {unit}")
+    print(f"总用时: {stats.elapsed:.1f} 秒")
+    if report_path:
+        print(f"运行报告: {report_path}")
+    print(f"下载目录: {args.output}")
     print("=" * 50)
 
-
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+离线基准测试
+在本地启动模拟的B站API和CDN服务器，不访问真实的B站即可测量
+列表获取、API请求、单文件下载、完整下载流程和音视频合并的性能
+
+模拟的接口: x/web-interface/nav、medialist/info、medialist/resource/list、
+x/web-interface/view、x/player/wbi/playurl，以及支持Range请求的CDN（两个镜像）。
+可以设置每个连接的带宽上限、每个请求的延迟、CDN传输中断的概率和412限流。
+
+用法:
+    python benchmark.py                          # 默认测试 1.py
+    python benchmark.py --script 2.py --bandwidth 20 --latency 30 --error-rate 0.05
+    python benchmark.py --throttle-every 10 --json bench.json
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import math
+import os
+import random
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List, Optional
+from urllib.parse import urlparse, parse_qs
+
+
+MB = 1024 * 1024
+
+
+def _box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack('>I4s', len(payload) + 8, box_type) + payload
+
+
+def _full_box(box_type: bytes, version: int, flags: int, payload: bytes) -> bytes:
+    return _box(box_type, struct.pack('>I', (version << 24) | flags) + payload)
+
+
+def build_fmp4(size: int, timescale: int, fragments: int, handler: bytes) -> bytes:
+    """生成单轨道的分片MP4，结构与B站DASH流相同（ftyp/moov/sidx + moof/mdat），样本内容为随机字节"""
+    mvhd = _full_box(b'mvhd', 0, 0, struct.pack('>IIII', 0, 0, 1000, 0) + b'\0' * 76 + struct.pack('>I', 2))
+    tkhd = _full_box(b'tkhd', 0, 3, struct.pack('>IIIII', 0, 0, 1, 0, 0) + b'\0' * 60)
+    mdhd = _full_box(b'mdhd', 0, 0, struct.pack('>IIII', 0, 0, timescale, 0) + b'\0' * 4)
+    hdlr = _full_box(b'hdlr', 0, 0, b'\0' * 4 + handler + b'\0' * 13)
+    trak = _box(b'trak', tkhd + _box(b'mdia', mdhd + hdlr))
+    mvex = _box(b'mvex', _full_box(b'trex', 0, 0, struct.pack('>IIIII', 1, 1, 0, 0, 0)))
+    parts = [_box(b'ftyp', b'iso5\0\0\0\1iso6mp41'), _box(b'moov', mvhd + trak + mvex), _box(b'sidx', b'\0' * 24)]
+
+    fragments = max(1, fragments)
+    payload_size = max(1, size // fragments)
+    for i in range(fragments):
+        payload = os.urandom(payload_size)
+        tfhd = _full_box(b'tfhd', 0, 0x020000, struct.pack('>I', 1))
+        tfdt = _full_box(b'tfdt', 1, 0, struct.pack('>Q', i * 2 * timescale))
+        trun_size = len(_full_box(b'trun', 0, 0x201, b'\0' * 12))
+        moof_size = 8 + len(_full_box(b'mfhd', 0, 0, b'\0' * 4)) + 8 + len(tfhd) + len(tfdt) + trun_size
+        trun = _full_box(b'trun', 0, 0x201, struct.pack('>IiI', 1, moof_size + 8, payload_size))
+        moof = _box(b'moof', _full_box(b'mfhd', 0, 0, struct.pack('>I', i + 1)) + _box(b'traf', tfhd + tfdt + trun))
+        parts.append(moof + _box(b'mdat', payload))
+    return b''.join(parts)
+
+
+class FakeBilibiliServer:
+    """模拟B站API和CDN的本地HTTP服务器
+
+    bandwidth 为每个CDN连接的带宽上限（字节/秒，0为不限制），latency 为每个请求的额外延迟（秒），
+    error_rate 为CDN传输中途断开的概率，throttle_every 为每隔多少个API请求返回一次412（0为不限流）。
+    """
+
+    def __init__(self, videos: int = 20, video_size: int = 16 * MB, audio_size: int = 2 * MB,
+                 bandwidth: int = 0, latency: float = 0.0, error_rate: float = 0.0,
+                 throttle_every: int = 0, seed: int = 0):
+        self.videos = videos
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_every = throttle_every
+        self.random = random.Random(seed)
+        fragments = max(1, video_size // MB)
+        self.files = {
+            'video.m4s': build_fmp4(video_size, 90000, fragments, b'vide'),
+            'audio.m4s': build_fmp4(audio_size, 48000, fragments, b'soun'),
+        }
+        self.api_requests = 0
+        self.throttled = 0
+        self.injected_errors = 0
+        self._lock = threading.Lock()
+        self._server: Optional[_QuietServer] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self) -> 'FakeBilibiliServer':
+        handler = type('Handler', (_FakeHandler,), {'bench': self})
+        self._server = _QuietServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def should_throttle(self) -> bool:
+        with self._lock:
+            self.api_requests += 1
+            if self.throttle_every and self.api_requests % self.throttle_every == 0:
+                self.throttled += 1
+                return True
+        return False
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.injected_errors += 1
+                return True
+        return False
+
+    def media_item(self, i: int) -> Dict:
+        return {
+            'bv_id': f'BV1bench{i:04d}', 'id': i, 'title': f'benchmark video {i}', 'cover': '',
+            'upper': {'name': 'benchmark', 'mid': 1}, 'pubtime': 1700000000 + i, 'duration': 120,
+            'cnt_info': {'play': 0, 'reply': 0},
+            'pages': [{'id': 100000 + i, 'page': 1, 'title': 'P1', 'duration': 120}],
+        }
+
+    def playurl(self) -> Dict:
+        cdn = [f"{self.url}/cdn{n}/" for n in (1, 2)]
+
+        def stream(name, **fields):
+            return dict(fields, baseUrl=cdn[0] + name, backupUrl=[cdn[1] + name])
+
+        return {
+            'quality': 80, 'timelength': 120000,
+            'dash': {
+                'duration': 120,
+                'video': [stream('video.m4s', id=80, height=1080, codecid=7, codecs='avc1.640032',
+                                 bandwidth=len(self.files['video.m4s']) * 8 // 120)],
+                'audio': [stream('audio.m4s', id=30280, codecs='mp4a.40.2',
+                                 bandwidth=len(self.files['audio.m4s']) * 8 // 120)],
+            }
+        }
+
+
+class _QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端测速后主动断开、注入的传输错误都会产生连接重置，不输出堆栈
+        pass
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # 响应头和响应体分开写出，不关闭Nagle算法时每个请求会多出约40ms
+    bench: FakeBilibiliServer = None
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, data: Dict, status: int = 200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        bench = self.bench
+        if bench.latency:
+            time.sleep(bench.latency)
+        url = urlparse(self.path)
+        path = url.path
+        if re.match(r'^/cdn\d+/', path):
+            return self._serve_file(path.rsplit('/', 1)[1])
+
+        query = {k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+        if bench.should_throttle():
+            return self._json({'code': -412, 'message': '请求被拦截'}, status=412)
+        if path == '/x/web-interface/nav':
+            return self._json({'code': -101, 'message': '账号未登录', 'data': {'isLogin': False, 'wbi_img': {
+                'img_url': 'https://i0.hdslb.com/bfs/wbi/7cd084941338484aae1ad9425b84077c.png',
+                'sub_url': 'https://i0.hdslb.com/bfs/wbi/4932caff0ff746eab6f01bf08b70ac45.png'}}})
+        if path == '/x/v1/medialist/info':
+            return self._json({'code': 0, 'data': {'upper': {'mid': 1, 'name': 'benchmark', 'face': ''},
+                                                   'intro': '', 'media_count': bench.videos}})
+        if path == '/x/v2/medialist/resource/list':
+            page_size = int(query.get('ps') or 20)
+            oid = int(query.get('oid') or bench.videos + 1)
+            ids = [i for i in range(bench.videos, 0, -1) if i < oid][:page_size]
+            return self._json({'code': 0, 'data': {'has_more': bool(ids) and ids[-1] > 1,
+                                                   'media_list': [bench.media_item(i) for i in ids]}})
+        if path == '/x/web-interface/view':
+            i = int(re.sub(r'\D', '', query.get('bvid', '0')) or 0)
+            return self._json({'code': 0, 'data': {'bvid': query.get('bvid'), 'pages': [
+                {'cid': 100000 + i, 'page': 1, 'part': 'P1', 'duration': 120}]}})
+        if path == '/x/player/wbi/playurl':
+            return self._json({'code': 0, 'data': bench.playurl()})
+        self._json({'code': -404, 'message': '啥都木有'}, status=404)
+
+    def _serve_file(self, name: str):
+        bench = self.bench
+        data = bench.files.get(name)
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = 0, len(data) - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else end, end)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        body = memoryview(data)[start:end + 1]
+        # 注入的错误在传输到一半时断开连接
+        cut = len(body) // 2 if len(body) > 64 * 1024 and bench.should_fail() else None
+        began = time.monotonic()
+        sent = 0
+        try:
+            for offset in range(0, len(body), 64 * 1024):
+                if cut is not None and offset >= cut:
+                    self.close_connection = True
+                    return
+                chunk = body[offset:offset + 64 * 1024]
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if bench.bandwidth:
+                    delay = sent / bench.bandwidth - (time.monotonic() - began)
+                    if delay > 0:
+                        time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    """最近秩法百分位数"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Benchmark:
+    """针对 1.py/2.py 中的 BilibiliUserDownloader 运行各项基准测试"""
+
+    def __init__(self, module, server: FakeBilibiliServer, workdir: str, verbose: bool = False):
+        self.module = module
+        self.server = server
+        self.workdir = workdir
+        self.verbose = verbose
+        self.results: List[Dict] = []
+
+    @contextlib.contextmanager
+    def _output(self):
+        """下载器本身输出很多日志，默认不显示"""
+        if self.verbose:
+            yield
+        else:
+            with contextlib.redirect_stdout(io.StringIO()):
+                yield
+
+    def _downloader(self, name: str, **overrides):
+        directory = os.path.join(self.workdir, name)
+        shutil.rmtree(directory, ignore_errors=True)
+        with self._output():
+            downloader = self.module.BilibiliUserDownloader()
+        downloader.api_base = self.server.url
+        downloader.download_dir = directory
+        downloader.cache_path = None
+        downloader.report_name = None
+        downloader.quiet = True
+        downloader.api_rate = downloader.api_max_rate = 1000.0
+        for key, value in overrides.items():
+            setattr(downloader, key, value)
+        return downloader
+
+    def _record(self, name: str, samples: List[float], total_seconds: float,
+                total_bytes: int = 0, videos: int = 0):
+        result = {
+            'name': name,
+            'runs': len(samples),
+            'seconds': total_seconds,
+            'mb_per_s': total_bytes / MB / total_seconds if total_bytes and total_seconds else None,
+            'videos_per_min': videos * 60 / total_seconds if videos and total_seconds else None,
+            'p50_ms': percentile(samples, 50) * 1000,
+            'p95_ms': percentile(samples, 95) * 1000,
+        }
+        self.results.append(result)
+        return result
+
+    @staticmethod
+    def _timed(samples: List[float], func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - start)
+
+    def listing(self, repeat: int):
+        """获取完整视频列表（每页一次 resource/list 请求）"""
+        pages: List[float] = []
+        started = time.perf_counter()
+        for _ in range(repeat):
+            downloader = self._downloader('listing')
+            fetch_page = downloader._fetch_medialist_page
+            downloader._fetch_medialist_page = lambda *a, **k: self._timed(pages, fetch_page, *a, **k)
+            with self._output():
+                downloader.get_all_user_videos('1')
+        self._record('listing (per page)', pages, time.perf_counter() - started)
+
+    def api(self, count: int):
+        """逐个视频请求 view 和 playurl 接口"""
+        view: List[float] = []
+        playurl: List[float] = []
+        downloader = self._downloader('api')
+        with self._output():
+            started = time.perf_counter()
+            for i in range(1, count + 1):
+                bvid = f'BV1bench{i:04d}'
+                self._timed(view, downloader.get_video_pages, bvid)
+            view_seconds = time.perf_counter() - started
+            started = time.perf_counter()
+            for i in range(1, count + 1):
+                self._timed(playurl, downloader.get_video_download_url, f'BV1bench{i:04d}', str(100000 + i))
+            playurl_seconds = time.perf_counter() - started
+        self._record('api view', view, view_seconds)
+        self._record('api playurl', playurl, playurl_seconds)
+
+    def file_download(self, repeat: int):
+        """download_video_file 下载单个视频流（含镜像测速、分段下载）"""
+        downloader = self._downloader('file')
+        os.makedirs(downloader.download_dir, exist_ok=True)
+        urls = [f"{self.server.url}/cdn{n}/video.m4s" for n in (1, 2)]
+        size = len(self.server.files['video.m4s'])
+        samples: List[float] = []
+        ok = 0
+        with self._output():
+            for i in range(repeat):
+                filename = os.path.join(downloader.download_dir, f"video{i}.m4s")
+                ok += bool(self._timed(samples, downloader.download_video_file, urls[0], filename, urls[1:]))
+                if os.path.exists(filename):
+                    os.remove(filename)
+        self._record('download_video_file', samples, sum(samples), total_bytes=size * ok)
+
+    def full_path(self, count: int, jobs: int):
+        """完整下载流程：_download_video（cid → playurl → 下载音视频流 → 合并），以及多个视频并发下载"""
+        downloader = self._downloader('video', muxer='builtin')
+        with self._output():
+            videos = downloader.get_all_user_videos('1', count)
+        size = len(self.server.files['video.m4s']) + len(self.server.files['audio.m4s'])
+        samples: List[float] = []
+        ok = 0
+        with self._output():
+            for video in videos:
+                ok += bool(self._timed(samples, downloader._download_video, video))
+        self._record('_download_video', samples, sum(samples), total_bytes=size * ok, videos=ok)
+
+        if jobs > 1:
+            downloader = self._downloader('video_jobs', muxer='builtin', download_jobs=jobs)
+            with self._output():
+                started = time.perf_counter()
+                stats = downloader.download_videos(videos)
+                elapsed = time.perf_counter() - started
+            self._record(f'download_videos (jobs={jobs})', [elapsed], elapsed,
+                         total_bytes=size * stats.success, videos=stats.success)
+
+    def merge(self, repeat: int):
+        """合并音视频：内置fMP4合并器，以及ffmpeg（可用时）"""
+        source_dir = os.path.join(self.workdir, 'merge')
+        os.makedirs(source_dir, exist_ok=True)
+        size = len(self.server.files['video.m4s']) + len(self.server.files['audio.m4s'])
+        muxers = ['builtin']
+        if self.module.find_ffmpeg():
+            muxers.append('ffmpeg')
+        for muxer in muxers:
+            downloader = self._downloader('merge_out', muxer=muxer)
+            os.makedirs(downloader.download_dir, exist_ok=True)
+            samples: List[float] = []
+            with self._output():
+                for i in range(repeat):
+                    # merge_video_audio 会删除输入文件，每次先复制一份（不计入耗时）
+                    video_file = os.path.join(source_dir, 'video.tmp')
+                    audio_file = os.path.join(source_dir, 'audio.tmp')
+                    with open(video_file, 'wb') as f:
+                        f.write(self.server.files['video.m4s'])
+                    with open(audio_file, 'wb') as f:
+                        f.write(self.server.files['audio.m4s'])
+                    output = os.path.join(downloader.download_dir, f'merged{i}.mp4')
+                    self._timed(samples, downloader.merge_video_audio, video_file, audio_file, output)
+            self._record(f'merge ({muxer})', samples, sum(samples), total_bytes=size * repeat)
+
+    def print_results(self):
+        print(f"{'benchmark':<30}{'runs':>6}{'MB/s':>10}{'videos/min':>12}{'p50 ms':>10}{'p95 ms':>10}")
+        for r in self.results:
+            mb_per_s = f"{r['mb_per_s']:.1f}" if r['mb_per_s'] is not None else '-'
+            videos_per_min = f"{r['videos_per_min']:.1f}" if r['videos_per_min'] is not None else '-'
+            print(f"{r['name']:<30}{r['runs']:>6}{mb_per_s:>10}{videos_per_min:>12}"
+                  f"{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}")
+
+
+def load_script(path: str):
+    """按路径加载下载器脚本（文件名为 1.py/2.py，不能直接 import）"""
+    spec = importlib.util.spec_from_file_location('bilibili_downloader', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main():
+    parser = argparse.ArgumentParser(description="B站下载器离线基准测试（本地模拟API和CDN）")
+    parser.add_argument('--script', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '1.py'),
+                        help="要测试的下载器脚本（默认 1.py）")
+    parser.add_argument('--videos', type=int, default=20, help="模拟的视频数量")
+    parser.add_argument('--video-size', type=float, default=16, help="视频流大小（MB）")
+    parser.add_argument('--audio-size', type=float, default=2, help="音频流大小（MB）")
+    parser.add_argument('--bandwidth', type=float, default=0, help="每个CDN连接的带宽上限（MB/s，0为不限制）")
+    parser.add_argument('--latency', type=float, default=0, help="每个请求的额外延迟（毫秒）")
+    parser.add_argument('--error-rate', type=float, default=0, help="CDN传输中途断开的概率（0~1）")
+    parser.add_argument('--throttle-every', type=int, default=0, help="每隔多少个API请求返回一次412（0为不限流）")
+    parser.add_argument('--repeat', type=int, default=5, help="列表、单文件下载和合并的重复次数")
+    parser.add_argument('--jobs', type=int, default=4, help="并发下载测试的视频数量（1为跳过）")
+    parser.add_argument('--only', default='listing,api,file,video,merge',
+                        help="只运行指定的测试，逗号分隔：listing,api,file,video,merge")
+    parser.add_argument('--json', dest='json_path', help="把结果写入JSON文件")
+    parser.add_argument('--verbose', action='store_true', help="显示下载器自身的输出")
+    args = parser.parse_args()
+
+    module = load_script(args.script)
+    server = FakeBilibiliServer(
+        videos=args.videos,
+        video_size=int(args.video_size * MB),
+        audio_size=int(args.audio_size * MB),
+        bandwidth=int(args.bandwidth * MB),
+        latency=args.latency / 1000,
+        error_rate=args.error_rate,
+        throttle_every=args.throttle_every,
+    ).start()
+    workdir = tempfile.mkdtemp(prefix='bilibili_bench_')
+    selected = set(args.only.split(','))
+    print(f"基准测试: {args.script}，模拟服务器 {server.url}，临时目录 {workdir}")
+    bench = Benchmark(module, server, workdir, args.verbose)
+    try:
+        if 'listing' in selected:
+            bench.listing(args.repeat)
+        if 'api' in selected:
+            bench.api(args.videos)
+        if 'file' in selected:
+            bench.file_download(args.repeat)
+        if 'video' in selected:
+            bench.full_path(args.videos, args.jobs)
+        if 'merge' in selected:
+            bench.merge(args.repeat)
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    bench.print_results()
+    print(f"API请求 {server.api_requests} 次，其中412限流 {server.throttled} 次；注入传输错误 {server.injected_errors} 次")
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'script': args.script,
+                'config': vars(args),
+                'server': {'api_requests': server.api_requests, 'throttled': server.throttled,
+                           'injected_errors': server.injected_errors},
+                'results': bench.results,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()